@@ -26,12 +26,16 @@ forceadd = True
 forceurlstore = False
 # Set to true if want each ipfs hash added to DHT via DHT provide
 announcedht = False
+# With forceadd, pipe each file from archive.org into IPFS rather than downloading it first
+stream = True
+# Files ingested in parallel, None uses config["ipfs"]["ingest_concurrency"]
+concurrency = None
 
 obj = ArchiveItem.new("archiveid", *args, wanttorrent=False)
 print('"URL","Add/Urlstore","Hash","Size","Announced"')
 if isinstance(obj, ArchiveFile): # TODO-PERMS-OK cache_ipfs should be checking perms
-    obj.cache_ipfs(url = obj.archive_url, forceadd=forceadd, forceurlstore=forceurlstore, verbose=False,  printlog=True, announcedht=announcedht, size=int(obj._metadata["size"]))
+    obj.cache_ipfs(url = obj.archive_url, forceadd=forceadd, forceurlstore=forceurlstore, verbose=False,  printlog=True, announcedht=announcedht, size=int(obj._metadata["size"]), stream=stream)
 else:
-    obj.cache_ipfs(forceurlstore=forceurlstore, forceadd=forceadd, verbose=False, announcedht=announcedht, printlog=True)  # Will Loop through all files in Item
+    obj.cache_ipfs(forceurlstore=forceurlstore, forceadd=forceadd, verbose=False, announcedht=announcedht, printlog=True, stream=stream, concurrency=concurrency)  # Will Loop through all files in Item
 
 #print("---FINISHED ---")
@@ -5,13 +5,17 @@ import base64
 import hashlib
 import requests
 import urllib.parse
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from .NameResolver import NameResolverDir, NameResolverFile
 from .miscutils import loads, dumps, httpget
 from .config import config
 from .Multihash import Multihash
 from .Errors import CodingException, MyBaseException, IPFSException, TransportURLNotFound, ForbiddenException
-from .HashStore import MagnetLinkService, ThumbnailIPFSfromItemIdService, TitleService
+from .HashStore import MagnetLinkService, ThumbnailIPFSfromItemIdService, TitleService, IPLDHashService
 from .TransportIPFS import TransportIPFS
 from .LocalResolver import KeyValueTable
 from .KeyPair import KeyPair
@@ -37,7 +41,9 @@ archiveconfig = {
         '-date': ['podcasts', 'audio_podcast', 'community_media'],
         'titleSorter': ['densho'],
     },
-    'excludefromparentsortoder': ['TVNewsKitchen']
+    'excludefromparentsortoder': ['TVNewsKitchen'],
+    # Fields in archive.org/metadata that change on every request, ignored when checking if a leaf needs rebuilding
+    'leafvolatilefields': ['created', 'd1', 'd2', 'dir', 'server', 'uniq', 'workable_servers', 'alternate_locations'],
 
 }
 
@@ -146,10 +152,16 @@ class ArchiveItem(NameResolverDir):
         itemid = itemid
         _thumbnail = list of urls of thumbnail (access via thumbnail())
         _list = list of ArchiveFiles
+        _filesbyname = { name: file metadata } index into _metadata["files"] (set by _indexfiles)
+        _torrenttime = mtime of the item's torrent file or 0 (set by _indexfiles)
 
     Supports: metadata
     """
     alwaysArray = ["collection"]       # Any metadata fields which should always be a (possibly empty) array
+    _domainkeypair = None               # KeyPair for signing leafs, see domainkeypair()
+    _leafcache = OrderedDict()          # { itemid: (metadatahash, leaf) } most recently built leaf for each item, see leaf()
+    _leafcachelock = threading.Lock()   # Protects _leafcache across server threads
+    leafcachesize = 10000               # Maximum number of leafs remembered in _leafcache
 
     def _enforceMetadataContracts(self):
         # Enforce consistency in data, especially type of fields, to avoid having to check everywhere for Fjords
@@ -195,6 +207,7 @@ class ArchiveItem(NameResolverDir):
         obj._enforceMetadataContracts()     # Ensure fields we care about are what we expect e.g. always a possibly empty array
         if not obj._metadata:  # metadata retrieval failed, itemid probably false
             raise ArchiveItemNotFound(itemid=itemid)
+        obj._indexfiles()       # Index files by name so dont have to scan them for each file
         if obj._metadata.get("metadata", None):  # Some items e.g. with isdark:true will not have metadata.
             obj.setmagnetlink(wantmodified=True, wanttorrent=kwargs.get("wanttorrent", False), verbose=verbose)  # Set a modified magnet link suitable for WebTorrent
             if not obj._metadata["metadata"].get("thumbnaillinks"):  # Set thumbnaillinks if not done already - can be slow as loads to IPFS
@@ -205,18 +218,69 @@ class ArchiveItem(NameResolverDir):
                 ln = int(name.split('/')[-1])
                 return ArchiveFilePadding(verbose=verbose, ln=ln)
             else:
-                f = [f for f in obj._metadata["files"] if f["name"] == name]
-                if not f: raise Exception("Valid Archive item {} but no file called: {}".format(itemid, name))    # TODO change to islice
-                return ArchiveFile.new(namespace, itemid, name, item=obj, metadata=f[0], verbose=verbose)
-        else:  # Its an item - cache all the files isdark:dark and possibly other items have no .files field
-            obj._list = [ArchiveFile.new(namespace, itemid, f["name"], item=obj, metadata=f, transport=transport,
-                                         verbose=verbose) for f in obj._metadata.get("files",[])]
+                f = obj._filesbyname.get(name)
+                if not f: raise Exception("Valid Archive item {} but no file called: {}".format(itemid, name))
+                return ArchiveFile.new(namespace, itemid, name, item=obj, metadata=f, verbose=verbose)
+        else:  # Its an item - ArchiveFiles are built as accessed, isdark:dark and possibly other items have no .files field
+            obj._list = ArchiveFileList(obj, namespace, transport=transport, verbose=verbose)
             if verbose: logging.debug("Archive Metadata found {0} files".format(len(obj._list)))
             return obj
 
+    def _indexfiles(self):
+        """
+        Build an index from name to file metadata, and find the mtime of the torrent,
+        done once per fetch of metadata, as per-file lookups (e.g. inTorrent) would otherwise scan all files each time.
+        """
+        files = self._metadata.get("files", [])  # isdark:dark and possibly other items have no .files field
+        self._filesbyname = {}
+        for f in files:
+            self._filesbyname.setdefault(f["name"], f)  # First wins if a name is repeated, as the linear search did
+        torrentending = self.itemid + "_archive.torrent"
+        torrentfile = next((f for f in files if f["name"].endswith(torrentending)), None)
+        self._torrenttime = int(torrentfile["mtime"]) if torrentfile else 0
+        self._filesderived = False  # Set by _setfilesderivedfields
+
     def torrenttime(self):
-        files = [ f for f in self._metadata["files"] if f["name"].endswith(self.itemid +"_archive.torrent")]
-        return int(files[0]["mtime"]) if len(files) else 0
+        return self._torrenttime    # Set by _indexfiles
+
+    def _itemintorrent(self):
+        # Item level part of ArchiveFile.inTorrent, False if none of the files can be in the item's torrent
+        # The rule is a bit more complex, if any of the collctions an item is in are not open (don't start with open_) then can go to 250GB else 75GB)
+        return not ((self._metadata["metadata"].get("noarchivetorrent", None) == "true") or
+                    any([coll in config["torrent_reject_collections"] for coll in self._metadata["metadata"]["collection"]]) or
+                    (self._metadata["item_size"] > 80530636800))
+
+    def _fileintorrent(self, f):
+        # File level part of ArchiveFile.inTorrent, f is the file's metadata
+        # TODO may be some specific files e.g. _meta.xml that should also return false
+        if any([f["name"].endswith(ending) for ending in config["torrent_reject_list"]]):
+            return False
+        # TODO Note this next line fails if mtime = "12345.0" as it does for some items see https://github.com/internetarchive/dweb-mirror/issues/212
+        if (not f.get("mtime")) or (self._torrenttime < int(f["mtime"])):
+            if self._torrenttime: # Only log the data inconsistency if the torrent exists
+                # Note known bug in Traceys code as of 13Nov2018 where doesnt update torrent when writing __ia_thumb.jpg TODO ask Tracey to fix
+                # Large torrents can be behind on updates
+                # If files count is large there is a bug with some part of the tools process Aaron let me know about, setting to 20k as a guess
+                if (self._metadata["item_size"] < 80530636800) and (self._metadata["files_count"] < 20000) and (f["name"] != "__ia_thumb.jpg"):
+                    logging.warning("Aaron believes all that torrents updated for files not in reject_list exception={}/{}".format(self.itemid, f["name"]));
+            return False
+        return True
+
+    def _setfilesderivedfields(self):
+        """
+        Set the magnetlink and contenthash fields of each file in _metadata["files"] in a single pass,
+        this is only done when the response includes the files, and is equivalent to what ArchiveFile.new sets for one file.
+        """
+        if self._filesderived:
+            return
+        magnetlink = (self._metadata.get("metadata") or {}).get("magnetlink")   # isdark:true have no metadata
+        itemintorrent = bool(magnetlink) and self._itemintorrent()
+        for f in self._metadata.get("files", []):
+            if itemintorrent and self._fileintorrent(f):
+                f["magnetlink"] = "{}/{}".format(magnetlink, f["name"])
+            if f.get("sha1"):   # For the _files.xml there is no SHA1
+                f["contenthash"] = "contenthash:/contenthash/{}".format(Multihash(sha1hex=f["sha1"]).multihash58)
+        self._filesderived = True
 
     @classmethod
     def modifiedtorrent(cls, itemid, wantmodified=True, verbose=False):
@@ -288,6 +352,7 @@ class ArchiveItem(NameResolverDir):
         Pass metadata (i.e. what retrieved in AdvancedSearch) directly back to client
         This is based on assumption that if/when CORS issues are fixed then client will go direct to this API on archive.org
         """
+        self._setfilesderivedfields()   # Files in the response need magnetlink and contenthash
         if self._metadata.get("metadata", None): # isdark:true have no metadata
             # collection will always exist and be array - see _enforceMetadataContracts()
             self._metadata["collection_titles"] = {k: AdvancedSearch.collectiontitle(k, verbose) for k in self._metadata["metadata"]["collection"]}
@@ -326,51 +391,153 @@ class ArchiveItem(NameResolverDir):
         data = bencode.bencode(self.torrentdata)   # Set in ArchiveItem.new > setmagnetlink
         return {"Content-type": mimetype, "data": data} if headers else data
 
-    def leaf(self, headers=True, verbose=False):
+    @classmethod
+    def domainkeypair(cls):
         """
-        Resolve names to a Leaf (a pointer to a metadata record)
+        Return the KeyPair used to sign leafs, deriving it from the passphrase is slow so its only done once per process
+
+        :return: KeyPair
+        """
+        if not ArchiveItem._domainkeypair:  # Note uses ArchiveItem so shared across subclasses
+            ArchiveItem._domainkeypair = KeyPair({"key": {"passphrase": config["domains"]["metadatapassphrase"]}})
+        return ArchiveItem._domainkeypair
+
+    @staticmethod
+    def _metadatahash(metadata):
+        # Hash of the metadata, ignoring fields that archive.org changes on every request, used to detect if a leaf is unchanged
+        return hashlib.sha256(dumps({k: v for k, v in metadata.items() if k not in archiveconfig["leafvolatilefields"]}).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _leafcacheget(cls, itemid, metadatahash):
+        # Return the leaf (as JSON) cached for itemid if it was built from the same metadata, else None
+        with ArchiveItem._leafcachelock:
+            cached = ArchiveItem._leafcache.get(itemid)
+            if cached and cached[0] == metadatahash:
+                ArchiveItem._leafcache.move_to_end(itemid)
+                return cached[1]
+        return None
+
+    @classmethod
+    def _leafcacheset(cls, itemid, metadatahash, leaf):
+        with ArchiveItem._leafcachelock:
+            ArchiveItem._leafcache[itemid] = (metadatahash, leaf)
+            ArchiveItem._leafcache.move_to_end(itemid)
+            while len(ArchiveItem._leafcache) > cls.leafcachesize:
+                ArchiveItem._leafcache.popitem(last=False)    # Drop least recently used
+
+    def _leafnew(self, metadata, verbose=False):
+        """
+        Store metadata in IPFS and build an (unsigned) leaf pointing at it
 
-        :param headers:
-        :param verbose:
         :raises: IPFSException if cant reach IPFS
-        :return:
+        :return: leaf dict
         """
-        # TODO-DOMAIN - push metadata to IPFS, save IPFS hash
-        # TODO-DOMAIN - create Name record from IPFS hash & contenthash
-        # TODO-DOMAIN - store Name record on local nameservice (set)
-        # TODO-DOMAIN - return Name record to caller
-        metadata = self.metadata(headers=False, verbose=verbose)
         # Store in IPFS, note cant use urlstore on IPFS as metadata is mutable
         try:
             # Store on IPFS, dont ping gateway as will return a gateway url in the result so client can
             ipfsurl = TransportIPFS().store(data=metadata, verbose=verbose, mimetype="application/json", pinggateway=False)
         except Exception as e:
             raise IPFSException(message=e)
-        # TODO-DOMAIN probably encapsulate construction of name once all tested
-        metadataverifykey = config["domains"]["metadataverifykey"]
-        metadatapassphrase = config["domains"]["metadatapassphrase"]
-        leaf = {
+        return {
             # expires:   # Not needed, a later dated version is sufficient.
             "name": self.itemid,
             "signatures": [],
             "table": "leaf",
             "urls": [ipfsurl, config["gateway"]["url_metadata"]+self.itemid]  # Where to get the content
         }
+
+    @classmethod
+    def _leafsign(cls, leaf, verbose=False):
+        # Sign a leaf with the domain keypair, adds to its signatures and returns it
+        keypair = cls.domainkeypair()
         datenow = datetime.utcnow().isoformat()
         signable = dumps({"date": datenow, "signed": {k: leaf.get(k) for k in ["urls", "name", "expires"] if leaf.get(k)}})  # TODO-DOMAIN-DOC matches SignatureMixin.call in Domain.js
-        keypair = KeyPair({"key": {"passphrase": metadatapassphrase}})
-        signature = keypair.sign(signable, verbose=True)  # TODO-DOMAIN test then remove verbose=True
-        #signature = "FAKEFAKEFAKE"
+        signature = keypair.sign(signable, verbose=verbose)
         leaf["signatures"].append({"date": datenow, "signature": signature, "signedby": keypair.signingexport()})
-        # TODO-DOMAIN now have encapsulated leaf
+        return leaf
+
+    @classmethod
+    def _leafssave(cls, newleafs, verbose=False):
+        """
+        Sign new leafs and save them all to the domain table in a single append
+
+        :param newleafs: [ (itemid, metadatahash, leaf) ] as built by _leafnew
+        :return: { itemid: leaf as JSON }
+        """
+        signed = {itemid: dumps(cls._leafsign(leaf, verbose=verbose)) for (itemid, metadatahash, leaf) in newleafs}
         # Store the domain in the http domain server, its also always going to be retrievable from this gateway, we cant write to YJS, but a client can copy it TODO-DOMAIN
         # Next two lines would be if adding to HTTP on different machine, instead assuming this machine *is* the KeyValueTable we can go direct.
         # tableurl = "{}/get/table/{}/domains".format(server, pkeymetadatadomain)
         # TransportHTTP().set(tableurl, self.itemid, dumps(leaf), verbose)  # TODO-DOMAIN need to write TransportHTTP
-        KeyValueTable.new("table", metadataverifykey, "domain", verbose=verbose)\
-            .set(headers=False, verbose=verbose, data=[{"key": self.itemid, "value": dumps(leaf)}])
+        KeyValueTable.new("table", config["domains"]["metadataverifykey"], "domain", verbose=verbose)\
+            .set(headers=False, verbose=verbose, data=[{"key": itemid, "value": leaf} for itemid, leaf in signed.items()])
+        for (itemid, metadatahash, leaf) in newleafs:
+            cls._leafcacheset(itemid, metadatahash, signed[itemid])
+        return signed
+
+    def leaf(self, headers=True, verbose=False):
+        """
+        Resolve names to a Leaf (a pointer to a metadata record)
+        Leafs are cached by a hash of the metadata, so if the metadata is unchanged the leaf isnt stored, signed or saved again.
+
+        :param headers:
+        :param verbose:
+        :raises: IPFSException if cant reach IPFS
+        :return:
+        """
+        # TODO-DOMAIN - push metadata to IPFS, save IPFS hash
+        # TODO-DOMAIN - create Name record from IPFS hash & contenthash
+        # TODO-DOMAIN - store Name record on local nameservice (set)
+        # TODO-DOMAIN - return Name record to caller
+        metadata = self.metadata(headers=False, verbose=verbose)
+        metadatahash = self._metadatahash(metadata)
+        leaf = self._leafcacheget(self.itemid, metadatahash)
+        if not leaf:
+            leaf = self._leafssave([(self.itemid, metadatahash, self._leafnew(metadata, verbose=verbose))], verbose=verbose)[self.itemid]
+        elif verbose: logging.debug("Leaf for {} unchanged".format(self.itemid))
+        mimetype = 'application/json'
+        data = {self.itemid: leaf}
+        return {"Content-type": mimetype, "data": data} if headers else data
+
+    @classmethod
+    def leaves(cls, itemids, headers=True, verbose=False, **kwargs):
+        """
+        Resolve many items to Leafs in one call, see leaf()
+        Metadata is retrieved concurrently, then any new leafs are signed together and saved to the table in a single append.
+        Items that cant be found, or fail, are logged and left out of the result.
+
+        :param itemids: list of Archive item ids
+        :param headers:
+        :param verbose:
+        :return: { itemid: leaf as JSON } for each item found
+        """
+        def _fetch(itemid):  # Returns (itemid, metadatahash, leaf) where leaf is JSON if cached, or a new unsigned leaf dict
+            item = cls.new("archiveid", itemid, verbose=verbose)
+            metadata = item.metadata(headers=False, verbose=verbose)
+            metadatahash = cls._metadatahash(metadata)
+            return itemid, metadatahash, (cls._leafcacheget(itemid, metadatahash) or item._leafnew(metadata, verbose=verbose))
+
+        data = {}
+        newleafs = []
+        with ThreadPoolExecutor(max_workers=config["domains"]["leaf_concurrency"]) as executor:
+            futures = {executor.submit(_fetch, itemid): itemid for itemid in OrderedDict.fromkeys(itemids)}  # Ignore duplicates
+            for future in as_completed(futures):
+                try:
+                    itemid, metadatahash, leaf = future.result()
+                except ArchiveItemNotFound as e:
+                    logging.info("Leaf skipping {}".format(e))
+                    continue
+                except Exception as e:
+                    logging.error("Leaf failed for {} err={}".format(futures[future], e))
+                    continue
+                if isinstance(leaf, str):   # Cached and unchanged
+                    data[itemid] = leaf
+                else:
+                    newleafs.append((itemid, metadatahash, leaf))
+        if newleafs:
+            data.update(cls._leafssave(newleafs, verbose=verbose))
+        if verbose: logging.debug("Leaves found {} of {} items, {} new".format(len(data), len(itemids), len(newleafs)))
         mimetype = 'application/json'
-        data = {self.itemid: dumps(leaf)}
         return {"Content-type": mimetype, "data": data} if headers else data
 
     @classmethod
@@ -403,15 +570,31 @@ class ArchiveItem(NameResolverDir):
         (data, mimetype) = httpget("{}{}".format(config["archive"]["url_servicesimg"], self.itemid), wantmime=True)
         return {"Content-type": mimetype, "data": data} if headers else data
 
-    def cache_ipfs(self, forceurlstore=False, forceadd=False, verbose=False, announcedht=False, printlog=False):
+    def cache_ipfs(self, forceurlstore=False, forceadd=False, verbose=False, announcedht=False, printlog=False, stream=True, concurrency=None, skipcached=True):
         """
-        Loop over all files, pushing into IPFS
+        Loop over all files, pushing into IPFS, several files at a time
 
-        :param forceurlstore, forceadd, printlog, verbose:    See NameResolverFile.cache_ipfs for documentation
-        :return:                                    Doesnt return anything, but sets ipfs link on each file
+        :param forceurlstore, forceadd, printlog, stream, verbose:    See NameResolverFile.cache_ipfs for documentation
+        :param concurrency: Number of files ingested in parallel, default config["ipfs"]["ingest_concurrency"]
+        :param skipcached:  Dont push files IPLDHashService already knows about
+        :return:            Doesnt return anything, but sets ipfs link on each file, and prints one record per file
         """
-        for af in self._list: # TODO-PERMS must check here or prob in af.cache_ipfs before passing to IPF
-            af.cache_ipfs(url=af.archive_url, verbose=verbose, forceurlstore=forceurlstore, forceadd=forceadd, printlog=printlog, announcedht=announcedht, size=int(af._metadata.get("size","0")))
+        def _ingest(af):
+            if skipcached and af.multihash:
+                ipldhash = IPLDHashService.get(af.multihash.multihash58)
+                if ipldhash:
+                    af.printrecord(af.archive_url, "skip", ipldhash, af._metadata.get("size",""), False)
+                    return ipldhash
+            try:    # TODO-PERMS must check here or prob in af.cache_ipfs before passing to IPF
+                return af.cache_ipfs(url=af.archive_url, verbose=verbose, forceurlstore=forceurlstore, forceadd=forceadd, printlog=printlog,
+                                     announcedht=announcedht, size=int(af._metadata.get("size","0")), stream=stream)
+            except Exception as e:  # One bad file shouldnt stop the rest of the item
+                logging.error("cache_ipfs failed for {}: {}".format(af.archive_url, e))
+                af.printrecord(af.archive_url, "error", "", af._metadata.get("size",""), str(e).replace('"',"'"))
+                return None
+
+        with ThreadPoolExecutor(max_workers=concurrency or config["ipfs"]["ingest_concurrency"]) as executor:
+            list(executor.map(_ingest, self._list))
 
 # noinspection PyProtectedMember
 class ArchiveFile(NameResolverFile):
@@ -498,24 +681,39 @@ class ArchiveFile(NameResolverFile):
         # TODO this should really pass back a stream
 
     def inTorrent(self):
-        # TODO may be some specific files e.g. _meta.xml that should also return false
-        if (self.parent._metadata["metadata"].get("noarchivetorrent", None) == "true") or \
-            any([ self._metadata["name"].endswith(ending) for ending in config["torrent_reject_list"] ]) or \
-            any([coll in config["torrent_reject_collections"] for coll in self.parent._metadata["metadata"]["collection"]]):
-            return False
-        # The rule is a bit more complex, if any of the collctions an item is in are not open (don't start with open_) then can go to 250GB else 75GB)
-        if self.parent._metadata["item_size"] > 80530636800:
-            return False
-        # TODO Note this next line fails if mtime = "12345.0" as it does for some items see https://github.com/internetarchive/dweb-mirror/issues/212
-        if (not self._metadata.get("mtime")) or (self.parent.torrenttime() < int(self._metadata["mtime"])):
-            if self.parent.torrenttime(): # Only log the data inconsistency if the torrent exists
-                # Note known bug in Traceys code as of 13Nov2018 where doesnt update torrent when writing __ia_thumb.jpg TODO ask Tracey to fix
-                # Large torrents can be behind on updates
-                # If files count is large there is a bug with some part of the tools process Aaron let me know about, setting to 20k as a guess
-                if (self.parent._metadata["item_size"] < 80530636800) and (self.parent._metadata["files_count"] < 20000) and (self._metadata["name"] != "__ia_thumb.jpg"):
-                    logging.warning("Aaron believes all that torrents updated for files not in reject_list exception={}/{}".format(self.itemid, self._metadata["name"]));
-            return False
-        return True
+        return self.parent._itemintorrent() and self.parent._fileintorrent(self._metadata)
+
+class ArchiveFileList(Sequence):
+    """
+    The ArchiveFiles of an ArchiveItem (its _list), each ArchiveFile is only built from the item's files metadata when accessed,
+    so that requests that only need the item's metadata dont build an ArchiveFile for every file.
+    """
+
+    def __init__(self, item, namespace, transport=None, verbose=False):
+        self._item = item
+        self._namespace = namespace
+        self._transport = transport
+        self._verbose = verbose
+        self._files = item._metadata.get("files", [])   # isdark:dark and possibly other items have no .files field
+        self._built = {}    # { index: ArchiveFile } for those accessed so far
+
+    def __len__(self):
+        return len(self._files)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not (0 <= i < len(self)):
+            raise IndexError("ArchiveFileList index out of range")
+        af = self._built.get(i)
+        if af is None:
+            f = self._files[i]
+            af = ArchiveFile.new(self._namespace, self._item.itemid, f["name"], item=self._item, metadata=f,
+                                 transport=self._transport, verbose=self._verbose)
+            self._built[i] = af
+        return af
 
 class ArchiveFilePadding(ArchiveFile):
     # Catch special case of ".____padding_file/nnn" and deliver a range of 0 bytes.
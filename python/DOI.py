@@ -1,12 +1,22 @@
 import sqlite3
+import threading
+import time
+import os
+import re
+import unicodedata
 
 import logging
 import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from urllib.parse import urlparse, unquote
 
-from .HashStore import LocationService, MimetypeService, IPLDHashService
+from .HashStore import HashStore, LocationService, MimetypeService, IPLDHashService, StateService, DOIorgMetadataService
 from .Multihash import Multihash
 from .NameResolver import NameResolverDir, NameResolverFile, NameResolverSearchItem, NameResolverSearch
-from .miscutils import httpget
+from .miscutils import httpget, httpstream, dumps, loads, SqlitePool
+from .TransportIPFS import TransportIPFS
+from .config import config
 from .Errors import SearchException, NoContentException
 
 class DOI(NameResolverDir):
@@ -19,8 +29,8 @@ class DOI(NameResolverDir):
 
     Case insensitive, have some significant punctuation, but sometimes presented with insignificant punctuation
 
-    Future Work
-    * Build way to preload the hashstore with the hashes and URLs from the sqlite
+    The hashstore can be preloaded with the hashes and URLs from the sqlite by DOI.preload, otherwise
+    they are stored the first time each file is requested.
 
     TODO - ssome of this will end up in NameResolverDir as we build other classe and see commonalities
 
@@ -35,11 +45,23 @@ class DOI(NameResolverDir):
     CREATE INDEX files_metadata_sha1 on files_metadata (sha1);
     CREATE TABLE urls (sha1 char(40) not null, url text not null, datetime integer);
     CREATE INDEX url_sha1 on urls (sha1);
+    Covering indexes added by "python -m python.maintenance doiindexes" so that SQLJOINED can be answered from indexes alone
+    Column and index added by "python -m python.maintenance doinormalize" for lookup by DOI.normalize(doi)
+    ALTER TABLE files_id_doi ADD COLUMN doi_norm text;
+    CREATE INDEX files_id_doi_norm_sha1 on files_id_doi (doi_norm, sha1, doi);
+    CREATE INDEX files_id_doi_doi_sha1 on files_id_doi (doi, sha1);
+    CREATE INDEX files_metadata_covering on files_metadata (sha1, mimetype, size_bytes, md5);
+    CREATE INDEX urls_covering on urls (sha1, url, datetime);
     """
+    # One row per (file, url) with everything DOIfile._metadata needs, rows for one file are adjacent. Append the WHERE clause.
+    SQLJOINED = 'SELECT f.doi, f.sha1, m.mimetype, m.size_bytes, m.md5, u.url, u.datetime FROM files_id_doi f ' \
+                'LEFT JOIN files_metadata m ON m.sha1 = f.sha1 LEFT JOIN urls u ON u.sha1 = f.sha1 '
+    SQLJOINEDORDER = ' ORDER BY f.sha1, u.rowid;'
 
     # SQLITE="../data/idents_files_urls_sqlite"   # Old version in Python2 when working dir was "python"
     SQLITE = "data/idents_files_urls.sqlite"
-    #_sqliteconnection=None  #TODO-SQL should be per thread
+    _sqlitepools = {}   # { path: SqlitePool } of read-only connections
+    _sqlitepoolslock = threading.Lock()
 
     def __init__(self, namespace, publisher, *identifier, **kwargs):
         """
@@ -49,7 +71,8 @@ class DOI(NameResolverDir):
         :param publisher:   Publisher ID allocated by DOI.org, always of form 10.nnnn
         :param identifier:  Id for an academic article or resource, allocated by the publisher. Case insensitive, Alphanumeric plus a few (undefined) punctuation.
                             Its an array, because may be multiple fields seperated by /, can safely re-concatenate
-        :param kwargs:      Any other args to the URL, ignored for now.
+        :param kwargs:      Any other args to the URL, ignored for now, except
+                            rows:   Rows of SQLJOINED for this DOI if already queried (e.g. by batchmetadata)
         """
         #Note if you dont have your own way of using sqlite I suggest SqliteWrap from https://github.com/mitra42/sqlite_models
         """
@@ -65,32 +88,184 @@ class DOI(NameResolverDir):
         if verbose:
             logging.debug("DOI.__init__({0}, {1}, {2})".format(namespace, publisher, identifier))
         super(DOI, self).__init__(namespace, publisher, *identifier)
-        db = self.sqliteconnection(verbose)                     # Lazy connection to database
         self.doi = self.canonical(publisher, *identifier)    # "10.nnnn/xxxx/yyyy"
         self._metadata = {}
-        if verbose: logging.debug("DOI.__init__ looking up {0}".format(self.doi))
-        sha1_list = list(db.execute('SELECT * FROM files_id_doi WHERE doi = ?;', [self.doi]))
-
-        if verbose: logging.debug("DOI.__init__ iterating over {0} rows".format(len(sha1_list)))
-        for row in sha1_list:
-            _, sha1hex, _ = row
-            doifile = DOIfile(doi=self.doi, multihash=Multihash(sha1hex=sha1hex), verbose=verbose)
+        rows = kwargs.get("rows")
+        if rows is None:
+            if verbose: logging.debug("DOI.__init__ looking up {0}".format(self.doi))
+            doicolumn = self.doicolumn(verbose)
+            lowered = (publisher + "/" + "/".join(identifier)).lower()
+            with self.sqliteconnection(verbose) as db:
+                rows = db.execute(self.SQLJOINED + 'WHERE {} = ?'.format(doicolumn) + self.SQLJOINEDORDER, [self.doi]).fetchall()  # All files, metadata and urls at once
+                if not rows and doicolumn == "f.doi" and lowered != self.doi:   # Not yet migrated, match as before normalize
+                    rows = db.execute(self.SQLJOINED + 'WHERE f.doi = ?' + self.SQLJOINEDORDER, [lowered]).fetchall()
+        if rows:
+            self.doi = rows[0][0]   # As stored, may differ from self.doi in case or punctuation
+
+        if verbose: logging.debug("DOI.__init__ iterating over {0} rows".format(len(rows)))
+        for sha1hex, filerows in self.groupbysha1(rows).items():
+            doifile = DOIfile(doi=self.doi, multihash=Multihash(sha1hex=sha1hex), rows=filerows, verbose=verbose)
             self.push(doifile)
         if verbose: logging.debug("DOI.__init__ completing")
 
     @classmethod
-    def sqliteconnection(cls, verbose=False):
+    def batchmetadata(cls, dois, headers=True, verbose=False):
         """
-        # This below wont work in a multithreaded server, as sqlite connections cant be used across threads and doesnt appear
-        # to be a way to access thread variables.  #TODO-THREADING
-        if not cls._sqliteconnection:
-            if verbose: logging.debug("DOI.sqliteconnection connecting to DB")
-            cls._sqliteconnection = sqlite3.connect(cls.SQLITE)
-            if verbose: logging.debug("DOI.sqliteconnection connected to DB")
-        return cls._sqliteconnection
+        Resolve a list of DOIs, e.g. a reading list POSTed as a JSON array to /metadata/doi
+        The sqlite is queried a batch of DOIs at a time, then metadata (which needs doi.org) is built in parallel
+        and each DOI's result sent as soon as it is ready, with at most about a batch waiting on doi.org at once.
+
+        :param dois:    [ "10.pub/id" ]
+        :return:        NDJSON generator, one { doi, metadata } or { doi, error } per line in order of completion, for each
+                        different string in dois, with doi as it was sent so results can be matched up. Each DOI is
+                        only looked up once, however many ways it was written.
         """
-        # Using a new sqlite connection for each request
-        return sqlite3.connect(cls.SQLITE)
+        def _canonical(doi):
+            return cls.canonical(*doi.split('/'))
+
+        def _lines():
+            inputs = OrderedDict()  # { canonical: [ doi as sent ] } so each DOI is looked up once, however written
+            for d in dois:
+                if isinstance(d, str) and '/' in d:
+                    sent = inputs.setdefault(_canonical(d), [])
+                    if d not in sent:
+                        sent.append(d)
+                else:
+                    yield dumps({"doi": d, "error": "Not a DOI"}) + "\n"
+            doilist = list(inputs)
+            batchsize = config["doi"]["batch_query_size"]
+            doicolumn = cls.doicolumn(verbose)
+            lowered = {}    # { canonical: [ doi lowercased, as matched before normalize ] } for databases not yet migrated
+            if doicolumn == "f.doi":
+                for doi, sent in inputs.items():
+                    lowered[doi] = [ d.lower() for d in sent if d.lower() != doi ]
+            executor = ThreadPoolExecutor(max_workers=config["doi"]["metadata_concurrency"])
+            futures = {}    # { future: canonical doi } not yet sent
+            def _sent(future):
+                result = future.result()
+                return [ dumps(dict(result, doi=d)) + "\n" for d in inputs[futures.pop(future)] ]
+            try:
+                for i in range(0, len(doilist), batchsize):
+                    batch = doilist[i:i+batchsize]
+                    with cls.sqliteconnection(verbose) as db:
+                        rows = db.execute(cls.SQLJOINED + 'WHERE {} IN ({})'.format(doicolumn, ",".join("?"*len(batch))) + cls.SQLJOINEDORDER, batch).fetchall()
+                        rowsbydoi = {}
+                        for row in rows:
+                            rowsbydoi.setdefault(cls.normalize(row[0]), []).append(row)
+                        for doi in batch:
+                            if doi not in rowsbydoi and lowered.get(doi):
+                                rows = db.execute(cls.SQLJOINED + 'WHERE f.doi IN ({})'.format(",".join("?"*len(lowered[doi]))) + cls.SQLJOINEDORDER, lowered[doi]).fetchall()
+                                if rows:
+                                    rowsbydoi[doi] = rows
+                    for doi in batch:
+                        futures[executor.submit(cls._batchmetadataone, doi, rowsbydoi.get(doi, []), verbose)] = doi
+                    while futures:  # Send whatever is ready, and wait rather than have more than a batch outstanding
+                        done, _ = wait(futures, timeout=None if len(futures) >= batchsize else 0, return_when=FIRST_COMPLETED)
+                        if not done:
+                            break
+                        for future in done:
+                            yield from _sent(future)
+                for future in as_completed(list(futures)):
+                    yield from _sent(future)
+            finally:    # Including when the client has gone away, dont wait for doi.org lookups no one will see
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=False)
+
+        return {"Content-type": "application/x-ndjson", "data": _lines()} if headers else _lines()
+
+    @classmethod
+    def _batchmetadataone(cls, doi, rows, verbose=False):
+        try:
+            return {"doi": doi, "metadata": cls(None, *doi.split('/'), rows=rows, verbose=verbose).metadata(headers=False, verbose=verbose)}
+        except Exception as e:  # One bad DOI shouldnt lose the rest of the stream
+            logging.error("DOI.batchmetadata failed for {}: {}".format(doi, e))
+            return {"doi": doi, "error": str(e)}
+
+    @staticmethod
+    def groupbysha1(rows):
+        """
+        Split rows from SQLJOINED into the rows for each file
+
+        :param rows: [ (doi, sha1, mimetype, size_bytes, md5, url, datetime) ]
+        :return: { sha1hex: [ row* ] } in the order files were found
+        """
+        files = {}
+        for row in rows:
+            files.setdefault(row[1], []).append(row)
+        return files
+
+    @classmethod
+    def sqliteconnection(cls, verbose=False, path=None):
+        """
+        Check out a read-only connection to the sqlite database from a pool of up to config["doi"]["sqlite_pool_size"],
+        each connection is opened once so the schema is parsed once and statements stay prepared
+        (sqlite3 caches up to config["doi"]["sqlite_cached_statements"] per connection).
+        Use like:  with DOI.sqliteconnection(verbose) as db: rows = db.execute(...).fetchall()
+        Fetch the rows inside the with, the connection goes back to the pool after it.
+
+        :param path:    Database, default SQLITE, the search index uses this too
+        :return: context manager giving a sqlite3.Connection
+        """
+        path = path or cls.SQLITE
+        with DOI._sqlitepoolslock:
+            pool = DOI._sqlitepools.get(path)
+            if pool is None:
+                def _connect():
+                    if verbose: logging.debug("DOI.sqliteconnection connecting to {}".format(path))
+                    db = sqlite3.connect("file:{}?mode=ro".format(path), uri=True, check_same_thread=False,
+                                         cached_statements=config["doi"]["sqlite_cached_statements"])
+                    db.execute("PRAGMA query_only = ON;")
+                    db.execute("PRAGMA mmap_size = {:d};".format(config["doi"]["sqlite_mmap_size"]))
+                    db.execute("PRAGMA cache_size = -{:d};".format(config["doi"]["sqlite_cache_kb"]))  # Negative is in KiB rather than pages
+                    return db
+                pool = DOI._sqlitepools[path] = SqlitePool(_connect, config["doi"]["sqlite_pool_size"])
+        return pool.connection()
+
+    @classmethod
+    def preload(cls, batchsize=None, resume=True, verbose=False):
+        """
+        Write location and mimetype for every file in the sqlite into the HashStore, in sha1 order, so first requests dont
+        have to wait for sqlite_metadata. Progress is saved after each batch in StateService LastDOIpreload so an interrupted
+        run picks up where it stopped.
+
+        :param batchsize:   Files per pipelined Redis write, default config["doi"]["preload_batch"]
+        :param resume:      If False start from the first sha1 again
+        :return:            Number of files loaded by this run
+        """
+        batchsize = int(batchsize or config["doi"]["preload_batch"])
+        last = (resume and StateService.get("LastDOIpreload", verbose)) or ""
+        logging.info("DOI.preload starting after sha1={}".format(last or "(start)"))
+        loaded = 0
+        batch = []
+        files = 0
+        started = time.time()
+        sha1hex = None
+        with cls.sqliteconnection(verbose) as db:     # Held for the whole scan, the cursor reads as it goes
+            rows = db.execute(cls.SQLJOINED + 'WHERE f.sha1 > ?' + cls.SQLJOINEDORDER, [last])
+            for _, rowsha1, mimetype, _, _, url, datetime in rows:
+                if rowsha1 == sha1hex:
+                    continue    # Only the first url is used as the location, as in sqlite_metadata
+                if files >= batchsize:  # Only break between files, so resuming from sha1hex is exact
+                    HashStore.hash_setmany(batch, verbose=verbose)
+                    StateService.set("LastDOIpreload", sha1hex, verbose)
+                    loaded += files
+                    logging.info("DOI.preload {} files loaded, {:.0f}/s, at sha1={}".format(loaded, loaded/max(time.time()-started, 0.001), sha1hex))
+                    batch = []
+                    files = 0
+                sha1hex = rowsha1
+                files += 1
+                multihash58 = Multihash(sha1hex=sha1hex).multihash58
+                if url:
+                    batch.append((multihash58, LocationService.redisfield, cls.archive_url((sha1hex, url, datetime))))
+                if mimetype:
+                    batch.append((multihash58, MimetypeService.redisfield, mimetype))
+        if files:
+            HashStore.hash_setmany(batch, verbose=verbose)
+            StateService.set("LastDOIpreload", sha1hex, verbose)
+            loaded += files
+        logging.info("DOI.preload complete, {} files loaded in {:.0f}s".format(loaded, time.time()-started))
+        return loaded
 
     @staticmethod
     def archive_url(row):
@@ -136,9 +311,46 @@ class DOI(NameResolverDir):
         Brian says its a long-tail, the vast majority of correct DOI appear to be case insensitive alphanumeric with some allowed punctuation
         This will require lookin in the Sqlite (or asking Brian) to determine suitable characters for a OK DOI
         """
-        #TODO convert this identifier into a canonicised form,
-        #TDO check publisher is canonicised 10.nnnn
-        return publisher.lower() + "/" + "/".join([i.lower() for i in identifier])
+        return cls.normalize(publisher + "/" + "/".join(identifier))
+
+    DOIPREFIXES = re.compile(r"^(doi:|https?://(dx\.)?doi\.org/)", re.IGNORECASE)
+    DASHES = re.compile("[\u2010\u2011\u2012\u2013\u2014\u2015\u2212\ufe63\uff0d]")
+    IGNORABLE = re.compile("[\\s\u200b\u200c\u200d\u2060\ufeff]")
+
+    @classmethod
+    def normalize(cls, doi):
+        """
+        Reduce the ways a DOI gets written to one form, used both to build the doi_norm column (see maintenance doinormalize) and to look up.
+        URL-decoded, Unicode NFC, "doi:" or doi.org prefixes removed, dashes unified, whitespace and zero-width characters
+        removed, trailing sentence punctuation (and unbalanced closing brackets) removed, lowercase.
+
+        :param doi: e.g. "https://doi.org/10.1001/JAMA.2009.1064."
+        :return:    e.g. "10.1001/jama.2009.1064"
+        """
+        doi = unicodedata.normalize("NFC", unquote(doi)).strip()
+        doi = cls.DOIPREFIXES.sub("", doi)
+        doi = cls.IGNORABLE.sub("", cls.DASHES.sub("-", doi))
+        while doi:
+            if doi[-1] in ".,;:'\"":
+                doi = doi[:-1]
+            elif doi[-1] in ")]}" and doi.count(doi[-1]) > doi.count({")": "(", "]": "[", "}": "{"}[doi[-1]]):
+                doi = doi[:-1]
+            else:
+                break
+        return doi.lower()
+
+    _doicolumns = {}    # { path: column } so normalized lookups work before and after the doi_norm migration
+
+    @classmethod
+    def doicolumn(cls, verbose=False):
+        """
+        :return: "f.doi_norm" if the database has been migrated by maintenance doinormalize, else "f.doi"
+        """
+        if cls.SQLITE not in cls._doicolumns:
+            with cls.sqliteconnection(verbose) as db:
+                columns = [ row[1] for row in db.execute("PRAGMA table_info(files_id_doi);") ]
+            cls._doicolumns[cls.SQLITE] = "f.doi_norm" if "doi_norm" in columns else "f.doi"
+        return cls._doicolumns[cls.SQLITE]
 
     def check_if_link_works(self, url, verbose=False):
         """
@@ -155,23 +367,43 @@ class DOI(NameResolverDir):
         if verbose: logging.debug("result={0}".format(request.status_code))
         return request.status_code == 200
 
-    @staticmethod
-    def get_doi_metadata(doi, verbose=False):
+    _hostsemaphores = {}    # { host: BoundedSemaphore } limits how many requests we have outstanding to each metadata server
+    _hostsemaphoreslock = threading.Lock()
+
+    @classmethod
+    def hostsemaphore(cls, url):
+        host = urlparse(url).netloc
+        with cls._hostsemaphoreslock:
+            if host not in cls._hostsemaphores:
+                cls._hostsemaphores[host] = threading.BoundedSemaphore(config["doi"]["metadata_concurrency"])
+            return cls._hostsemaphores[host]
+
+    @classmethod
+    def get_doi_metadata(cls, doi, verbose=False):
         """
-        For a DOI, get metadata from doi.org about that file
+        For a DOI, get metadata from doi.org about that file, cached in DOIorgMetadataService
         #TODO - move this to browser - but having problems with CBOR
-        :return: metadata on the doi in json format
+        :return: metadata on the doi in json format, or None if doi.org doesnt have it
         """
-        url = "http://dx.doi.org/" + doi
+        cached = DOIorgMetadataService.get(doi, verbose)
+        if cached is not None:
+            return cached or None   # {} is a cached failure
+        url = config["doi"]["url_metadata"] + doi
         headers = {"accept": "application/vnd.citationstyles.csl+json"}
-        r = requests.get(url, headers=headers)  # Note that with headers it wont redirect, without it will go to doc which may fail
-        if verbose: logging.debug("get_doi_metadata returned: {0}".format(r))
-        if r.status_code == 200:
-            return r.json()
-        else:
-            logging.warning("Failed to read metadata at {0}".format(url))
-            return None
+        try:
+            with cls.hostsemaphore(url):
+                r = requests.get(url, headers=headers, timeout=config["doi"]["metadata_timeout"])  # Note that with headers it wont redirect, without it will go to doc which may fail
+            if verbose: logging.debug("get_doi_metadata returned: {0}".format(r))
+            if r.status_code == 200:
+                res = r.json()
+                DOIorgMetadataService.set(doi, res, verbose, expire=config["doi"]["metadata_ttl"])
+                return res
+            logging.warning("Failed to read metadata at {0} status={1}".format(url, r.status_code))
+        except (requests.exceptions.RequestException, ValueError) as e:  # ValueError if its not JSON
+            logging.warning("Failed to read metadata at {0} {1}".format(url, e))
         # If dont get metadata, the rest of our info may still be valid
+        DOIorgMetadataService.set(doi, {}, verbose, expire=config["doi"]["metadata_negative_ttl"])
+        return None
 
     def doi_org_metadata(self, verbose=False):
         """
@@ -196,13 +428,14 @@ class DOIfile(NameResolverFile):    # Note plural
 
     """
 
-    def __init__(self, doi=None, multihash=None, metadata=None, verbose=False):
+    def __init__(self, doi=None, multihash=None, metadata=None, rows=None, verbose=False):
         """
         Initilize a new DOIfile, usually called from new()
 
         :param doi:
         :param multihash:
         :param metadata:
+        :param rows:    Rows of DOI.SQLJOINED for this file if already queried (e.g. by DOI.__init__), saves going back to sqlite
         :param verbose:
         :raises NoContentException: if no DOI and cant find sha1 in index
         """
@@ -210,44 +443,72 @@ class DOIfile(NameResolverFile):    # Note plural
         self.doi = doi
         self._metadata = metadata or {}    # For now all in one dict
         self.multihash = multihash
-        if multihash and not self.doi:
-            # Lookup DOI from sha1hex if DOI not supplied.
+        if multihash and not rows:
+            # One query gets DOI (if not supplied), metadata and urls
             if verbose: logging.debug("DOIfile.__init__ looking up {0}".format(multihash.sha1hex))
-            l = list(DOI.sqliteconnection(verbose).execute('SELECT * FROM files_id_doi WHERE sha1 = ?;', [multihash.sha1hex]))
-            if not l:
+            with DOI.sqliteconnection(verbose) as db:
+                rows = db.execute(DOI.SQLJOINED + 'WHERE f.sha1 = ?' + DOI.SQLJOINEDORDER, [multihash.sha1hex]).fetchall()
+            if not rows:
                 raise NoContentException    # If cant find a doi, no point continuing
-            self.doi, _, _ = l[0]
+        if rows and not self.doi:
+            self.doi = rows[0][0]
         if multihash:
-            self.sqlite_metadata(verbose)
+            self.sqlite_metadata(verbose, rows=rows)
 
-    def sqlite_metadata(self, verbose):
-            files_metadata_list = list(DOI.sqliteconnection(verbose).execute('SELECT * FROM files_metadata WHERE sha1 = ?;', [self.multihash.sha1hex]))
-            _, mimetype, size_bytes, md5 = files_metadata_list[0]
-            files_list = list(DOI.sqliteconnection(verbose).execute('SELECT * FROM urls WHERE sha1 = ?;', [self.multihash.sha1hex]))
+    def sqlite_metadata(self, verbose, rows=None):
+            if not rows:
+                with DOI.sqliteconnection(verbose) as db:
+                    rows = db.execute(DOI.SQLJOINED + 'WHERE f.sha1 = ?' + DOI.SQLJOINEDORDER, [self.multihash.sha1hex]).fetchall()
+            _, _, mimetype, size_bytes, md5, _, _ = rows[0]
             self._metadata = {'mimetype': mimetype, 'size_bytes': size_bytes, 'md5': md5, 'multihash58': self.multihash.multihash58,
-                              'files': [DOI.archive_url(file) for file in files_list]}
+                              'files': list(dict.fromkeys(DOI.archive_url((sha1, url, datetime)) for _, sha1, _, _, _, url, datetime in rows if url))}  # Each url once, though rows repeat per DOI sharing the file
             if verbose: logging.debug("multihash base58={0}".format(self.multihash.multihash58))
             #multihash58_sha256 = Multihash(data=doifile.retrieve(), code=SHA256)
             #logging.debug("Saving location "+ multihash58_sha256+":"+doifile._metadata["urls"][0]  )
             LocationService.set(self.multihash.multihash58, self._metadata["files"][0], verbose=verbose)
             MimetypeService.set(self.multihash.multihash58, self._metadata["mimetype"], verbose=verbose)
             ipldhash = IPLDHashService.get(self.multihash.multihash58)    # May be None, we don't know it
-            if not ipldhash:
-                data = httpget(self._metadata["files"][0])
-                #TODO move this to a URL or better to TransportIPFS when built
-                #ipfsurl = "https://ipfs.dweb.me/api/v0/add"  # note Kyle was using localhost:5001/api/v0/add which wont resolve externally.
-                ipfsurl = "http://localhost:5001/api/v0/add"  # note Kyle was using localhost:5001/api/v0/add which wont resolve externally.
-                if verbose: logging.debug("Fetching IPFS from {0}".format(ipfsurl))
-                #Debugging - running into problems with 404, not sure if laptop/HTTPS issue or server
-                #ipldresp = requests.post(ipfsurl, files={'file': ('', data, self.metadata["mimetype"])})
-                #ipldhash = ipldresp.json()['Hash']
-                res = requests.post(ipfsurl, files={'file': ('', data, self._metadata["mimetype"])}).json()
-                logging.debug("IPFS result={}".format(res))
-                ipldhash = res['Hash']
-                IPLDHashService.set(self.multihash.multihash58, ipldhash)
             self._metadata["ipldhash"] = ipldhash
+            self._metadata["ipfsstatus"] = "cached" if ipldhash else self.ipfs_ingest(verbose=verbose)
             if verbose: logging.debug("sqlite_metadata done")
 
+    _ipfsexecutor = None    # Background threads pushing DOI files to IPFS, created on first use
+    _ipfspending = set()    # multihash58 of files queued or being pushed, so each is only pushed once
+    _ipfslock = threading.Lock()
+
+    def ipfs_ingest(self, verbose=False):
+        """
+        Queue this file to be streamed from its first url into IPFS, returns without waiting.
+        The ipldhash is in IPLDHashService once done, so a later request for the file will find it.
+
+        :return: "pending" (queued, or already queued by another request) or "nourl"
+        """
+        if not self._metadata.get("files"):
+            return "nourl"
+        multihash58 = self.multihash.multihash58
+        with DOIfile._ipfslock:
+            if multihash58 in DOIfile._ipfspending:
+                return "pending"
+            DOIfile._ipfspending.add(multihash58)
+            if not DOIfile._ipfsexecutor:
+                DOIfile._ipfsexecutor = ThreadPoolExecutor(max_workers=config["doi"]["ipfs_concurrency"])
+        DOIfile._ipfsexecutor.submit(self._ipfs_ingest, self._metadata["files"][0], self._metadata["mimetype"], verbose)
+        return "pending"
+
+    def _ipfs_ingest(self, url, mimetype, verbose=False):
+        multihash58 = self.multihash.multihash58
+        try:
+            if not IPLDHashService.get(multihash58):    # Could have been done since queued
+                (chunks, _) = httpstream(url, chunksize=config["ipfs"]["stream_chunksize"])
+                ipldurl = TransportIPFS().rawstorestream(chunks, mimetype=mimetype, pinggateway=False, verbose=verbose)
+                IPLDHashService.set(multihash58, urlparse(ipldurl).path.split('/')[2])
+                if verbose: logging.debug("DOIfile pushed {} to {}".format(url, ipldurl))
+        except Exception as e:  # Background thread, nowhere to report it to except the log, will be retried on next request
+            logging.error("DOIfile failed to push {} to IPFS: {}".format(url, e))
+        finally:
+            with DOIfile._ipfslock:
+                DOIfile._ipfspending.discard(multihash58)
+
     @property
     def url(self):
         """
@@ -299,10 +560,9 @@ class DOIfile(NameResolverFile):    # Note plural
         return self._doi_org_metadata
 
 class DOIsearchItem(NameResolverSearchItem):
-    # NOTE THESE ARE STUBS UNTESTED AND DONT WORK YET
 
     def __init__(self, result=None):
-        super(DOIsearchItem, self).__init__()
+        super(DOIsearchItem, self).__init__(None)
         if result: # Its a DOI search result
             # Ensure 'authors' is a list, not a single string
             if type(result['authors']) is not list:
@@ -315,51 +575,121 @@ class DOIsearchItem(NameResolverSearchItem):
         # Will match elastic_schema.json  which is doi, title, author, journal, date, publisher, topic, media
 
 class DOIsearch(NameResolverSearch):
-    # NOTE THESE ARE STUBS UNTESTED AND DONT WORK YET
-    #TODO-SEARCH add search of scholar.archivelab.org?q=harvard or direct to elasticsearch.openjournal.foundation - this is Bryan's
+    """
+    Search of the DOI corpus, using an sqlite FTS5 index built by DOIsearch.build (python3 -m python.maintenance doisearchindex)
+    URL: /metadata/search/<query>?limit=20&highlight=true
+    Query syntax is FTS5's: words, "phrases", AND OR NOT, prefix*, and column filters like title:foo or author:smith
+
+    The index is opened read-only by a pool of connections, restart the server after rebuilding it.
+    """
+    SEARCHINDEX = "data/doi_search.sqlite"
+    FIELDS = ["doi", "title", "authors", "journal", "date", "publisher", "topic", "media"]  # As in elastic_schema.json
+    HIGHLIGHTFIELDS = ["title", "authors", "journal"]
+    # FTS5 bm25 weights in order of FIELDS, boosts as in elastic_schema.json
+    RANK = "bm25(works, 0.0, 3.0, 2.0, 1.0, 0.0, 0.5, 0.5, 0.0)"
 
     @classmethod
-    def search(self, querystring, limit=20, do_highlight=False):
+    def search(cls, querystring, limit=20, do_highlight=False, verbose=False):
         """
         Use like  /metadata/search/
         :param querystring:
         :param limit:
         :param do_highlight:
-        :return:
+        :return: { hits: { total: n, hits: [ { doi, title, authors:[], ..., highlight: { field: [ snippet ] } } ] } } as was returned by elasticsearch
+        :raises SearchException: if the index isnt there or the query cant be parsed even as plain words
         """
         logging.debug("Search hit: {0}".format(querystring))
-
         querystring = querystring.replace("author:", "authors:")  # Replace author: with authors: in query
+        try:
+            with DOI.sqliteconnection(verbose, path=cls.SEARCHINDEX) as db:
+                try:
+                    return cls._search(db, querystring, limit, do_highlight)
+                except sqlite3.OperationalError as e:   # Usually FTS5 syntax error, search for the words instead
+                    if verbose: logging.debug("DOIsearch retrying as plain words after {}".format(e))
+                    words = [w for w in re.findall(r"\w+", querystring) if w not in ("AND", "OR", "NOT", "NEAR")]
+                    return cls._search(db, " ".join('"{}"'.format(w) for w in words), limit, do_highlight)
+        except sqlite3.Error as e:
+            logging.error("DOIsearch failed: {}".format(e))
+            raise SearchException(search=querystring)
 
-
-        search_request = {
-            "query": {
-                "query_string": {
-                    "query": querystring,
-                    "analyzer": "snowball",
-                    "default_operator": "AND",
-                    "analyze_wildcard": True,
-                },
-            },
-            "size": limit,
-        }
+    @classmethod
+    def _search(cls, db, match, limit, do_highlight):
+        columns = ", ".join(cls.FIELDS)
         if do_highlight:
-            search_request['highlight'] = {
-                "pre_tags": ["<mark>"],
-                "post_tags": ["</mark>"],
-                "fields": {"_all": {}},
-            }
-        url = "http://localhost:9200/crossref-works/_search"  # Might parameterise part of this, but unlikely
-        resp = requests.post(url, json=search_request)
-        if resp.status_code != 200:
-            raise SearchException(search="search_request")  # TODO-SEARCH extract useful part of search_request
-        return resp.json()
-
-    def __init__(self, namespace, querystring, limit=20, do_highlight=False, verbose=False):
-        super(DOIsearch,self).__init__(namespace, querystring, verbose=verbose)
+            columns += "".join(", highlight(works, {}, '<mark>', '</mark>')".format(cls.FIELDS.index(f)) for f in cls.HIGHLIGHTFIELDS)
+        hits = []
+        for row in db.execute("SELECT {} FROM works WHERE works MATCH ? ORDER BY {} LIMIT ?;".format(columns, cls.RANK), [match, limit]):
+            hit = dict(zip(cls.FIELDS, row))
+            hit["authors"] = hit["authors"].split("; ") if hit["authors"] else []
+            if do_highlight:
+                hit["highlight"] = { f: [h] for f, h in zip(cls.HIGHLIGHTFIELDS, row[len(cls.FIELDS):]) if h and "<mark>" in h }
+            hits.append(hit)
+        total = len(hits) if len(hits) < limit else db.execute("SELECT count(*) FROM works WHERE works MATCH ?;", [match]).fetchone()[0]
+        return {"hits": {"total": total, "hits": hits}}
+
+    @classmethod
+    def build(cls, source, indexfile=None, batchsize=10000, verbose=False):
+        """
+        Build the search index from NDJSON, one work per line with any of FIELDS (crossref style lists are joined),
+        streaming so the source can be bigger than memory. Builds beside the index and renames, so searches keep working.
+
+        :param source:      iterable of lines e.g. open file or sys.stdin
+        :param indexfile:   default SEARCHINDEX
+        :return:            number of works indexed
+        """
+        indexfile = indexfile or cls.SEARCHINDEX
+        tmpfile = indexfile + ".tmp"
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        db = sqlite3.connect(tmpfile)
+        db.execute("PRAGMA journal_mode = OFF;")
+        db.execute("PRAGMA synchronous = OFF;")
+        db.execute("CREATE VIRTUAL TABLE works USING fts5({}, tokenize = 'porter unicode61 remove_diacritics 2');"
+                   .format(", ".join(f + ("" if f in ("title", "authors", "journal", "publisher", "topic") else " UNINDEXED") for f in cls.FIELDS)))
+
+        def _value(v):
+            if isinstance(v, list):
+                return "; ".join(_value(i) for i in v)
+            if isinstance(v, dict):     # e.g. crossref author { given, family }
+                return " ".join(str(v[k]) for k in ("given", "family", "name") if v.get(k))
+            return "" if v is None else str(v)
+
+        count = 0
+        batch = []
+        insert = "INSERT INTO works ({}) VALUES ({});".format(", ".join(cls.FIELDS), ", ".join("?"*len(cls.FIELDS)))
+        for line in source:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                work = loads(line)
+            except ValueError as e:
+                logging.warning("DOIsearch.build skipping bad line: {}".format(e))
+                continue
+            work.setdefault("authors", work.get("author"))
+            batch.append([_value(work.get(f)) for f in cls.FIELDS])
+            if len(batch) >= batchsize:
+                db.executemany(insert, batch)
+                count += len(batch)
+                batch = []
+                if verbose: logging.debug("DOIsearch.build {} works".format(count))
+        db.executemany(insert, batch)
+        count += len(batch)
+        db.execute("INSERT INTO works(works) VALUES('optimize');")
+        db.commit()
+        db.close()
+        os.replace(tmpfile, indexfile)
+        logging.info("DOIsearch.build indexed {} works into {}".format(count, indexfile))
+        return count
+
+    def __init__(self, namespace, *querystring, limit=20, do_highlight=False, verbose=False, **kwargs):
+        super(DOIsearch,self).__init__(namespace, *querystring, verbose=verbose)
+        querystring = "/".join(querystring) or kwargs.get("q", "")
+        do_highlight = do_highlight or kwargs.get("highlight")
+        do_highlight = do_highlight if isinstance(do_highlight, bool) else str(do_highlight).lower() in ("true", "1", "yes")
         results = self.search(querystring,
                                 do_highlight=do_highlight,
-                                limit=min(max(0, int(limit)), 100))
+                                limit=min(max(0, int(limit)), 100), verbose=verbose)
         self._list = [  DOIsearchItem(result=h) for h in results['hits']['hits'] ]
         self.count_found = results['hits']['total']
         self.count_returned = len(self._list)
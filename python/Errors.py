@@ -103,6 +103,10 @@ class TransportFileNotFound(MyBaseException):
     httperror = 404
     msg = "file {file} not found"
 
+class TransportCursorException(MyBaseException):
+    httperror = 400
+    msg = "after={after} is not the start of a record in {file}, it may have been compacted, start again from 0"
+
 """
 
 # Following are currently obsolete - not being used in Python or JS
@@ -19,8 +19,8 @@ class HashResolver(NameResolverFile):
 
     Implements name resolution of the ContentHash namespace, via a local store and any other internal archive method
 
-    Future Work
-    * Build way to preload the hashstore with the hashes and URLs from various parts of the Archive
+    The hashstore can be preloaded from the DOI sqlite with DOI.preload (python3 -m python.maintenance doipreload),
+    other parts of the Archive are still only loaded as they are requested.
     """
     namespace = None       # Defined in subclasses
     multihashfield = None  # Defined in subclasses
@@ -23,12 +23,16 @@ class HashStore(object):
     redis()             Initiate connection to redis or return already open one.
 
     Instance methods:
-    hash_set(multihash, field, value, verbose=False)    Set Redis.multihash.field to value
+    hash_set(multihash, field, value, verbose=False, expire=None)    Set Redis.multihash.field to value, optionally expiring
+    hash_setmany(triples, verbose=False)                Set many (multihash, field, value) in one pipelined round trip
     hash_get(multihash, field, verbose=False)           Retrieve value of Redis.multihash.field
     set(multihash, value, verbose=False)                Set Redis.multihash.<redisfield> = value
     get(multihash, value, verbose=False)                Retrieve Redis.multihash.<redisfield>
 
-    Delete and Push are not supported but could be if required.
+    hash_delete(multihash, field, verbose=False)        Remove Redis.multihash.field
+    delete(multihash, verbose=False)                    Remove Redis.multihash.<redisfield>
+
+    Push is not supported but could be if required.
 
     Subclasses map
 
@@ -38,6 +42,7 @@ class HashStore(object):
     Class               StoredAt                        Maps        To
     StateService        __STATE__.<field>               field       arbitraryvalue    For global state
     StateService        __STATE__.LastDHTround          number?     Used by cron_ipfs.py to track whats up next
+    StateService        __STATE__.LastDOIpreload        sha1hex     Used by DOI.preload to resume
     LocationService     <contenthash>.location          url         As returned by rawstore or url of content on IA
     MimetypeService     <contenthash>.mimetype          mimetype
     IPLDService         Not used currently
@@ -46,6 +51,7 @@ class HashStore(object):
     MagnetLinkService   bits:<b32hash>.magnetlink       magnetlink
     MagnetLinkService   archived:<itemid>.magnetlink    magnetlink
     TitleService        archived:<itemid>.title         title       Used to map collection item’s to their titles (cache search query)
+    DOIorgMetadataService doi:<doi>.doiorgmetadata      json        CSL metadata from doi.org, {} if doi.org failed, expires
     """
 
     _redis = None   # Will be connected to a redis instance by redis()
@@ -67,15 +73,36 @@ class HashStore(object):
         raise CodingException(message="It is meaningless to instantiate an instance of HashStore, its all class methods")
 
     @classmethod
-    def hash_set(cls, multihash, field, value, verbose=False):
+    def hash_set(cls, multihash, field, value, verbose=False, expire=None):
         """
         :param multihash:
         :param field:
         :param value:
+        :param expire:  Seconds until the whole of Redis.multihash expires, only use on keys holding a single field
         :return:
         """
         if verbose: logging.debug("Hash set: {0} {1}={2}".format(multihash, field, value))
-        cls.redis().hset(multihash, field, value)
+        if expire:
+            cls.redis().pipeline(transaction=False).hset(multihash, field, value).expire(multihash, int(expire)).execute()
+        else:
+            cls.redis().hset(multihash, field, value)
+
+    @classmethod
+    def hash_setmany(cls, triples, verbose=False):
+        """
+        Set many fields in one round trip to Redis, for bulk loading
+
+        :param triples: iterable of (multihash, field, value)
+        :return:        number of fields set
+        """
+        pipe = cls.redis().pipeline(transaction=False)
+        count = 0
+        for multihash, field, value in triples:
+            pipe.hset(multihash, field, value)
+            count += 1
+        pipe.execute()
+        if verbose: logging.debug("Hash set {} fields".format(count))
+        return count
 
     @classmethod
     def hash_get(cls, multihash, field, verbose=False):
@@ -89,6 +116,16 @@ class HashStore(object):
         if verbose: logging.debug("Hash found: {0} {1}={2}".format(multihash, field, res))
         return res
 
+    @classmethod
+    def hash_delete(cls, multihash, field, verbose=False):
+        """
+        :param multihash:
+        :param field:
+        :return: True if there was a field to delete
+        """
+        if verbose: logging.debug("Hash delete: {0} {1}".format(multihash, field))
+        return bool(cls.redis().hdel(multihash, field))
+
     @classmethod
     def set(cls, multihash, value, verbose=False):
         """
@@ -108,6 +145,14 @@ class HashStore(object):
         """
         return cls.hash_get(multihash, cls.redisfield, verbose)
 
+    @classmethod
+    def delete(cls, multihash, verbose=False):
+        """
+
+        :param multihash:
+        :return: True if there was something to delete
+        """
+        return cls.hash_delete(multihash, cls.redisfield, verbose)
 
     @classmethod
     def archiveidget(cls, itemid, verbose=False):
@@ -198,3 +243,19 @@ class TitleService(HashStore):
     # uses archiveidset/get
     # TODO-REDIS note this is caching for ever, which is generally a bad idea ! Should figure out how to make Redis expire this cache every few days
     redisfield = "title"
+
+class DOIorgMetadataService(HashStore):
+    # Cache CSL-JSON metadata from doi.org, its expensive to get and rarely changes, failures are cached (as {}) for less time
+    redisfield = "doiorgmetadata"
+
+    @classmethod
+    def set(cls, doi, value, verbose=False, expire=None):
+        return cls.hash_set("doi:"+doi, cls.redisfield, dumps(value), verbose, expire=expire)
+
+    @classmethod
+    def get(cls, doi, verbose=False):
+        """
+        :return: dict, {} if doi.org failed recently, None if not cached
+        """
+        res = cls.hash_get("doi:"+doi, cls.redisfield, verbose)
+        return None if res is None else loads(res)
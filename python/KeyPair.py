@@ -470,12 +470,13 @@ class KeyPair(SmartDict):   # Note this include is a partial implementation of S
     ABOVE HERE NOT YET BACKPORTED FROM JS
     """
 
-    def sign(self, signable, verbose=False):
+    def sign(self, signable, verbose=False, verify=False):
         """
         Sign and date a url using public key function.
         Pair of "verify()"
 
         :param signable: A signable string
+        :param verify:   True to immediately verify the signature - useful if seeing problems verifying things that should verify ok
         :return: signature that can be verified with verify
         #Backported from JS 20180703
         """
@@ -483,8 +484,8 @@ class KeyPair(SmartDict):   # Note this include is a partial implementation of S
         assert self._key["sign"]._signing_key    # Needs private key to sign
         # Note pattern slightly different form JS because NaCl wants "bytes" and we use/need utf8 strings.
         sig = self._key["sign"].sign(signable if isinstance(signable, bytes) else bytes(signable, 'utf8'), nacl.encoding.URLSafeBase64Encoder).signature.decode('utf8')
-        # Can uncommen next line if seeing problems veriying things that should verify ok - tests immediate verification
-        self.verify(signable, sig)
+        if verify:
+            self.verify(signable, sig)
         return sig
 
 
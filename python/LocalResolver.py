@@ -5,6 +5,7 @@ from .HashStore import LocationService
 from .Multihash import Multihash
 from .miscutils import loads, dumps
 from .Errors import TransportFileNotFound
+from .config import config
 
 #TODO add caching to headers returned so not repeatedly pinged for same file
 
@@ -28,8 +29,8 @@ class LocalResolver(NameResolverFile):
 
     @staticmethod
     def transport(verbose=False):
-        return TransportLocal(options={"local": {"dir": ".cache"}},
-                       verbose=verbose)  # TODO-LOCAL move to options at higher level
+        return TransportLocal(options={"local": {"dir": config["local"]["dir"]}},
+                       verbose=verbose)
 
 class LocalResolverStore(LocalResolver):
 
@@ -60,19 +61,34 @@ class LocalResolverFetch(LocalResolver):
     def mimetype(self):
         return "application/octet-stream"   # By default we don't know what it is #TODO-LOCAL look up in MimetypeService just in case ...
 
+    def content(self, _headers=None, verbose=False, **kwargs):
+        """
+        Return the block as an open file if its local, so the server can send it with sendfile (and handle ranges),
+        otherwise as retrieved from elsewhere by retrieve()
+        """
+        try:
+            data = self.transport(verbose=verbose).rawfetchfile(multihash=self._contenthash, verbose=verbose)
+        except TransportFileNotFound as e:
+            data = self._fallback(e, verbose=verbose)
+        return {"Content-type": self.mimetype, "data": data}
+
     def retrieve(self, verbose=False, **kwargs):
         try:
             return self.transport(verbose=verbose).rawfetch(multihash=self._contenthash)
         except TransportFileNotFound as e1:  # Not found in block store, lets try contenthash
-            logging.debug("LocalResolverFetch.retrieve: err={}".format(e1))
-            try:
-                from .HashResolvers import ContentHash  # Avoid a circular reference
-                contenthash = self._contenthash.multihash58
-                logging.debug("LocalResolverFetch.retrieve falling back to contenthash: {}".format(contenthash))
-                return ContentHash.new("contenthash", contenthash, verbose=verbose, nolocal=True).retrieve(verbose=verbose)
-            except Exception as e:
-                logging.debug("Fallback failed, raising original error")
-                raise e1
+            return self._fallback(e1, verbose=verbose)
+
+    def _fallback(self, e1, verbose=False):
+        # Not in the block store (e1 is the error that said so), try elsewhere via contenthash
+        logging.debug("LocalResolverFetch.retrieve: err={}".format(e1))
+        try:
+            from .HashResolvers import ContentHash  # Avoid a circular reference
+            contenthash = self._contenthash.multihash58
+            logging.debug("LocalResolverFetch.retrieve falling back to contenthash: {}".format(contenthash))
+            return ContentHash.new("contenthash", contenthash, verbose=verbose, nolocal=True).retrieve(verbose=verbose)
+        except Exception as e:
+            logging.debug("Fallback failed, raising original error")
+            raise e1
 
 class LocalResolverAdd(LocalResolver):
 
@@ -80,9 +96,14 @@ class LocalResolverAdd(LocalResolver):
     def new(cls, namespace, url, *args, data=None, **kwargs):  # Used by Gateway
         verbose = kwargs.get("verbose")
         obj = super(LocalResolverAdd, cls).new(namespace, *args, **kwargs)  # Calls __init__() by default
+        if hasattr(data, "read"):   # Large POSTs arrive as a file
+            data = data.read()
         if isinstance(data, (str, bytes)): # Assume its JSON
             data = loads(data)    # HTTP just delivers bytes
-        cls.transport(verbose=verbose).rawadd(url, data)
+        if isinstance(data, list):  # Many signatures at once e.g. an ingest, one append to each file, see rawaddbatch
+            cls.transport(verbose=verbose).rawaddbatch([ (url, sig) for sig in data ], verbose=verbose)
+        else:
+            cls.transport(verbose=verbose).rawadd(url, data)
         return obj
 
 class LocalResolverList(LocalResolver):
@@ -94,10 +115,34 @@ class LocalResolverList(LocalResolver):
         obj._contenthash = Multihash(multihash58=hash)
         return obj
 
-    def metadata(self, headers=True, verbose=False, **kwargs):
-        data = self.transport(verbose=verbose).rawlist(self._contenthash.multihash58, verbose=verbose)
-        mimetype = 'application/json';
-        return {"Content-type": mimetype, "data": data} if headers else data
+    def metadata(self, headers=True, verbose=False, after=None, limit=None, output=None, **kwargs):
+        """
+        The list, or with after and/or limit a page of it, see TransportLocal._recordspage
+
+        :param after:   Cursor to start at, the X-Next-Offset header of the previous response
+        :param limit:   Maximum number of records
+        :param output:  "ndjson" to stream one record per line instead of returning a JSON array
+        """
+        records, nextoffset = self.transport(verbose=verbose).rawlistpage(self._contenthash.multihash58,
+                                    after=after, limit=int(limit) if limit else None, verbose=verbose)
+        return self._page(records, nextoffset, headers=headers, output=output, data=list)
+
+    @staticmethod
+    def _page(records, nextoffset, headers=True, output=None, data=list):
+        """
+        Format a page of records from TransportLocal, with the cursor for the next page in an X-Next-Offset header
+
+        :param records:     iterator of records
+        :param output:      "ndjson" to return a generator of lines, which the server streams
+        :param data:        function to turn records into the JSON returned otherwise
+        """
+        if output == "ndjson":
+            mimetype = "application/x-ndjson"
+            data = ( dumps(record) + "\n" for record in records )
+        else:
+            mimetype = "application/json"
+            data = data(records)
+        return {"Content-type": mimetype, "data": data, "headers": {"X-Next-Offset": str(nextoffset)}} if headers else data
 
 class KeyValueTable(LocalResolver):
     @classmethod
@@ -113,6 +158,8 @@ class KeyValueTable(LocalResolver):
 
     def set(self, verbose=False, headers=False, data=None, **kwargs):       # set/table/<pubkey>
         #TODO check pubkey or have transport do it - and save with it
+        if hasattr(data, "read"):   # Large POSTs arrive as a file
+            data = data.read()
         if isinstance(data, (str, bytes)): # Assume its JSON
             data = loads(data)    # HTTP just delivers bytes
         self.transport(verbose=verbose).set(database=self.database, table=self.table, keyvaluelist=data, value=None, verbose=verbose)
@@ -132,8 +179,13 @@ class KeyValueTable(LocalResolver):
         res = self.transport(verbose=verbose).keys(database=self.database, table=self.table, verbose=verbose)
         return { "Content-type": "application/json", "data": res} if headers else res
 
-    def getall(self, verbose=False, headers=False, **kwargs):  # set/table/<pubkey>
+    def getall(self, verbose=False, headers=False, after=None, limit=None, output=None, **kwargs):  # set/table/<pubkey>
         # TODO check pubkey or have transport do it - and save with it
+        if after or limit or output:    # Page through changes, see LocalResolverList.metadata
+            records, nextoffset = self.transport(verbose=verbose).getpage(database=self.database, table=self.table,
+                                    after=after, limit=int(limit) if limit else None, verbose=verbose)
+            return LocalResolverList._page(records, nextoffset, headers=headers, output=output,
+                                           data=lambda records: { record["key"]: record.get("value") for record in records })
         res = self.transport(verbose=verbose).getall(database=self.database, table=self.table, verbose=verbose)
         return { "Content-type": "application/json", "data": res} if headers else res
 
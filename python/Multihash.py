@@ -67,13 +67,13 @@ class Multihash(object):
             raise MultihashError(message="Invalid lengths: expect {}, byte {}, len {}"
                                   .format(self.LENGTHS[self.code], self.digestlength, len(self.digest)))
 
-    def __init__(self, multihash58=None, sha1hex=None, data=None, code=None, url=None):
+    def __init__(self, multihash58=None, sha1hex=None, data=None, code=None, url=None, digest=None):
         """
         Accept variety of parameters,
 
         :param multihash_58:
+        :param digest:  bytes already hashed (e.g. incrementally) with code
         """
-        digest = None
 
         if url: # Assume its of the form somescheme:/somescheme/Q...
             logging.debug("url={} {}".format(url.__class__.__name__,url))
@@ -1,11 +1,13 @@
 import logging
+import hashlib
+import threading
 import requests
 from urllib.parse import urlparse
-from .Errors import ToBeImplementedException, NoContentException, IPFSException
+from .Errors import ToBeImplementedException, NoContentException, IPFSException, CodingException
 from .Multihash import Multihash
 from .HashStore import LocationService, MimetypeService, IPLDHashService
 from .config import config
-from .miscutils import httpget
+from .miscutils import httpget, httpstream
 from .TransportIPFS import TransportIPFS
 
 
@@ -169,7 +171,17 @@ class NameResolverFile(NameResolver):
         raise ToBeImplementedException(name="NameResolverFile.shards")
         pass
 
-    def cache_ipfs(self, url=None, data=None, forceurlstore=False, forceadd=False, printlog=False, announcedht=False, size=None, verbose=False ):
+    _printlock = threading.Lock()   # Progress records can come from several ingestion threads, dont let lines interleave
+
+    @classmethod
+    def printrecord(cls, *fields):
+        """
+        Print one CSV progress record ("URL","Add/Urlstore","Hash","Size","Announced") as used by load_ipfs.py
+        """
+        with cls._printlock:
+            print(",".join('"{}"'.format(f) for f in fields), flush=True)
+
+    def cache_ipfs(self, url=None, data=None, forceurlstore=False, forceadd=False, printlog=False, announcedht=False, size=None, stream=False, verbose=False ):
         """
         Cache in IPFS, will automatically select no action, urlstore or add unless constrained by forcexxx
         Before doing this, should have checked if IPLDHashService can return the hash already
@@ -178,7 +190,8 @@ class NameResolverFile(NameResolver):
         :param data:        # If present is the data for the file
         :param forceurlstore:   # Override default and use urlstore
         :param forceadd:        # Override default and use add
-        :raises:                # IPFS Exeption if its failing
+        :param stream:          # With forceadd and url, pipe the url into IPFS add chunk by chunk rather than fetching it all first
+        :raises:                # IPFS Exeption if its failing, or if streamed content doesnt match the sha1 or size expected
         :return:                # IPLDhash
 
         Logical combinations of arguments attempt to get the "right" result.
@@ -191,21 +204,46 @@ class NameResolverFile(NameResolver):
         # TODO-PERMS, this cant be caching to IPFS if dont have permission
         if not config["ipfs"].get("url_urlstore"):  # If not running on machine with urlstore
             forceadd = True
-        if url and forceadd:  # To "add" from an URL we need to retrieve and then urlstore
+        did = None
+        length = None
+        if url and forceadd and stream and not data:  # Pipe from the URL to IPFS, hashing and counting as it passes
+            (chunks, self.mimetype) = httpstream(url, chunksize=config["ipfs"]["stream_chunksize"])
+            sha1 = hashlib.sha1()
+            counted = { "length": 0 }
+            def _tee():
+                for chunk in chunks:
+                    sha1.update(chunk)
+                    counted["length"] += len(chunk)
+                    yield chunk
+            did = "addstream"
+            ipldurl = TransportIPFS().rawstorestream(_tee(), pinggateway=False, mimetype=self.mimetype, verbose=verbose)  # Can throw IPFSException
+            length = counted["length"]
+            sha1hex = sha1.hexdigest()
+            if (size and length != size) or (self.multihash and self.multihash.code == Multihash.SHA1 and self.multihash.sha1hex != sha1hex):
+                # Truncated or corrupted on the way, dont map the real file's hash to it
+                logging.error("NameResolverFile.cache_ipfs {} got sha1 {} length {} expected {} {}"
+                              .format(url, sha1hex, length, self.multihash and self.multihash.multihash58, size))
+                raise IPFSException(message="{} streamed content doesnt match its sha1 or size".format(url))
+            if not self.multihash:
+                self.multihash = Multihash(sha1hex=sha1hex)
+            MimetypeService.set(self.multihash.multihash58, self.mimetype, verbose=verbose)
+        elif url and forceadd:  # To "add" from an URL we need to retrieve and then urlstore
             (data, self.mimetype) = httpget(url, wantmime=True)
             if not self.multihash:  # Since we've got the data, we can compute SHA1 from it
                 if verbose: logging.debug("Computing SHA1 hash of url {}".format(url))
                 self.multihash = Multihash(data=data, code=Multihash.SHA1)
             # Since we retrieved mimetype we can save it, since not set in metadata
             MimetypeService.set(self.multihash.multihash58, self.mimetype, verbose=verbose)
-        if (url and not forceadd):
+        if did:
+            pass    # Already stored while streaming
+        elif (url and not forceadd):
             did = "urlstore"
             ipldurl = TransportIPFS().store(urlfrom=url, pinggateway=False, verbose=verbose)  # Can throw IPFSExeption
         elif data:  # Either provided or fetched from URL
             did = "add"
             ipldurl = TransportIPFS().store(data=data, pinggateway=False, mimetype=self.mimetype, verbose=verbose)
         else:
-            raise errors.CodingException(message="Invalid options to cache_ipfs forceurlstore={} forceadd={} url={} data len={}"\
+            raise CodingException(message="Invalid options to cache_ipfs forceurlstore={} forceadd={} url={} data len={}"\
                                          .format(forceurlstore, forceadd, url, len(data) if data else 0))
         # Each of the successful routes through above leaves us with ipldurl
         ipldhash = urlparse(ipldurl).path.split('/')[2]
@@ -213,9 +251,11 @@ class NameResolverFile(NameResolver):
             TransportIPFS().announcedht(ipldhash)  # Let DHT know - dont wait for up to 10 hours for next cycle
         IPLDHashService.set(self.multihash.multihash58, ipldhash)
         #("URL", "Add/Urlstore", "Hash", "Size", "Announced")
-        if size and data and (len(data) != size):
-            size = "{}!={}".format(size, len(data))
-        print('"{}","{}","{}","{}","{}"'.format(url, did, ipldhash, size, announcedht))
+        if data:
+            length = len(data)
+        if size and (length is not None) and (length != size):
+            size = "{}!={}".format(size, length)
+        self.printrecord(url, did, ipldhash, size, announcedht)
         return ipldhash
 
 
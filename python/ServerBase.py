@@ -3,11 +3,14 @@ import logging
 from .miscutils import dumps # Use our own version of dumps - more compact and handles datetime etc
 from json import loads      # Not our own loads since dumps is JSON compliant
 from sys import version as python_version
-from cgi import parse_header, parse_multipart
+from email.message import Message
 #from Dweb import Dweb      # Import Dweb library (wont use for Academic project
 #TODO-API needs writing up
 import html
+import io
+import os
 from http import HTTPStatus
+from types import GeneratorType
 from .config import config
 
 """
@@ -45,6 +48,124 @@ class DWEBMalformedURLException(MyBaseException):
     httperror = 400
     msg = "Malformed URL {path}"
 
+class HTTPRangeNotSatisfiableException(MyBaseException):
+    httperror = 416
+    msg = "Range {range} not satisfiable for length {length}"
+
+class HTTPPayloadTooLargeException(MyBaseException):
+    httperror = 413
+    msg = "Upload of {length} bytes is more than the maximum of {maximum}"
+
+class UploadStream(io.RawIOBase):
+    """
+    The body of a POST as a read-only file, so large uploads can be consumed in chunks rather than read into memory.
+    Reads stop at the Content-Length so never run into the next request on the connection.
+    """
+
+    def __init__(self, rfile, length):
+        super(UploadStream, self).__init__()
+        self.rfile = rfile
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.remaining <= 0:
+            return 0
+        data = self.rfile.read(min(len(b), self.remaining))
+        self.remaining -= len(data)
+        b[:len(data)] = data
+        return len(data)
+
+def parse_header(value):
+    """
+    Split a header such as Content-Type or Content-Disposition into its value and a dict of its parameters
+
+    :return: (value lowercased, {param: value})
+    """
+    msg = Message()
+    msg["content-type"] = value or ""     # Any header name, the parsing is the same
+    params = msg.get_params() or [("", "")]
+    return params[0][0].lower(), dict(params[1:])
+
+class MultipartParser(object):
+    """
+    Read a multipart/form-data body part by part as it arrives, nothing is spooled to disk, so a file part can be passed
+    to the handler open and is only written once, where the handler puts it e.g. by rawstore in block/.incoming.
+    """
+    MAXHEADERS = 16384  # Bytes of headers allowed on a part
+
+    def __init__(self, stream, boundary):
+        """
+        :param stream:      the body, e.g. an UploadStream
+        :param boundary:    from the Content-Type header
+        """
+        self.stream = stream
+        self.delimiter = b"\r\n--" + boundary.encode('latin-1')
+        self.buffer = b"\r\n"     # So the first boundary, at the very start, matches delimiter
+
+    def _more(self):
+        chunk = self.stream.read(io.DEFAULT_BUFFER_SIZE * 8)
+        if not chunk:
+            raise HTTPdispatcherException(req="multipart body truncated")
+        self.buffer += chunk
+
+    def _readpart(self, size):
+        # Up to size bytes of the current part, b"" at its end (leaving the delimiter at the start of buffer)
+        while True:
+            i = self.buffer.find(self.delimiter)
+            if i < 0:   # Everything except what could be the start of a delimiter is part of this part
+                i = len(self.buffer) - len(self.delimiter) + 1
+                if i <= 0:
+                    self._more()
+                    continue
+            data, self.buffer = self.buffer[:min(size, i)], self.buffer[min(size, i):]
+            return data
+
+    def parts(self):
+        """
+        Generate the parts, each must be finished with before asking for the next, any of it left unread is skipped
+
+        :return: generator of (name, filename or None, file open on the part's content)
+        """
+        while self._readpart(io.DEFAULT_BUFFER_SIZE * 8):  # Preamble, if any
+            pass
+        while True:
+            while len(self.buffer) < len(self.delimiter) + 2:
+                self._more()
+            if self.buffer[len(self.delimiter):len(self.delimiter) + 2] == b"--":   # Closing delimiter
+                return
+            self.buffer = self.buffer[len(self.delimiter):]
+            while b"\r\n\r\n" not in self.buffer:
+                if len(self.buffer) > self.MAXHEADERS:
+                    raise HTTPdispatcherException(req="multipart part headers")
+                self._more()
+            headers, self.buffer = self.buffer.split(b"\r\n\r\n", 1)
+            disposition = next(( line.split(b":", 1)[1] for line in headers.split(b"\r\n")
+                                 if line.lower().startswith(b"content-disposition:") ), b"")
+            _, params = parse_header(disposition.decode('utf-8', 'replace'))
+            yield params.get("name"), params.get("filename"), io.BufferedReader(MultipartStream(self))
+            while self._readpart(io.DEFAULT_BUFFER_SIZE * 8):  # Whatever the caller didnt read
+                pass
+
+class MultipartStream(io.RawIOBase):
+    """
+    The content of one part of a MultipartParser as a read-only file
+    """
+
+    def __init__(self, parser):
+        super(MultipartStream, self).__init__()
+        self.parser = parser
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.parser._readpart(len(b))
+        b[:len(data)] = data
+        return len(data)
+
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""
 
@@ -53,7 +174,7 @@ class MyHTTPRequestHandler(BaseHTTPRequestHandler):
     Generic HTTPRequestHandler, extends BaseHTTPRequestHandler, to make it easier to use
     """
     # Carefull - do not define __init__ as it is run for each incoming request.
-    # TODO-STREAMS add support for longer (streamed) files on both upload and download, allow a stream to be passed back from the subclasses routines.
+    # Routines can return a generator as "data" which is sent chunked, large uploads are passed to them as an UploadStream.
 
     """
     Simple (standard) HTTPdispatcher,
@@ -131,15 +252,25 @@ class MyHTTPRequestHandler(BaseHTTPRequestHandler):
                     raise HTTPdispatcherException(req=cmd)  # Will be caught in except
                 res = func(*args, **kwargs)
                 # Function should return
+                if isinstance(res.get("data"), io.IOBase):  # An open file, send without reading it into memory
+                    self._sendfile(res["data"], res.get("Content-type","application/octet-stream"))
+                    return
 
                 # Send the content-type
                 self.send_response(200)  # Send an ok response
                 contenttype = res.get("Content-type","application/octet-stream")
                 self.send_header('Content-type', contenttype)
+                for header, value in res.get("headers", {}).items():  # Extra headers e.g. X-Next-Offset for paging
+                    self.send_header(header, value)
                 if self.headers.get('Origin'):  # Handle CORS (Cross-Origin)
                     self.send_header('Access-Control-Allow-Origin', '*')
                     # self.send_header('Access-Control-Allow-Origin', self.headers['Origin'])  # '*' didnt work
+                    if res.get("headers"):
+                        self.send_header('Access-Control-Expose-Headers', ", ".join(res["headers"]))
                 data = res.get("data","")
+                if isinstance(data, GeneratorType):    # Stream it, length unknown so chunked
+                    self._sendchunked(data)
+                    return
                 if data or isinstance(data, (list, tuple, dict)): # Allow empty arrays toreturn as [] or empty dict as {}
                     if isinstance(data, (dict, list, tuple)):    # Turn it into JSON
                         data = dumps(data)        # Does our own version to handle classes like datetime
@@ -180,6 +311,94 @@ class MyHTTPRequestHandler(BaseHTTPRequestHandler):
             self.send_error(httperror, str(e))    # Send an error response
 
 
+    def _sendfile(self, file, contenttype):
+        """
+        Send an open file as the response, the kernel copies it to the socket with sendfile.
+        Handles a single "Range: bytes=..." request with a 206, otherwise sends all of it.
+        Closes the file.
+
+        :param file:        file open for binary read
+        :param contenttype:
+        :raises HTTPRangeNotSatisfiableException: if range is beyond the file
+        """
+        try:
+            length = os.fstat(file.fileno()).st_size
+            start, end = 0, length - 1
+            rangeheader = self.headers.get('range') if self.headers else None
+            if rangeheader and rangeheader.startswith("bytes=") and ("," not in rangeheader):  # Multiple ranges get whole file
+                first, _, last = rangeheader[6:].strip().partition("-")
+                try:
+                    if first:
+                        start, end = int(first), min(int(last), length - 1) if last else length - 1
+                    else:  # bytes=-n is the last n bytes
+                        start = max(length - int(last), 0)
+                except ValueError:
+                    raise HTTPRangeNotSatisfiableException(range=rangeheader, length=length)
+                if start > end or start >= length:
+                    raise HTTPRangeNotSatisfiableException(range=rangeheader, length=length)
+                self.send_response(206)
+                self.send_header('Content-Range', "bytes {}-{}/{}".format(start, end, length))
+            else:
+                self.send_response(200)
+            self.send_header('Content-type', contenttype)
+            self.send_header('Accept-Ranges', 'bytes')
+            if self.headers.get('Origin'):  # Handle CORS (Cross-Origin)
+                self.send_header('Access-Control-Allow-Origin', '*')
+            count = end - start + 1 if length else 0
+            self.send_header('content-length', str(count))
+            self.end_headers()
+            self.wfile.flush()
+            offset = start
+            try:
+                while count > 0:
+                    sent = os.sendfile(self.connection.fileno(), file.fileno(), offset, count)
+                    if not sent:
+                        break   # File shrank, shouldnt happen as blocks are immutable
+                    offset += sent
+                    count -= sent
+            except (AttributeError, OSError) as e:   # No sendfile on this platform or socket type, copy it instead
+                if isinstance(e, BrokenPipeError):
+                    raise
+                file.seek(offset)
+                while count > 0:
+                    chunk = file.read(min(count, 1048576))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    count -= len(chunk)
+        finally:
+            file.close()
+
+    def _sendchunked(self, data):
+        """
+        Send the rest of the response from a generator of str or bytes, as each part is ready.
+        Called after the status and headers (except length) are sent. HTTP/1.0 clients get the data unframed and the connection closed.
+        Once the headers are gone an error can only be reported by closing the connection early.
+
+        :param data: generator of str or bytes
+        """
+        chunked = self.request_version != "HTTP/1.0"
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_headers()
+        try:
+            for chunk in data:
+                if isinstance(chunk, str):
+                    chunk = bytes(chunk, "utf-8")
+                if chunk:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except BrokenPipeError:
+            raise   # Handled by _dispatch
+        except Exception as e:
+            logging.error("Error while streaming response, closing connection url={}".format(self.path), exc_info=True)
+            self.close_connection = True
+        finally:
+            data.close()
+
     def do_GET(self):
         #logging.debug(self.headers)
         self._dispatch()
@@ -206,28 +425,53 @@ class MyHTTPRequestHandler(BaseHTTPRequestHandler):
             #logging.debug(self.headers)
             ctype, pdict = parse_header(self.headers['content-type'])
             #logging.debug("Contenttype={0}, dict={1}".format(ctype, pdict))
+            length = int(self.headers['content-length'] or 0)
+            if length > config["httpserver"]["max_upload"]:
+                self.close_connection = True    # Not reading the body, so cant read another request after it
+                raise HTTPPayloadTooLargeException(length=length, maximum=config["httpserver"]["max_upload"])
+            body = UploadStream(self.rfile, length)
             if ctype == 'multipart/form-data':
-                postvars = parse_multipart(self.rfile, pdict)
+                # Fields are read into memory, the first file part is passed open as it arrives, so must be the last part used
+                postvars = {}
+                for name, filename, part in MultipartParser(body, pdict.get("boundary", "")).parts():
+                    if filename is not None:
+                        value = part
+                    else:
+                        value = part.read(config["httpserver"]["upload_memory"] + 1)
+                        if len(value) > config["httpserver"]["upload_memory"]:
+                            self.close_connection = True
+                            raise HTTPPayloadTooLargeException(length=len(value), maximum=config["httpserver"]["upload_memory"])
+                        value = value.decode('utf-8')
+                    a = postvars.get(name)
+                    postvars[name] = value if (a is None) else a+[value] if (isinstance(a,list)) else [a,value]
+                    if filename is not None:
+                        break
             elif ctype == 'application/x-www-form-urlencoded':
                 # This route is taken by browsers using jquery as no easy wayto uploadwith octet-stream
                 # If its just singular like data="foo" then return single values else (unusual) lists
-                length = int(self.headers['content-length'])
                 postvars = { p: (q[0] if (isinstance(q, list) and len(q)==1) else q) for p,q in parse_qs(
-                    self.rfile.read(length),
+                    body.read(length),
                     keep_blank_values=1).items() }  # In Python2 this was iteritems, I think items will work in both cases.
             elif ctype in ('application/octet-stream', 'text/plain'):  # Block sends this
-                length = int(self.headers['content-length'])
-                postvars = {"data": self.rfile.read(length)}
+                if length > config["httpserver"]["upload_memory"]:     # Handler reads it as a file e.g. rawstore writes it to disk as it arrives
+                    postvars = {"data": body}
+                else:
+                    postvars = {"data": body.read(length)}
             elif ctype == 'application/json':
-                length = int(self.headers['content-length'])
-                postvars = {"data": loads(self.rfile.read(length))}
+                postvars = {"data": loads(body.read(length))}
             else:
                 postvars = {}
             self._dispatch(**postvars)
+            if body.remaining:
+                self.close_connection = True    # Handler didnt read it all, rest would be mistaken for the next request
         except Exception as e:
         #except ZeroDivisionError as e:  # Uncomment this to actually throw exception (since it wont be caught here)
-            # Return error to user, should have been logged already
+            # Return error to user, errors from the handler have been logged already by _dispatch
             httperror = e.httperror if hasattr(e, "httperror") else 500
+            if not (self.expectedExceptions and isinstance(e, self.expectedExceptions)):  # Unexpected error
+                logging.error("Sending Unexpected Error {0}:".format(httperror), exc_info=True)
+            else:
+                logging.info("Sending Error {0}:{1}".format(httperror, str(e)))
             self.send_error(httperror, str(e))  # Send an error response
 
     def send_error(self, code, message=None, explain=None):
@@ -3,9 +3,9 @@
 import logging
 from .config import config
 from .miscutils import mergeoptions
-from .ServerBase import MyHTTPRequestHandler, exposed, HTTPdispatcherException
-from .DOI import DOI
-from .Errors import ToBeImplementedException, NoContentException, SearchException, TransportFileNotFound, ForbiddenException
+from .ServerBase import MyHTTPRequestHandler, exposed, HTTPdispatcherException, HTTPRangeNotSatisfiableException, HTTPPayloadTooLargeException
+from .DOI import DOI, DOIsearch
+from .Errors import ToBeImplementedException, NoContentException, SearchException, TransportFileNotFound, TransportCursorException, ForbiddenException
 # !SEE-OTHERNAMESPACE add new namespaces here and see other #!SEE-OTHERNAMESPACE
 from .HashResolvers import ContentHash, Sha1Hex
 from .LocalResolver import LocalResolverStore, LocalResolverFetch, LocalResolverList, LocalResolverAdd
@@ -53,18 +53,18 @@ class DwebGatewayHTTPRequestHandler(MyHTTPRequestHandler):
     Notes:
     *The namespace is passed to the specific constructor since a single name resolver might implement multiple namespaces.
 
-    Future Work:
-    #TODO-STREAM Expand the ServerBase classes to support streams as a return from these routines
+    Routines may return a generator as "data", ServerBase will stream it (chunked) e.g. POST /metadata/doi
     """
     defaulthttpoptions = {"ipandport": ('0.0.0.0', 4244)}   # Was localhost, but need it to answer on all ports
     onlyexposed = True          # Only allow calls to @exposed methods
-    expectedExceptions = (NoContentException, ArchiveItemNotFound, HTTPdispatcherException, TransportFileNotFound, ForbiddenException)     # List any exceptions that you "expect" (and don't want stacktraces for)
+    expectedExceptions = (NoContentException, ArchiveItemNotFound, HTTPdispatcherException, TransportFileNotFound, ForbiddenException, HTTPRangeNotSatisfiableException, HTTPPayloadTooLargeException, TransportCursorException)     # List any exceptions that you "expect" (and don't want stacktraces for)
 
     namespaceclasses = {    # Map namespace names to classes each of which has a constructor that can be passed the URL arguments.
         # !SEE-OTHERNAMESPACE add new namespaces here and see other !SEE-OTHERNAMESPACE here and in clients
         "advancedsearch": AdvancedSearch,
         "archiveid": ArchiveItem,
         "doi": DOI,
+        "search": DOIsearch,            # /metadata/search/<query> over the DOI corpus
         "contenthash": ContentHash,
         "sha1hex": Sha1Hex,
         "rawstore": LocalResolverStore,
@@ -191,6 +191,7 @@ class DwebGatewayHTTPRequestHandler(MyHTTPRequestHandler):
         /arc/archive.org/download => content/archiveid
         /arc/archive.org/metadata => metadata/archiveid
         /arc/archive.org/advancedsearch => metadata/advancedsearch
+        /arc/archive.org/leaf?key=xyz => leaf for item xyz, or with ?key=xyz&key=abc a dict of leafs for a batch of items
         /arc/archive.org/details => html file, but this should be done by nginx
 
         :param arg1: Must be "archive.org"
@@ -212,6 +213,9 @@ class DwebGatewayHTTPRequestHandler(MyHTTPRequestHandler):
                     raise SearchException(search=kwargs)
             if arg2 == "leaf":  # This needs to catch the special case of /arc/archive.org/leaf?key=xyz
                 args = list(args)
+                if isinstance(kwargs.get("key"), list):  # /arc/archive.org/leaf?key=xyz&key=abc resolves a batch of items
+                    keys = kwargs.pop("key")
+                    return ArchiveItem.leaves(keys, headers=True, **kwargs)
                 if kwargs.get("key"):
                     args.append(kwargs["key"])  # Push key into place normally held by itemid in URL of archiveid/xyz
                     del kwargs["key"]
@@ -281,7 +285,9 @@ class DwebGatewayHTTPRequestHandler(MyHTTPRequestHandler):
         if namespace == "advancedsearch":
             logging.debug("Accessing legacy URL - needs rewriting to use /arc/archive.org/{}/{} {}".format(namespace, '/'.join(args), kwargs))
             return self.arc("archive.org", "advancedsearch", *args, **kwargs)
-        if namespace not in ["sha1hex", "contenthash", "doi", "rawlist"]:
+        if namespace == "doi" and not args and isinstance(kwargs.get("data"), list):    # POST /metadata/doi with JSON array of DOIs
+            return DOI.batchmetadata(kwargs["data"], headers=True, verbose=kwargs.get("verbose", False))
+        if namespace not in ["sha1hex", "contenthash", "doi", "rawlist", "search"]:
             logging.debug("Accessing unsupported legacy URL - needs implementing metadata/{}/{} {}".format(namespace, '/'.join(args), kwargs))
             raise ToBeImplementedException(name="metadata/{}/{} {}".format(namespace, '/'.join(args), kwargs))
         # legacy supporting metadata/xxx
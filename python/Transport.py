@@ -156,6 +156,11 @@ class Transport(object):
     def rawadd(self, url, sig, verbose=False, subdir=None, **options):
         raise ToBeImplementedException(name=cls.__name__+".rawadd")
 
+    def rawaddbatch(self, pairs, verbose=False, subdir=None, **options):
+        # pairs is a list of (url, sig), by default added one at a time, subclasses can do better
+        for url, sig in pairs:
+            self.rawadd(url, sig, verbose=verbose, subdir=subdir, **options)
+
     def add(self, urls=None, date=None, signature=None, signedby=None, verbose=False, obj=None, **options ):
         #TODO-BACKPORTING check if still needed after Backport - not used in JS
         #add(dataurl, sig, date, keyurl)
@@ -1,6 +1,7 @@
 # encoding: utf-8
 import json
 import logging
+import uuid
 from .miscutils import loads, dumps
 from .Transport import Transport
 from .config import config
@@ -109,6 +110,40 @@ class TransportIPFS(Transport):
             self.pinggateway(ipldhash)
         return "ipfs:/ipfs/{}".format(ipldhash)
 
+    def rawstorestream(self, chunks, verbose=False, pinggateway=True, mimetype=None, **options):
+        """
+        Store data on IPFS as it arrives, the add is posted as a chunked multipart body so content is never held in memory
+
+        :param chunks:  Iterable of bytes, e.g. from miscutils.httpstream
+        :param mimetype:
+        :raises: IPFSException if cant reach server or it doesnt return a Hash
+        :return: url of data e.g. ipfs:/ipfs/Qm123abc
+        """
+        ipfsurl = config["ipfs"]["url_add_data"]
+        if verbose: logging.debug("Streaming IPFS to {0}".format(ipfsurl))
+        boundary = uuid.uuid4().hex
+
+        def _body():  # multipart/form-data with a single file part, as requests would build for files={'file': ...}
+            yield ('--{}\r\nContent-Disposition: form-data; name="file"; filename=""\r\nContent-Type: {}\r\n\r\n'
+                   .format(boundary, mimetype or "application/octet-stream")).encode('utf-8')
+            for chunk in chunks:
+                if chunk:
+                    yield chunk
+            yield '\r\n--{}--\r\n'.format(boundary).encode('utf-8')
+
+        headers = { "Connection": "keep-alive", "Content-Type": "multipart/form-data; boundary={}".format(boundary)}
+        try:
+            res = requests.post(ipfsurl, headers=headers, params={ 'trickle': 'true', 'pin': 'true'}, data=_body()).json()
+            ipldhash = res['Hash']
+        except requests.exceptions.ConnectionError as e:
+            raise IPFSException(message="Unable to post to local IPFS at {} it is probably not running or wedged".format(ipfsurl))
+        except (KeyError, json.decoder.JSONDecodeError) as e:
+            raise IPFSException(message="Bad format back from IPFS;"+str(e))
+        logging.debug("IPFS result={}".format(res))
+        if pinggateway:
+            self.pinggateway(ipldhash)
+        return "ipfs:/ipfs/{}".format(ipldhash)
+
     def store(self, data=None, urlfrom=None, verbose=False, mimetype=None, pinggateway=True, returns=None, **options):
         """
         Higher level store semantics
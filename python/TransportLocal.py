@@ -6,16 +6,99 @@ import logging
 #else:
 #    from urlparse import urlparse        # See https://docs.python.org/2/library/urlparse.html
 import os   # For isdir and exists
+import fcntl
+import hashlib
+import math
+import struct
+import time
+import zlib
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+try:
+    import msgpack  # Optional, only needed for config["local"]["record_format"] = "msgpack"
+except ImportError:
+    msgpack = None
 
 # Neither of these are used in the Gateway which could be extended
 #from Transport import Transport
 #from Dweb import Dweb
-from .Errors import TransportFileNotFound
+from .Errors import TransportFileNotFound, TransportCursorException, CodingException, MultihashError
+from .config import config
 from .Multihash import Multihash
-from .miscutils import loads, dumps
+from .HashStore import LocationService
+from .miscutils import loads, dumps, SqlitePool
 from .Transport import Transport
 
 
+class BloomFilter(object):
+    """
+    A set that can only be added to, and may wrongly say it contains something (with probability error) but never
+    wrongly says it doesnt, in about 10 bits per item at 1%. Used by TransportLocal to know which blocks it doesnt have.
+    Safe to test from many threads while one adds.
+    """
+
+    def __init__(self, capacity, error=0.01):
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error) / (math.log(2) ** 2)), 64)   # Bits
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self._lock = threading.Lock()   # Adds are read-modify-write of a byte
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [ (h1 + i * h2) % self.size for i in range(self.hashes) ]
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            for p in positions:
+                self.bits[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    HEADER = struct.Struct(">QQQQ")     # capacity, size, hashes, count
+
+    def tobytes(self):
+        with self._lock:
+            return self.HEADER.pack(self.capacity, self.size, self.hashes, self.count) + bytes(self.bits)
+
+    @classmethod
+    def frombytes(cls, data):
+        """
+        :raises ValueError: if data isnt from tobytes
+        """
+        if len(data) < cls.HEADER.size:
+            raise ValueError("BloomFilter too short")
+        bloomfilter = cls.__new__(cls)
+        bloomfilter.capacity, bloomfilter.size, bloomfilter.hashes, bloomfilter.count = cls.HEADER.unpack_from(data)
+        bloomfilter.bits = bytearray(data[cls.HEADER.size:])
+        if len(bloomfilter.bits) != (bloomfilter.size + 7) // 8:
+            raise ValueError("BloomFilter truncated")
+        bloomfilter._lock = threading.Lock()
+        return bloomfilter
+
+    def update(self, other):
+        """
+        Add everything in other to this filter
+
+        :return: False if other is a different size, so cant be
+        """
+        if (other.size, other.hashes) != (self.size, self.hashes):
+            return False
+        with self._lock:
+            self.bits = bytearray((int.from_bytes(self.bits, 'little') | int.from_bytes(other.bits, 'little')).to_bytes(len(self.bits), 'little'))
+            self.count += other.count
+        return True
+
+
 class TransportLocal(Transport):
     """
     Subclass of Transport.
@@ -33,7 +116,7 @@ class TransportLocal(Transport):
         :param dir:
         :param options:
         """
-        subdirs = "list", "reverse", "block"
+        subdirs = "list", "reverse", "block", "table"
         dir = options["local"]["dir"]
         if not os.path.isdir(dir):
             os.mkdir(dir)
@@ -70,10 +153,97 @@ class TransportLocal(Transport):
     def info(self, **options):
         return { "type": "local", "options": self.options }
 
+    shardedsubdirs = ("block",)     # Subdirs fanned out over two levels of directories, see _filename
+
     def _filename(self, subdir, multihash=None, verbose=False, **options):
         # Utility function to get filename to use for storage
+        # Blocks are in .cache/block/<last 2 chars>/<previous 2 chars>/<multihash58> since the start of a multihash58 is
+        # mostly the hash code and length so hardly varies, and one flat directory of millions of files is slow
+        h = multihash.multihash58
+        if subdir in self.shardedsubdirs:
+            return "%s/%s/%s/%s/%s" % (self.dir, subdir, h[-2:], h[-4:-2], h)
+        return "%s/%s/%s" % (self.dir, subdir, h)
+
+    def _flatfilename(self, subdir, multihash=None):
+        # Where a block was stored before sharding, see migrateblocks
         return "%s/%s/%s" % (self.dir, subdir, multihash.multihash58)
 
+    @staticmethod
+    def _atomicwrite(filename, data, tmpdir=None):
+        """
+        Write data so that filename either doesnt exist or is complete, even after a crash
+        Exception: IOError
+
+        :param filename:
+        :param data: bytes
+        :param tmpdir: Where to write it first, on the same filesystem, default beside filename
+        """
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+        if tmpdir:
+            os.makedirs(tmpdir, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=tmpdir or dirname, prefix=".tmp")
+        try:
+            os.fchmod(fd, 0o644)    # mkstemp makes it private, blocks are public
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpname, filename)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+    def migrateblocks(self, verbose=False):
+        """
+        Move blocks from the flat .cache/block/<multihash58> layout into the sharded layout, safe to rerun or run while serving
+        since rawfetch checks both places.
+
+        :return: number of blocks moved
+        """
+        blockdir = "%s/%s" % (self.dir, "block")
+        moved = 0
+        incomingdir = "%s/%s" % (blockdir, self.INCOMING)
+        cutoff = time.time() - self.INCOMINGMAXAGE  # Writes in progress are recent, so only remove files long abandoned
+        if os.path.isdir(incomingdir):
+            self._removestale(incomingdir, cutoff)
+        with os.scandir(blockdir) as entries:
+            for entry in entries:
+                if entry.name.startswith(".tmp"):   # Left by a crash during a write
+                    os.unlink(entry.path)
+                elif entry.name.startswith("."):    # e.g. .journal or .incoming
+                    continue
+                elif entry.is_dir(follow_symlinks=False):   # A shard, _atomicwrite leaves .tmp files in them after a crash
+                    with os.scandir(entry.path) as subdirs:
+                        for subdir in subdirs:
+                            if subdir.is_dir(follow_symlinks=False):
+                                self._removestale(subdir.path, cutoff, prefix=".tmp")
+                elif entry.is_file(follow_symlinks=False):
+                    try:
+                        multihash = Multihash(multihash58=entry.name)
+                    except (MultihashError, ValueError) as e:
+                        logging.warning("TransportLocal.migrateblocks skipping {}, not a block: {}".format(entry.path, e))
+                        continue
+                    filename = self._filename("block", multihash)
+                    os.makedirs(os.path.dirname(filename), exist_ok=True)
+                    os.replace(entry.path, filename)
+                    moved += 1
+                    if verbose and not (moved % 10000): logging.debug("TransportLocal.migrateblocks moved {}".format(moved))
+        logging.info("TransportLocal.migrateblocks moved {} blocks in {}".format(moved, blockdir))
+        return moved
+
+    @staticmethod
+    def _removestale(dirname, cutoff, prefix=""):
+        # Remove files in dirname starting with prefix that havent been modified since cutoff
+        with os.scandir(dirname) as entries:
+            for entry in entries:
+                if entry.name.startswith(prefix) and entry.is_file(follow_symlinks=False) \
+                        and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:   # Renamed into place, or removed by another migrateblocks
+                        pass
+
     def _tablefilename(self, database, table, subdir="table", createdatabase=False):
         # Utility function to get filename to use for storage
         dir = "{}/{}/{}".format(self.dir, subdir, database)
@@ -98,24 +268,683 @@ class TransportLocal(Transport):
         """
         Fetch a block from the local file system
         Exception: TransportFileNotFound if file doesnt exist
-        #TODO-STREAM make return stream to HTTP and so on
 
         :param url: Of form somescheme:/something/hash
         :param multihash: a Multihash structure
         :param options:
         :return:
         """
+        with self.rawfetchfile(url=url, multihash=multihash, verbose=verbose, **options) as file:
+            content = file.read()
+        if verbose: logging.debug("Read")
+        return content
+
+    def rawfetchfile(self, url=url, multihash=None, verbose=False, **options):
+        """
+        Open a block in the local file system, so it can be sent without reading it into memory (see ServerBase._sendfile)
+        Exception: TransportFileNotFound if file doesnt exist
+
+        :param url: Of form somescheme:/something/hash
+        :param multihash: a Multihash structure
+        :return: file open for binary read, caller must close
+        """
         multihash = multihash or  Multihash(url=url)
+        blockfilter = self._blockfilter()
+        if (blockfilter is not None) and (multihash.multihash58 not in blockfilter):
+            raise TransportFileNotFound(file=multihash.multihash58)  # Definitely not here, dont touch the disk
         filename = self._filename("block", multihash)
+        for f in (filename, self._flatfilename("block", multihash)):  # Flat in case not migrated yet
+            try:
+                if verbose: logging.debug("Opening {0}".format(f))
+                file = open(f, 'rb')
+                self._blockused(multihash.multihash58)
+                return file
+            except (IOError, FileNotFoundError) as e:
+                logging.debug("TransportLocal.rawfetch err={}".format(e))
+        raise TransportFileNotFound(file=filename)
+
+    # Which blocks are here, so that fetching one that isnt (often a random hash being probed) can be answered without
+    # touching the disk. Each process keeps a BloomFilter, built by scanning the block directory in the background, and
+    # follows block/.journal to which every rawstore (in any process) appends the hash it stored, at most every
+    # config["local"]["block_filter_refresh"] seconds, so may miss a block just stored by another process for that long.
+    # Once the journal is over config["local"]["block_filter_journal_bytes"] a process folds it into its filter, saves
+    # that as block/.filter and empties the journal; others see .filter has changed and add it to theirs before reading
+    # the journal again from the start. Appending and reading the journal hold a shared flock on it, emptying it an
+    # exclusive one. Blocks copied in by other means are only seen after a restart.
+    _blockfilters = {}      # { dir: {"filter": BloomFilter or None while building, "offset": into journal, "snapshot": version of .filter
+                            #         included, "refreshed": time, "compacting": bool, "lock"} }
+    _blockfilterslock = threading.Lock()
+
+    def _journalfilename(self):
+        return "%s/%s/.journal" % (self.dir, "block")
+
+    def _snapshotfilename(self):
+        return "%s/%s/.filter" % (self.dir, "block")
+
+    def _snapshotversion(self):
         try:
-            if verbose: logging.debug("Opening {0}".format(filename))
-            with open(filename, 'rb') as file:
-                content = file.read()
-            if verbose: logging.debug("Opened")
-            return content
-        except (IOError, FileNotFoundError) as e:
-            logging.debug("TransportLocal.rawfetch err={}".format(e))
-            raise TransportFileNotFound(file=filename)
+            st = os.stat(self._snapshotfilename())
+            return st.st_ino, st.st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _journalstate(self):
+        """
+        :return: (size of journal, version of .filter) consistent with each other
+        """
+        try:
+            with open(self._journalfilename(), 'rb') as f:
+                fcntl.flock(f, fcntl.LOCK_SH)   # Not while _compactjournal is emptying it
+                return os.fstat(f.fileno()).st_size, self._snapshotversion()
+        except FileNotFoundError:
+            return 0, self._snapshotversion()
+
+    def _blockfilter(self):
+        """
+        :return: BloomFilter of blocks in this store, or None if not (yet) available in which case look on disk
+        """
+        if not config["local"]["block_filter"]:
+            return None
+        state = self._blockfilters.get(self.dir)
+        if state is None:
+            with self._blockfilterslock:
+                if self.dir not in self._blockfilters:
+                    state = self._blockfilters[self.dir] = {"filter": None, "offset": 0, "snapshot": None, "refreshed": 0,
+                                                            "compacting": False, "lock": threading.Lock()}
+                    threading.Thread(target=self._buildblockfilter, args=(state,), daemon=True).start()
+            return None
+        if state["filter"] is not None and (time.time() - state["refreshed"] > config["local"]["block_filter_refresh"]):
+            self._followjournal(state)
+        return state["filter"]
+
+    def _buildblockfilter(self, state, capacity=None):
+        """
+        Build the filter for a state in _blockfilters from what is in the block directory, sharded or flat
+        """
+        blockdir = "%s/%s" % (self.dir, "block")
+        offset, snapshot = self._journalstate()     # Anything added while scanning will be in the journal (or a newer .filter)
+        blockfilter = BloomFilter(capacity or config["local"]["block_filter_capacity"], config["local"]["block_filter_error"])
+        start = time.time()
+        dirs = [ blockdir ]
+        while dirs:
+            with os.scandir(dirs.pop()) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):  # .tmp*, .journal and .incoming
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    else:
+                        blockfilter.add(entry.name)
+        if blockfilter.count > blockfilter.capacity:    # Error rate would be too high
+            return self._buildblockfilter(state, capacity=blockfilter.count * 2)
+        with state["lock"]:
+            state.update(filter=blockfilter, offset=offset, snapshot=snapshot, refreshed=0)
+        logging.info("TransportLocal built filter of {} blocks in {} in {:.1f}s".format(blockfilter.count, blockdir, time.time() - start))
+
+    def _followjournal(self, state):
+        if not state["lock"].acquire(blocking=False):
+            return  # Another thread is already doing it
+        try:
+            state["refreshed"] = time.time()
+            try:
+                with open(self._journalfilename(), 'rb') as f:
+                    fcntl.flock(f, fcntl.LOCK_SH)   # Not while _compactjournal is emptying it
+                    snapshot = self._snapshotversion()
+                    if snapshot is not None and snapshot != state["snapshot"]:  # Another process has folded the journal into .filter and emptied it
+                        self._loadsnapshot(state)
+                    size = os.fstat(f.fileno()).st_size
+                    if size < state["offset"]:  # Journal was removed, rebuild from the directory
+                        state["filter"] = None
+                        threading.Thread(target=self._buildblockfilter, args=(state,), daemon=True).start()
+                        return
+                    data = os.pread(f.fileno(), size - state["offset"], state["offset"]) if size > state["offset"] else b""
+            except FileNotFoundError:
+                return
+            end = data.rfind(b"\n") + 1  # Ignore a line still being written
+            for h in data[:end].split():
+                state["filter"].add(h.decode('utf-8'))
+            state["offset"] += end
+            if state["offset"] > config["local"]["block_filter_journal_bytes"] and not state["compacting"]:
+                state["compacting"] = True
+                threading.Thread(target=self._compactjournal, args=(state,), daemon=True).start()
+        finally:
+            state["lock"].release()
+
+    def _loadsnapshot(self, state):
+        # Add block/.filter to the filter in state, and follow the journal from the start, called with state["lock"] held
+        with open(self._snapshotfilename(), 'rb') as f:
+            version = os.fstat(f.fileno())
+            snapshot = BloomFilter.frombytes(f.read())
+        if not state["filter"].update(snapshot):    # Sized differently, but .filter has everything the journal had
+            state["filter"] = snapshot
+        state.update(snapshot=(version.st_ino, version.st_mtime_ns), offset=0)
+
+    def _compactjournal(self, state):
+        """
+        Fold the journal into this process's filter, save that as block/.filter, and empty the journal.
+        Skipped (until the next time the journal is followed) if any process is appending to or reading the journal.
+        """
+        try:
+            with state["lock"]:
+                with open(self._journalfilename(), 'r+b') as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        return
+                    snapshot = self._snapshotversion()
+                    if snapshot is not None and snapshot != state["snapshot"]:
+                        return  # Another process compacted it since we followed it, follow that first
+                    size = os.fstat(f.fileno()).st_size
+                    for h in os.pread(f.fileno(), size - state["offset"], state["offset"]).split():
+                        state["filter"].add(h.decode('utf-8'))
+                    self._atomicwrite(self._snapshotfilename(), state["filter"].tobytes(),
+                                      tmpdir="%s/%s/%s" % (self.dir, "block", self.INCOMING))   # Not where migrateblocks removes .tmp files
+                    os.ftruncate(f.fileno(), 0)
+                    os.fsync(f.fileno())
+                    state.update(offset=0, snapshot=self._snapshotversion())
+            logging.info("TransportLocal compacted block journal of {} bytes into {}".format(size, self._snapshotfilename()))
+        except Exception as e:  # Background thread, the journal will just be longer until next time
+            logging.error("TransportLocal cant compact block journal in {}: {}".format(self.dir, e), exc_info=True)
+        finally:
+            state["compacting"] = False
+
+    def _blockadded(self, multihash):
+        """
+        Record that a block has been stored, in this process's filter and in the journal for other processes
+        """
+        if not config["local"]["block_filter"]:
+            return
+        h = multihash.multihash58
+        state = self._blockfilters.get(self.dir)
+        if state and state["filter"] is not None:
+            state["filter"].add(h)
+        with open(self._journalfilename(), 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)   # Not while _compactjournal is emptying it
+            f.write((h + "\n").encode('utf-8'))  # A single small O_APPEND write, so lines dont interleave
+
+    # The block store is a cache of content also available from archive.org or IPFS, kept under
+    # config["local"]["block_cache_bytes"] by evicting the least recently used blocks that arent pinned. When blocks
+    # are stored or fetched that is noted in memory, and every config["local"]["block_cache_interval"] seconds a
+    # background thread writes it to block/.lru.sqlite and if over budget evicts down to block_cache_lowwater of it,
+    # also forgetting the LocationService local: url. Only one process evicts at a time. Blocks stored before there was
+    # an index are added by that thread when it starts, once per block store (see indexblocks).
+    _blockcaches = {}       # { dir: {"used": { multihash58: (size or None, time) } not yet written, "lock"} }
+    _blockcacheslock = threading.Lock()
+    _blockcachepools = {}   # { dir: SqlitePool } of connections to block/.lru.sqlite
+
+    def _blockcacheconnection(self):
+        """
+        :return: context manager checking out a connection to the block cache index from a pool, see SqlitePool
+        """
+        dir = self.dir
+        with self._blockcacheslock:
+            pool = self._blockcachepools.get(dir)
+            if pool is None:
+                def _connect():
+                    db = sqlite3.connect("%s/%s/.lru.sqlite" % (dir, "block"), timeout=30, isolation_level=None, check_same_thread=False)
+                    db.execute("PRAGMA journal_mode = WAL;")
+                    db.execute("PRAGMA synchronous = NORMAL;")
+                    db.execute("CREATE TABLE IF NOT EXISTS blocks (hash TEXT PRIMARY KEY, size INTEGER, atime REAL, pinned INTEGER DEFAULT 0);")
+                    db.execute("CREATE INDEX IF NOT EXISTS blocks_lru ON blocks (pinned, atime);")
+                    db.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value);")
+                    return db
+                pool = self._blockcachepools[dir] = SqlitePool(_connect, config["local"]["sqlite_pool_size"])
+        return pool.connection()
+
+    def _blockcache(self):
+        cache = self._blockcaches.get(self.dir)
+        if cache is None:
+            with self._blockcacheslock:
+                cache = self._blockcaches.get(self.dir)
+                if cache is None:
+                    cache = self._blockcaches[self.dir] = {"used": {}, "lock": threading.Lock()}
+                    if config["local"]["block_cache_bytes"]:
+                        threading.Thread(target=self._blockcacheloop, daemon=True).start()
+        return cache
+
+    def _blockused(self, multihash58, size=None):
+        """
+        Note a block was stored (with its size) or fetched, cheap as just in memory until written by _blockcacheflush
+        """
+        cache = self._blockcache()
+        with cache["lock"]:
+            old = cache["used"].get(multihash58)
+            cache["used"][multihash58] = (size if size is not None else old and old[0], time.time())
+
+    def _blockcacheflush(self):
+        cache = self._blockcache()
+        with cache["lock"]:
+            used, cache["used"] = cache["used"], {}
+        if used:
+            with self._blockcacheconnection() as db:
+                db.execute("BEGIN IMMEDIATE;")
+                try:
+                    db.executemany("INSERT INTO blocks (hash, size, atime) VALUES (?, ?, ?) "
+                                   "ON CONFLICT(hash) DO UPDATE SET atime=excluded.atime, size=coalesce(excluded.size, size);",
+                                   [ (h, size, atime) for h, (size, atime) in used.items() ])
+                    db.execute("COMMIT;")
+                except BaseException:
+                    db.execute("ROLLBACK;")
+                    raise
+                # Blocks fetched but stored before the index have no size yet, find them among just these and stat
+                # them outside the write lock
+                unsized = [ h for h, (size, _) in used.items() if size is None ]
+                for i in range(0, len(unsized), 500):
+                    batch = unsized[i:i+500]
+                    sizes = [ (h, self._blocksize(h)) for (h,) in
+                              db.execute("SELECT hash FROM blocks WHERE size IS NULL AND hash IN ({});".format(",".join("?"*len(batch))), batch).fetchall() ]
+                    db.execute("BEGIN IMMEDIATE;")
+                    db.executemany("DELETE FROM blocks WHERE hash = ? AND size IS NULL;", [ (h,) for h, size in sizes if size is None ])  # Evicted meanwhile
+                    db.executemany("UPDATE blocks SET size = ? WHERE hash = ? AND size IS NULL;", [ (size, h) for h, size in sizes if size is not None ])
+                    db.execute("COMMIT;")
+
+    def _blocksize(self, multihash58):
+        # Size of a block fetched but not yet in the cache index e.g. stored before it existed, None if its not here
+        for f in (self._filename("block", Multihash(multihash58=multihash58)), self._flatfilename("block", Multihash(multihash58=multihash58))):
+            try:
+                return os.path.getsize(f)
+            except OSError:
+                pass
+        return None
+
+    def _blockcacheloop(self):
+        try:
+            with self._blockcacheconnection() as db:
+                scanned = db.execute("SELECT value FROM state WHERE name = 'scanned';").fetchone()
+            if not scanned:     # Blocks already on disk wouldnt otherwise count towards the budget until used
+                self.indexblocks()
+        except Exception as e:
+            logging.error("TransportLocal block cache {} cant index existing blocks: {}".format(self.dir, e), exc_info=True)
+        while True:
+            time.sleep(config["local"]["block_cache_interval"])
+            try:
+                self._blockcacheflush()
+                self.evictblocks()
+            except Exception as e:
+                logging.error("TransportLocal block cache {}: {}".format(self.dir, e), exc_info=True)
+
+    def evictblocks(self, budget=None, verbose=False):
+        """
+        If blocks take more than budget bytes, remove the least recently used that arent pinned until under
+        config["local"]["block_cache_lowwater"] of it, and remove their local: url from LocationService.
+
+        :param budget:  bytes, default config["local"]["block_cache_bytes"]
+        :return:        (blocks, bytes) evicted, or None if another process is evicting
+        """
+        budget = budget or config["local"]["block_cache_bytes"]
+        if not budget:
+            return 0, 0
+        self._blockcacheflush()     # So blocks just used arent taken as unused
+        with open("%s/%s/.lru.lock" % (self.dir, "block"), 'wb') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            with self._blockcacheconnection() as db:
+                total = db.execute("SELECT coalesce(SUM(size), 0) FROM blocks;").fetchone()[0]
+                target = budget * config["local"]["block_cache_lowwater"]
+                evicted, freed = 0, 0
+                if total <= budget:
+                    return evicted, freed
+                while total > target:
+                    rows = db.execute("SELECT hash, size, atime FROM blocks WHERE NOT pinned ORDER BY atime LIMIT 500;").fetchall()
+                    if not rows:
+                        logging.warning("TransportLocal.evictblocks {} bytes still used, but all blocks are pinned".format(total))
+                        break
+                    removed = []
+                    with open("%s/%s/.store.lock" % (self.dir, "block"), 'wb') as storelock:
+                        fcntl.flock(storelock, fcntl.LOCK_EX)   # No store between checking a block and unlinking it, see _storeblock
+                        for h, size, atime in rows:
+                            multihash = Multihash(multihash58=h)
+                            files = (self._filename("block", multihash), self._flatfilename("block", multihash))
+                            mtime = max(( os.path.getmtime(f) for f in files if os.path.exists(f) ), default=None)
+                            if mtime is not None and mtime > atime:     # Stored again since, but not yet flushed as used
+                                db.execute("UPDATE blocks SET atime = ? WHERE hash = ?;", (mtime, h))
+                                continue
+                            for f in files:
+                                try:
+                                    os.unlink(f)
+                                except FileNotFoundError:
+                                    pass
+                            db.execute("DELETE FROM blocks WHERE hash = ? AND NOT pinned;", (h,))
+                            removed.append(h)
+                            total -= size or 0
+                            freed += size or 0
+                            evicted += 1
+                            if total <= target:
+                                break
+                    for h in removed:
+                        try:
+                            if (LocationService.get(h) or "").startswith("local:"):     # Not if its since been found elsewhere
+                                LocationService.delete(h, verbose=verbose)
+                        except Exception as e:  # e.g. Redis down, dont stop freeing disk
+                            logging.error("TransportLocal.evictblocks cant remove location of {}: {}".format(h, e))
+                logging.info("TransportLocal.evictblocks removed {} blocks, {} bytes, from {}".format(evicted, freed, self.dir))
+                return evicted, freed
+
+    def pin(self, multihash58, pinned=True, verbose=False):
+        """
+        Stop (or with pinned=False allow) a block being evicted, whether or not it is here yet
+        """
+        self._blockcacheflush()
+        with self._blockcacheconnection() as db:
+            db.execute("INSERT INTO blocks (hash, size, atime, pinned) VALUES (?, ?, ?, ?) "
+                       "ON CONFLICT(hash) DO UPDATE SET pinned=excluded.pinned;",
+                       (multihash58, self._blocksize(multihash58) or 0, time.time(), int(pinned)))
+        if verbose: logging.debug("TransportLocal.pin {} {}".format(multihash58, pinned))
+
+    def indexblocks(self, verbose=False):
+        """
+        Add blocks that arent in the cache index (e.g. stored before it existed) using their modification time as last use,
+        in batches so writers arent held up for long. Run by the block cache thread the first time it starts on a block store.
+
+        :return: number of blocks added
+        """
+        self._blockcacheflush()
+        dirs = [ "%s/%s" % (self.dir, "block") ]
+        found = 0
+        with self._blockcacheconnection() as db:
+            def _add(rows):
+                db.execute("BEGIN IMMEDIATE;")
+                db.executemany("INSERT OR IGNORE INTO blocks (hash, size, atime) VALUES (?, ?, ?);", rows)
+                db.execute("COMMIT;")
+            rows = []
+            changes = db.total_changes
+            while dirs:
+                with os.scandir(dirs.pop()) as entries:
+                    for entry in entries:
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        else:
+                            st = entry.stat(follow_symlinks=False)
+                            rows.append((entry.name, st.st_size, st.st_mtime))
+                            if len(rows) >= 10000:
+                                _add(rows)
+                                found += len(rows)
+                                rows = []
+            _add(rows)
+            found += len(rows)
+            added = db.total_changes - changes
+            db.execute("INSERT OR REPLACE INTO state (name, value) VALUES ('scanned', ?);", (time.time(),))
+        logging.info("TransportLocal.indexblocks added {} of {} blocks in {}".format(added, found, self.dir))
+        return added
+
+    # List, reverse and table files are either JSON lines (the original format), or if they start with RECORDMAGIC
+    # (see config["local"]["record_format"]) binary records, each RECORDMARK, length and crc32 then a msgpack body.
+    # Files keep the format they were created with, see convertrecords to change it.
+    RECORDMAGIC = b"\xd7DWRMP1\n"     # Cant be the start of JSON
+    RECORDMARK = b"\xd7\xeb"          # Start of every binary record so can resync after a corrupt one
+    RECORDHEADER = struct.Struct(">2sII")   # mark, length of body, crc32 of body
+
+    @classmethod
+    def _fileformat(cls, file):
+        """
+        :param file:    Open (binary, readable) list, reverse or table file
+        :return:        "msgpack" or "json"
+        """
+        return "msgpack" if os.pread(file.fileno(), len(cls.RECORDMAGIC), 0) == cls.RECORDMAGIC else "json"
+
+    @classmethod
+    def _encoderecords(cls, records, format):
+        """
+        :param records: list of dicts
+        :param format:  "msgpack" or "json"
+        :return:        bytes to append to a file of that format
+        """
+        if format == "msgpack":
+            bodies = [ msgpack.packb(record, use_bin_type=True, default=lambda obj: loads(dumps(obj))) for record in records ]
+            return b"".join([ cls.RECORDHEADER.pack(cls.RECORDMARK, len(body), zlib.crc32(body)) + body for body in bodies ])
+        return "".join([ dumps(record) + "\n" for record in records ]).encode('utf-8')    # Compact JSON, one per line
+
+    @classmethod
+    def _decoderecord(cls, data, format):
+        """
+        :param data:    One whole record as it is in the file (bytes or memoryview e.g. from offset to nextoffset of _records)
+        :raises ValueError: if corrupt
+        """
+        if format == "msgpack":
+            if msgpack is None:
+                raise CodingException(message="msgpack must be installed to read binary records")
+            try:
+                return msgpack.unpackb(data[cls.RECORDHEADER.size:], raw=False)
+            except (msgpack.UnpackException, msgpack.ExtraData) as e:
+                raise ValueError(str(e))
+        return loads(data)
+
+    @classmethod
+    def _validframe(cls, fd, offset, end):
+        """
+        :return: offset after the binary record at offset, or None if there isnt a complete uncorrupted one there
+        """
+        header = os.pread(fd, cls.RECORDHEADER.size, offset)
+        if len(header) < cls.RECORDHEADER.size:
+            return None
+        mark, length, crc = cls.RECORDHEADER.unpack(header)
+        nextoffset = offset + cls.RECORDHEADER.size + length
+        if mark != cls.RECORDMARK or nextoffset > end or zlib.crc32(os.pread(fd, length, offset + cls.RECORDHEADER.size)) != crc:
+            return None
+        return nextoffset
+
+    @classmethod
+    def _resync(cls, fd, start, end):
+        """
+        :return: offset of the first complete uncorrupted binary record at or after start, or None
+        """
+        pos = start
+        while pos < end:
+            chunk = os.pread(fd, min(end - pos, 1048576), pos)
+            i = chunk.find(cls.RECORDMARK)
+            while i >= 0:
+                if cls._validframe(fd, pos + i, end):
+                    return pos + i
+                i = chunk.find(cls.RECORDMARK, i + 1)
+            pos += max(len(chunk) - 1, 1)     # Overlap in case a mark is split across chunks
+        return None
+
+    @classmethod
+    def _frames(cls, file, format, start=0, end=None):
+        """
+        Split a file into records without decoding them
+
+        :return: iterator of (offset, nextoffset, data) data is the whole record, or None if corrupt
+        """
+        fd = file.fileno()
+        if end is None:
+            end = os.fstat(fd).st_size
+        if format != "msgpack":
+            with os.fdopen(os.dup(fd), 'rb') as f:  # Own file position, so file can be shared
+                f.seek(start)
+                offset = start
+                for line in f:
+                    nextoffset = offset + len(line)
+                    if (nextoffset > end) or not line.endswith(b"\n"):
+                        break   # Incomplete, still being written
+                    yield offset, nextoffset, line
+                    offset = nextoffset
+            return
+        hs = cls.RECORDHEADER.size
+        unpack_from = cls.RECORDHEADER.unpack_from
+        offset = max(start, len(cls.RECORDMAGIC))
+        buf, bufoffset = b"", offset    # Read ahead, most records are small
+
+        def fill(n):   # Make sure buf holds n bytes from offset, if the file has them
+            nonlocal buf, bufoffset
+            buf = buf[offset - bufoffset:]
+            bufoffset = offset
+            more = min(max(n - len(buf), 1048576), end - bufoffset - len(buf))
+            if more > 0:
+                buf += os.pread(fd, more, bufoffset + len(buf))
+        while offset < end:
+            if bufoffset + len(buf) < offset + hs:
+                fill(hs)
+                if bufoffset + len(buf) < offset + hs:
+                    break   # Incomplete, still being written
+            i = offset - bufoffset
+            mark, length, crc = unpack_from(buf, i)
+            complete = False
+            if mark == cls.RECORDMARK:
+                if bufoffset + len(buf) < offset + hs + length:
+                    fill(hs + length)
+                    i = 0
+                complete = (len(buf) - i >= hs + length)
+                if complete:
+                    data = memoryview(buf)[i:i + hs + length]   # Without copying
+                    if zlib.crc32(data[hs:]) == crc:
+                        yield offset, offset + hs + length, data
+                        offset += hs + length
+                        continue
+            nextoffset = cls._resync(fd, offset + 1, end)  # Corrupt, or torn by a crash, or still being written
+            if nextoffset is None:
+                if not complete:
+                    break   # Probably still being written, if not the next append will make it resyncable
+                nextoffset = offset + hs + length
+            yield offset, nextoffset, None
+            offset = nextoffset
+
+    @classmethod
+    def _records(cls, filename, start=0, end=None, file=None):
+        """
+        Read the records of a list, reverse or table file, in either format (see RECORDMAGIC).
+        A partial record at the end (an append in progress) is not returned, a corrupt one is logged and returned as None.
+        Exception: IOError if file doesnt exist
+
+        :param filename:
+        :param start:   Offset to start reading at, must be the start of a record (e.g. a previous nextoffset)
+        :param end:     Offset to stop at, default end of file
+        :param file:    Already open (binary) file to read instead of opening filename
+        :return:        iterator of (offset, nextoffset, record)
+        """
+        with (os.fdopen(os.dup(file.fileno()), 'rb') if file else open(filename, 'rb')) as f:
+            format = cls._fileformat(f)
+            for offset, nextoffset, data in cls._frames(f, format, start=start, end=end):
+                try:
+                    record = None if data is None else cls._decoderecord(data, format)
+                except ValueError as e:
+                    record = None
+                if record is None:
+                    logging.error("TransportLocal skipping corrupt record in {} at {}".format(filename, offset))
+                yield offset, nextoffset, record
+
+    @classmethod
+    def _isboundary(cls, file, format, offset, size):
+        """
+        :return: True if offset is the start of a record (or the end of the file) of size bytes
+        """
+        if format == "msgpack":
+            return offset in (0, len(cls.RECORDMAGIC), size) or bool(cls._validframe(file.fileno(), offset, size))
+        return offset == 0 or (offset <= size and os.pread(file.fileno(), 1, offset - 1) == b"\n")
+
+    @classmethod
+    def _pageend(cls, file, format, after, size, limit=None):
+        """
+        Find the end of a page of up to limit records starting at after, without decoding them
+
+        :return: offset after the last complete record of the page
+        """
+        nextoffset = after
+        if format == "msgpack":
+            for count, (_, nextoffset, _) in enumerate(cls._frames(file, format, start=after, end=size), start=1):
+                if limit is not None and count >= limit:
+                    break
+            return nextoffset
+        pos = after     # JSON lines, just count them
+        count = 0
+        while pos < size and (limit is None or count < limit):
+            chunk = os.pread(file.fileno(), min(size - pos, 1048576), pos)
+            if limit is None:
+                i = chunk.rfind(b"\n")
+                if i >= 0:
+                    nextoffset = pos + i + 1
+            else:
+                i = -1
+                while count < limit:
+                    i = chunk.find(b"\n", i + 1)
+                    if i < 0:
+                        break
+                    count += 1
+                    nextoffset = pos + i + 1
+            pos += len(chunk)
+        return nextoffset
+
+    @classmethod
+    def _recordspage(cls, filename, after=0, limit=None):
+        """
+        Page through the records of a list or table file, using "<inode>:<offset>" cursors so a client can fetch just
+        what has been appended since it last looked. The inode ties the cursor to this version of the file, since
+        compact and convertrecords replace the file, an old offset could otherwise land on a record boundary in the new one.
+        Exception: TransportCursorException if after isnt the start of a record in the current file
+
+        :param after:   Cursor to start at, 0 (or None) or the nextoffset returned previously
+        :param limit:   Maximum number of records, default all
+        :return:        (iterator of records, nextoffset) the iterator reads the file lazily so can be streamed
+        """
+        if not after or after == "0":
+            inode, offset = None, 0
+        else:
+            try:
+                inode, offset = ( int(part) for part in str(after).split(":") )
+            except ValueError:
+                raise TransportCursorException(after=after, file=filename)
+        try:
+            f = open(filename, 'rb')
+        except FileNotFoundError:
+            if inode is not None:
+                raise TransportCursorException(after=after, file=filename)
+            return iter(()), 0
+        stat = os.fstat(f.fileno())
+        format = cls._fileformat(f)
+        if (inode is not None and inode != stat.st_ino) or not cls._isboundary(f, format, offset, stat.st_size):
+            f.close()
+            raise TransportCursorException(after=after, file=filename)
+        end = cls._pageend(f, format, offset, stat.st_size, limit)
+
+        def records():
+            with f:
+                for _, _, record in cls._records(filename, start=offset, end=end, file=f):
+                    if record is not None:
+                        yield record
+        return records(), "{}:{}".format(stat.st_ino, end)
+
+    @classmethod
+    def convertrecords(cls, filename, format, verbose=False):
+        """
+        Rewrite a list, reverse or table file in format ("msgpack" or "json"), appends wait until it is done.
+        Paging offsets (see _recordspage) from before are no longer valid.
+
+        :return: True if converted, False if already in that format
+        """
+        while True:
+            with open(filename, 'a+b') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)   # Stop appends and compaction
+                if os.fstat(f.fileno()).st_ino != os.stat(filename).st_ino:
+                    continue    # Replaced while waiting for lock
+                if cls._fileformat(f) == format:
+                    return False
+                fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".tmp")
+                try:
+                    with os.fdopen(fd, 'wb') as out:
+                        if format == "msgpack":
+                            out.write(cls.RECORDMAGIC)
+                        batch = []
+                        for _, _, record in cls._records(filename, file=f):
+                            if record is not None:
+                                batch.append(record)
+                            if len(batch) >= 1000:
+                                out.write(cls._encoderecords(batch, format))
+                                batch = []
+                        out.write(cls._encoderecords(batch, format))
+                        out.flush()
+                        os.fsync(out.fileno())
+                    os.chmod(tmpname, 0o644)
+                    os.replace(tmpname, filename)
+                except BaseException:
+                    if os.path.exists(tmpname):
+                        os.unlink(tmpname)
+                    raise
+                if verbose: logging.debug("TransportLocal.convertrecords {} to {}".format(filename, format))
+                return True
 
     def _rawlistreverse(self, filename=None, verbose=False, **options):
         """
@@ -126,10 +955,7 @@ class TransportLocal(Transport):
         :return: list of dictionaries for each item retrieved
         """
         try:
-            f = open(filename, 'rb')
-            s = [ loads(s) for s in f.readlines() ]
-            f.close()
-            return s
+            return [ record for _, _, record in self._records(filename) if record is not None ]
         except IOError as e:
             return []
             #Trying commenting out error, and returning empty array
@@ -148,6 +974,18 @@ class TransportLocal(Transport):
         return self._rawlistreverse(filename=filename, verbose=False, **options)
 
 
+    def rawlistpage(self, url, after=0, limit=None, verbose=False, **options):
+        """
+        Retrieve a page of the records matching a url, see _recordspage
+
+        :param url:     URL to be retrieved
+        :param after:   Cursor to start at, 0 or the nextoffset from the previous page
+        :param limit:   Maximum number of records
+        :return:        (iterator of dictionaries, nextoffset)
+        """
+        if verbose: logging.debug("TransportLocal:rawlistpage {0} after={1} limit={2}".format(url, after, limit))
+        return self._recordspage(self._filename("list", multihash=Multihash(url=url), verbose=verbose, **options), after=after, limit=limit)
+
     def rawreverse(self, url, verbose=False, **options):
 
         """
@@ -170,14 +1008,15 @@ class TransportLocal(Transport):
         :return: url of data
         """
         assert data is not None # Its meaningless (or at least I think so) to store None (empty string is meaningful) #TODO-LOCAL move assert to CodingException
-        contenthash=Multihash(data=data, code=Multihash.SHA2_256)
-        filename = self._filename("block",  multihash=contenthash, verbose=verbose, **options)
-        try:
-            f = open(filename, 'wb')
-            f.write(data)
-            f.close()
-        except IOError as e:
-            raise TransportFileNotFound(file=filename)
+        if hasattr(data, "read"):   # A file e.g. an upload, dont read it all into memory
+            contenthash, size = self._rawstorestream(data, verbose=verbose, **options)
+        else:
+            contenthash=Multihash(data=data, code=Multihash.SHA2_256)
+            size = len(data)
+            try:
+                self._storeblock(contenthash, size, lambda filename: self._atomicwrite(filename, data), verbose=verbose, **options)
+            except IOError as e:
+                raise TransportFileNotFound(file=self._filename("block",  multihash=contenthash, verbose=verbose, **options))
         url = self.url(multihash=contenthash)
         if returns:
             returns = returns.split(',')
@@ -186,12 +1025,149 @@ class TransportLocal(Transport):
             return url
 
 
-    def _rawadd(self, filename, value):
+    INCOMING = ".incoming"          # Directory in block for uploads being streamed, until their hash is known
+    INCOMINGMAXAGE = 24 * 3600      # Seconds unmodified before migrateblocks treats an upload there as abandoned
+
+    def _rawstorestream(self, file, verbose=False, **options):
+        """
+        Store a block from a file, hashing it while copying it to a temporary file in block/.incoming, in chunks of
+        config["local"]["upload_chunksize"], then renaming that to the hash
+
+        :param file:    open for binary read, read to the end but not closed
+        :return:        (Multihash, size)
+        """
+        incomingdir = "%s/%s/%s" % (self.dir, "block", self.INCOMING)
+        hashfn = Multihash.FUNCS[Multihash.SHA2_256]()
+        size = 0
         try:
-            with open(filename, 'ab') as f:
-                f.write(value)
+            os.makedirs(incomingdir, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=incomingdir, prefix=".tmp")
         except IOError as e:
+            raise TransportFileNotFound(file=incomingdir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = file.read(config["local"]["upload_chunksize"])
+                    if not chunk:
+                        break
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode('utf-8')
+                    hashfn.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+                out.flush()
+                os.fchmod(out.fileno(), 0o644)
+                os.fsync(out.fileno())
+            contenthash = Multihash(digest=hashfn.digest(), code=Multihash.SHA2_256)
+            def _write(filename):
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                os.replace(tmpname, filename)
+            self._storeblock(contenthash, size, _write, verbose=verbose, **options)
+        finally:
+            if os.path.exists(tmpname):     # Failed, or already had it
+                os.unlink(tmpname)
+        if verbose: logging.debug("TransportLocal.rawstore streamed {} bytes to {}".format(size, contenthash.multihash58))
+        return contenthash, size
+
+    def _storeblock(self, contenthash, size, write, verbose=False, **options):
+        """
+        Put a block in place with write(filename) unless its already here, and note it as used, holding block/.store.lock
+        shared so evictblocks (which holds it exclusively while unlinking) cant remove it in between. An existing block
+        has its modification time updated, which evictblocks checks, so it isnt evicted before _blockused is flushed.
+
+        :param write:   f(filename) to write the block atomically
+        """
+        filename = self._filename("block", multihash=contenthash, verbose=verbose, **options)
+        written = False
+        with open("%s/%s/.store.lock" % (self.dir, "block"), 'wb') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_SH)
+            for f in (filename, self._flatfilename("block", contenthash)):
+                try:
+                    os.utime(f)
+                except FileNotFoundError:
+                    continue
+                except OSError:
+                    pass    # Here, but not ours to touch e.g. read only
+                if verbose: logging.debug("TransportLocal.rawstore already have {}".format(f))  # Content addressed so must be same
+                break
+            else:
+                write(filename)
+                written = True
+            self._blockused(contenthash.multihash58, size=size)
+        if written:
+            self._blockadded(contenthash)
+
+    # Appends to list and table files are whole lines, so they must not interleave. Threads of this process queue their
+    # lines per file and whichever gets the file's lock writes everything queued (group commit), with one write and one
+    # fsync, under an flock against other processes and compaction. See config["local"]
+    _appendqueues = {}      # { filename: {"lock": Lock held while writing, "pending": [ {"records", "done", "error"} ], "users": threads using it} }
+    _appendqueueslock = threading.Lock()
+
+    def _rawadd(self, filename, records):
+        """
+        Append records to filename, in the file's format, returning once written (and synced if config["local"]["fsync"])
+        Exception: TransportFileNotFound if the directory doesnt exist
+
+        :param records: list of dicts
+        """
+        with self._appendqueueslock:
+            queue = self._appendqueues.setdefault(filename, {"lock": threading.Lock(), "pending": [], "users": 0})
+            queue["users"] += 1
+            waiter = {"records": records, "done": False, "error": None}
+            queue["pending"].append(waiter)
+        try:
+            with queue["lock"]:
+                if not waiter["done"]:  # Else already written by another thread's batch
+                    with self._appendqueueslock:
+                        if config["local"]["group_commit"]:
+                            batch, queue["pending"] = queue["pending"], []
+                        else:
+                            batch = [waiter]
+                            queue["pending"] = [ w for w in queue["pending"] if w is not waiter ]
+                    try:
+                        self._rawappend(filename, [ record for w in batch for record in w["records"] ])
+                    except Exception as e:
+                        for w in batch:
+                            w["error"] = e
+                    for w in batch:
+                        w["done"] = True
+        finally:
+            with self._appendqueueslock:    # Last one out drops the queue, so there isnt one per file ever written
+                queue["users"] -= 1
+                if not queue["users"]:
+                    del self._appendqueues[filename]
+        if isinstance(waiter["error"], FileNotFoundError):
             raise TransportFileNotFound(file=filename)
+        elif waiter["error"]:
+            raise waiter["error"]
+
+    @classmethod
+    def _rawappend(cls, filename, records):
+        while True:
+            with open(filename, 'a+b') as f:    # Readable to check the format and last byte, writes still always go to the end
+                fcntl.flock(f, fcntl.LOCK_EX)   # Against other processes and compaction
+                try:
+                    if os.fstat(f.fileno()).st_ino != os.stat(filename).st_ino:
+                        continue    # Compacted while waiting for lock, append to the new file
+                except FileNotFoundError:
+                    continue
+                end = os.fstat(f.fileno()).st_size
+                if end:
+                    format = cls._fileformat(f)
+                    value = cls._encoderecords(records, format)
+                    if format == "json" and os.pread(f.fileno(), 1, end - 1) != b"\n":
+                        value = b"\n" + value    # Last append was torn by a crash, dont join our first line onto it
+                else:   # New file
+                    format = config["local"]["record_format"]
+                    if format == "msgpack" and msgpack is None:
+                        logging.warning("TransportLocal: msgpack not installed, writing {} as json".format(filename))
+                        format = "json"
+                    value = (cls.RECORDMAGIC if format == "msgpack" else b"") + cls._encoderecords(records, format)
+                f.write(value)
+                f.flush()
+                if config["local"]["fsync"]:
+                    os.fsync(f.fileno())
+                return  # Closing unlocks
 
     def rawadd(self, url, sig, verbose=False, subdir=None, **options):
         """
@@ -205,25 +1181,48 @@ class TransportLocal(Transport):
         :param options:
         :return:
         """
-        subdir = subdir or ("list","reverse")   # By default store forward and backwards
         if verbose: logging.debug("TransportLocal.rawadd {0} {1} subdir={2} options={3}"
                                   .format(url, sig, subdir, options))
-        value = dumps(sig) + "\n" #Note this is a compact dump
-        value = value.encode('utf-8')
-        if "list" in subdir:
-            self._rawadd(
-                self._filename("list", multihash= Multihash(url=url), verbose=verbose, **options),   # List of things signedby
-                value)
-        """
-        # Reverse removed for now, as not used, and causes revision issues with Multi.
-        if "reverse" in subdir:
-            if not isinstance(urls, (list, tuple, set)):
-                urls = [urls]
-            for u in urls:
-                self._rawadd(
-                    self._filename("reverse", multihash= Multihash(url=u), verbose=verbose, **options),    # Lists that this object is on
-                    value)
+        self.rawaddbatch([(url, sig)], verbose=verbose, subdir=subdir, **options)
+
+    def rawaddbatch(self, pairs, verbose=False, subdir=None, **options):
+        """
+        Store many signatures, each on the list of its url and on the reverse list of each of its sig["urls"],
+        decoding each url once and appending to each file once.
+        Urls in sig["urls"] that arent multihashes (e.g. http urls) are logged and skipped, they have no reverse list.
+        Exception: MultihashError if a list url isnt a multihash, in which case nothing is stored
+
+        :param pairs:   list of (url, sig) as for rawadd
+        :param subdir:  as for rawadd
         """
+        subdir = subdir or ("list","reverse")   # By default store forward and backwards
+        filenames = {}  # { (subdir, url): filename or None if not decodable }
+        appends = OrderedDict()  # { filename: [ sig ] } in order first added to
+
+        def filename(sub, url):
+            if (sub, url) not in filenames:
+                try:
+                    filenames[(sub, url)] = self._filename(sub, multihash=Multihash(url=url), verbose=verbose, **options)
+                except (MultihashError, ValueError, TypeError, IndexError) as e:
+                    if sub == "list":
+                        raise   # Caller asked for this list
+                    logging.warning("TransportLocal.rawaddbatch skipping {} for {}: {}".format(url, sub, e))
+                    filenames[(sub, url)] = None
+            return filenames[(sub, url)]
+        for url, sig in pairs:
+            targets = []
+            if "list" in subdir:
+                targets.append(filename("list", url))       # List of things signedby
+            if "reverse" in subdir:
+                urls = (sig.get("urls") or []) if isinstance(sig, dict) else []
+                if not isinstance(urls, (list, tuple, set)):
+                    urls = [urls]
+                targets += [ filename("reverse", u) for u in urls ]     # Lists that this object is on
+            for f in targets:
+                if f:
+                    appends.setdefault(f, []).append(sig)
+        for f, sigs in appends.items():
+            self._rawadd(f, sigs)
 
     def set(self, url=None, database=None, table=None, keyvaluelist=None, keyvalues=None, value=None, verbose=False):
         #Add keyvalues to a table, note it doesnt delete existing keys and values, just writes to end
@@ -232,39 +1231,364 @@ class TransportLocal(Transport):
         filename = self._tablefilename(database, table, createdatabase=True)
         #TODO-KEYVALUE check and store sig which has to be on each keyvalue, not on entire set
         #TODO-KEYVALUE encode string in value for storing in quoted string
-        appendable = "".join([ dumps(kv)+"\n" for kv in keyvaluelist ]).encode('utf-8')    # Essentially jSON for array but without enclosing [ ]
-        self._rawadd(filename, appendable)
+        self._rawadd(filename, keyvaluelist)   # One record per key, see _encoderecords
+        self.maybecompact(filename, verbose=verbose)
+
+    # Each table file has a sidecar sqlite index <table>.idx mapping each key to where its latest record is, so a get doesnt
+    # replay the whole file. The index records how far into the table (and which inode) it has read, and catches up on
+    # whatever has been appended since before each use. Tables are only ever appended to, or replaced whole by compaction
+    # (which changes the inode), so the index can always be deleted and rebuilt (see indextables).
+    INDEXVERSION = 2                    # Bump if the index schema changes, old indexes are then rebuilt
+    _indexpools = {}                    # { indexfilename: SqlitePool }
+    _indexlocks = {}                    # { indexfilename: Lock } so only one thread per process catches up an index
+    _indexlockslock = threading.Lock()
+
+    @classmethod
+    def _indexconnection(cls, filename):
+        """
+        :return: context manager checking out a connection to the index of a table from a pool, see SqlitePool
+        """
+        indexfilename = filename + ".idx"
+        with cls._indexlockslock:
+            pool = cls._indexpools.get(indexfilename)
+            if pool is None:
+                def _connect():
+                    db = sqlite3.connect(indexfilename, timeout=30, isolation_level=None, check_same_thread=False)  # Autocommit, transactions are explicit
+                    db.execute("PRAGMA journal_mode = WAL;")
+                    db.execute("PRAGMA synchronous = NORMAL;")
+                    if db.execute("PRAGMA user_version;").fetchone()[0] != cls.INDEXVERSION:
+                        db.execute("DROP TABLE IF EXISTS keys;")
+                        db.execute("DROP TABLE IF EXISTS state;")
+                        db.execute("PRAGMA user_version = {:d};".format(cls.INDEXVERSION))
+                    # live is 0 for a deleted key (record without value), so garbage can be estimated without reading the table
+                    db.execute("CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, first INTEGER, offset INTEGER, length INTEGER, live INTEGER);")
+                    db.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value INTEGER);")
+                    return db
+                pool = cls._indexpools[indexfilename] = SqlitePool(_connect, config["local"]["sqlite_pool_size"])
+        return pool.connection()
+
+    @classmethod
+    def _indexlock(cls, filename):
+        with cls._indexlockslock:
+            return cls._indexlocks.setdefault(filename, threading.Lock())
+
+    @classmethod
+    def _tableindex(cls, db, filename, file, verbose=False):
+        """
+        Catch up the index for a table with the open table file
+
+        :param db:          Connection to the index, from _indexconnection, with table keys(key, first, offset, length, live), key is dumps(key)
+        :param filename:    Table file
+        :param file:        filename open for binary read, the index will describe this file
+        :return:            True, or False if file has since been replaced by compaction, reopen and try again
+        """
+        st = os.fstat(file.fileno())
+        state = dict(db.execute("SELECT name, value FROM state;").fetchall())
+        if state.get("inode") == st.st_ino and state.get("indexed", 0) == st.st_size:
+            return True     # Up to date, the usual case
+        with cls._indexlock(filename):
+            db.execute("BEGIN IMMEDIATE;")  # Locks against other processes catching up the same index
+            try:
+                if os.stat(filename).st_ino != st.st_ino:
+                    db.execute("ROLLBACK;")
+                    return False    # Dont go back to indexing a replaced file
+                state = dict(db.execute("SELECT name, value FROM state;").fetchall())    # May have changed while waiting
+                st = os.fstat(file.fileno())
+                indexed = state.get("indexed", 0)
+                if state.get("inode") != st.st_ino or indexed > st.st_size:  # Table replaced (e.g. compacted) or truncated
+                    if verbose: logging.debug("TransportLocal rebuilding index for {}".format(filename))
+                    db.execute("DELETE FROM keys;")
+                    indexed = 0
+                for offset, nextoffset, record in cls._records(filename, start=indexed, end=st.st_size, file=file):
+                    if record is not None:
+                        db.execute("INSERT INTO keys (key, first, offset, length, live) VALUES (?, ?, ?, ?, ?) "
+                                   "ON CONFLICT(key) DO UPDATE SET offset=excluded.offset, length=excluded.length, live=excluded.live;",
+                                   (dumps(record["key"]), offset, offset, nextoffset - offset, int("value" in record)))
+                    indexed = nextoffset
+                db.executemany("INSERT OR REPLACE INTO state (name, value) VALUES (?, ?);", [("indexed", indexed), ("inode", st.st_ino)])
+                db.execute("COMMIT;")
+            except BaseException:
+                if db.in_transaction:
+                    db.execute("ROLLBACK;")
+                raise
+        return True
+
+    @classmethod
+    def _tablequery(cls, filename, sql, params=(), verbose=False):
+        """
+        Run a query against the index of a table, consistently with the table file it describes
+
+        :return: (file, rows) file is the table open for read which caller must close, or (None, []) if no table yet
+        """
+        while True:
+            try:
+                f = open(filename, 'rb')
+            except FileNotFoundError:
+                return None, []
+            with cls._indexconnection(filename) as db:
+                if cls._tableindex(db, filename, f, verbose=verbose):
+                    db.execute("BEGIN;")    # Snapshot, so index isnt rebuilt for a newer file part way through
+                    try:
+                        if db.execute("SELECT value FROM state WHERE name = 'inode';").fetchone() == (os.fstat(f.fileno()).st_ino,):
+                            return f, db.execute(sql, params).fetchall()
+                    finally:
+                        db.execute("COMMIT;")
+            f.close()   # Compacted under us, go round again with the new file
+
+    def _tablerecords(self, filename, keys=None, verbose=False):
+        """
+        Latest record for each key (a deleted key's record has no value), in order keys were first set
+
+        :param keys:    list of keys wanted, or None for all
+        :return:        iterator of (key, record)
+        """
+        if keys is None:
+            batches = [ ("SELECT key, offset, length FROM keys ORDER BY first;", ()) ]
+        else:
+            jsonkeys = [ dumps(k) for k in keys ]
+            batches = [ ("SELECT key, offset, length FROM keys WHERE key IN ({}) ORDER BY first;".format(",".join("?"*len(jsonkeys[i:i+500]))), jsonkeys[i:i+500])
+                        for i in range(0, len(jsonkeys), 500) ]    # Stay under sqlites limit on parameters
+        for sql, params in batches:
+            f, rows = self._tablequery(filename, sql, params, verbose=verbose)
+            if f:
+                with f:
+                    format = self._fileformat(f)
+                    for key, offset, length in rows:
+                        yield loads(key), self._decoderecord(os.pread(f.fileno(), length, offset), format)
+
+    # Busy tables are also kept in memory as {key: value}, following the table by replaying only what has been appended
+    # since it was last read, so a lookup usually costs one stat. Tables over config["domains"]["tablecache_table_bytes"]
+    # are left to the index, and the least recently used tables are dropped to stay under config["domains"]["tablecache_bytes"]
+    _tablecache = OrderedDict()     # { filename: {"inode", "offset", "values": {key: value or None if deleted}, "lock"} }
+    _tablecachelock = threading.Lock()
+
+    @classmethod
+    def _tablecached(cls, filename, read, verbose=False):
+        """
+        Read the current state of a table from the in-memory cache, catching up with any appends
+
+        :param read:    function({key: value}) value is None for deleted keys, in order first set. Called with the cache
+                        locked as the dict is updated in place, so must copy anything it wants to keep
+        :return:        result of read, or None if table too big to cache
+        """
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            return read({})
+        if st.st_size > config["domains"]["tablecache_table_bytes"]:
+            with cls._tablecachelock:
+                cls._tablecache.pop(filename, None)
+            return None
+        with cls._tablecachelock:
+            entry = cls._tablecache.get(filename)
+            if entry is None:
+                entry = cls._tablecache[filename] = {"inode": None, "offset": 0, "values": {}, "lock": threading.Lock()}
+            cls._tablecache.move_to_end(filename)
+        with entry["lock"]:
+            if entry["inode"] == st.st_ino and entry["offset"] == st.st_size:
+                return read(entry["values"])    # Nothing appended, the usual case
+            try:
+                f = open(filename, 'rb')
+            except FileNotFoundError:
+                return read({})
+            with f:
+                st = os.fstat(f.fileno())   # The file actually being read, may be newer than the stat above
+                values = entry["values"]    # Updated in place, so catching up costs only what was appended
+                offset = entry["offset"]
+                if entry["inode"] != st.st_ino or offset > st.st_size:   # Replaced by compaction, replay from the start
+                    if verbose: logging.debug("TransportLocal replaying {} into cache".format(filename))
+                    values = {}
+                    offset = 0
+                for _, nextoffset, record in cls._records(filename, start=offset, end=st.st_size, file=f):
+                    if record is not None:
+                        values[record["key"]] = record.get("value")
+                    offset = nextoffset
+            entry.update(inode=st.st_ino, offset=offset, values=values)
+            result = read(values)
+        cls._tablecacheevict()
+        return result
+
+    @classmethod
+    def _tablecacheevict(cls):
+        with cls._tablecachelock:
+            total = sum(entry["offset"] for entry in cls._tablecache.values())
+            while total > config["domains"]["tablecache_bytes"] and len(cls._tablecache) > 1:
+                filename, entry = cls._tablecache.popitem(last=False)   # Least recently used
+                total -= entry["offset"]
+
+    _compacting = {}        # { filename: True } tables being compacted by this process (set() is shadowed by the method)
+    _compactchecked = {}    # { filename: size } size when last checked if worth compacting
+
+    def maybecompact(self, filename, verbose=False):
+        """
+        Compact a table in the background if enough of it is superseded or deleted records (config["domains"]["compact_garbage_ratio"]).
+        Only checks once the table has grown by a tenth since last checked, so cheap to call after every append.
+        """
+        try:
+            size = os.stat(filename).st_size
+        except FileNotFoundError:
+            return
+        if (size < config["domains"]["compact_min_size"]) or (size < self._compactchecked.get(filename, 0) * 1.1) or (filename in self._compacting):
+            return
+        self._compactchecked[filename] = size
+        f, rows = self._tablequery(filename, "SELECT SUM(length) FROM keys WHERE live;", verbose=verbose)
+        if f:
+            f.close()
+            livesize = (rows and rows[0][0]) or 0
+            if (1 - livesize / size) > config["domains"]["compact_garbage_ratio"]:
+                threading.Thread(target=self.compact, args=(filename,), kwargs={"verbose": verbose}, daemon=True).start()
+
+    @classmethod
+    def compact(cls, filename, verbose=False):
+        """
+        Rewrite a table with just the latest value of each key that hasnt been deleted, and swap it in atomically.
+        Safe against concurrent appends, in this or other processes: live records are copied without holding any lock,
+        then under the table's flock whatever was appended meanwhile is copied raw (later records win anyway) and the
+        new file renamed over the old. Appenders waiting on the lock notice the inode changed and append to the new file.
+        Note that deleted keys are dropped, so they no longer appear in keys() or getall()
+
+        :return: (oldsize, newsize) or None if already being compacted
+        """
+        with cls._indexlockslock:
+            if filename in cls._compacting:
+                return None
+            cls._compacting[filename] = True
+        try:
+            with open(filename + ".compact", 'wb') as lockfile:   # Only one compaction per table across processes
+                try:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None
+                # The first row is how far the index has read, with the live records in the same snapshot
+                f, rows = cls._tablequery(filename, "SELECT NULL, NULL, value FROM state WHERE name = 'indexed' "
+                                                    "UNION ALL SELECT offset, length, NULL FROM keys WHERE live ORDER BY 1;", verbose=verbose)
+                if not f:
+                    return None
+                with f:
+                    inode = os.fstat(f.fileno()).st_ino
+                    copied = rows[0][2]
+                    dirname = os.path.dirname(filename)
+                    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".tmp")
+                    try:
+                        with os.fdopen(fd, 'wb') as out:
+                            if cls._fileformat(f) == "msgpack":
+                                out.write(cls.RECORDMAGIC)
+                            for offset, length, _ in rows[1:]:
+                                out.write(os.pread(f.fileno(), length, offset))
+                            with open(filename, 'ab') as appendlock:     # Stop appends while catching up and swapping
+                                fcntl.flock(appendlock, fcntl.LOCK_EX)
+                                if os.fstat(appendlock.fileno()).st_ino != inode:
+                                    raise CodingException(message="Table {} replaced during compaction".format(filename))
+                                oldsize = os.fstat(f.fileno()).st_size
+                                while copied < oldsize:     # Appended since indexed, copy raw
+                                    chunk = os.pread(f.fileno(), min(oldsize - copied, 1048576), copied)
+                                    out.write(chunk)
+                                    copied += len(chunk)
+                                out.flush()
+                                os.fsync(out.fileno())
+                                newsize = out.tell()
+                                os.replace(tmpname, filename)
+                    except BaseException:
+                        if os.path.exists(tmpname):
+                            os.unlink(tmpname)
+                        raise
+            logging.info("TransportLocal.compact {} {} -> {} bytes".format(filename, oldsize, newsize))
+            cls._compactchecked[filename] = newsize
+            return oldsize, newsize
+        finally:
+            with cls._indexlockslock:
+                cls._compacting.pop(filename, None)
+
+    @classmethod
+    def compacttables(cls, directory, verbose=False):
+        """
+        Compact every table under directory e.g. config["domains"]["directory"]
+
+        :return: number of tables compacted
+        """
+        count = 0
+        for filename in cls._tablefiles(directory):
+            if cls.compact(filename, verbose=verbose):
+                count += 1
+        logging.info("TransportLocal.compacttables compacted {} tables in {}".format(count, directory))
+        return count
+
+    @classmethod
+    def _tablefiles(cls, directory):
+        for database in sorted(os.listdir(directory)):
+            dbdir = os.path.join(directory, database)
+            if os.path.isdir(dbdir):
+                for table in sorted(os.listdir(dbdir)):
+                    if not (table.startswith(".tmp") or os.path.splitext(table)[1] in cls.tablesidecarexts):
+                        yield os.path.join(dbdir, table)
+
+    tablesidecarexts = (".idx", ".idx-wal", ".idx-shm", ".compact")  # Files beside tables that arent tables
 
     def get(self, url=None, database=None, table=None, keys=None, verbose=False):
         #Add keyvalues to a table, note it doesnt delete existing keys and values, just writes to end
         filename = self._tablefilename(database, table, createdatabase=True)
-        resarr = self._rawlistreverse(filename=filename, verbose=False) # [ {key:k1, value:v1} {key:k2, value:v2}, {key:k1, value:v3}]
         #TODO-KEYVALUE check sig which has to be on each keyvalue, not on entire set
-        resdict = { kv["key"]: kv.get("value") for kv in resarr if kv["key"] in keys }               # {k1:v3, k2:v2} - replaces earlier with later values for same key
+        resdict = self._tablecached(filename, lambda values: { key: values[key] for key in keys if key in values }, verbose=verbose)
+        if resdict is not None:
+            return resdict
+        resdict = { key: record.get("value") for key, record in self._tablerecords(filename, keys=keys, verbose=verbose) }  # {k1:v3, k2:v2} - latest value for each key
         return resdict
 
     def delete(self, url=None, database=None, table=None, keys=None, verbose=False):
         # Add keyvalues to a table, note it doesnt delete existing keys and values, just writes to end
         filename = self._tablefilename(database, table)
         # TODO-KEYVALUE check and store sig which has to be on each keyvalue, not on entire set
-        appendable = ("\n".join([dumps({"key": key}) for key in keys]) + "\n").encode('utf-8')
-        self._rawadd(filename, appendable)
+        self._rawadd(filename, [ {"key": key} for key in keys ])    # A record without a value
+        self.maybecompact(filename, verbose=verbose)
 
     def keys(self, url=None, database=None, table=None, verbose=False):
         # Add keyvalues to a table, note it doesnt delete existing keys and values, just writes to end
         filename = self._tablefilename(database, table, createdatabase=True)
-        resarr = self._rawlistreverse(filename=filename, verbose=False) # [ {key:k1, value:v1} {key:k2, value:v2}, {key:k1, value:v3}]
-        #TODO-KEYVALUE check sig which has to be on each keyvalue, not on entire set
-        resdict = { kv["key"]: kv.get("value") for kv in resarr }               # {k1:v3, k2:v2} - replaces earlier with later values for same key
-        return list(resdict.keys()) # keys() returns a dict_keys object, want to return a list
+        keys = self._tablecached(filename, list, verbose=verbose)
+        if keys is not None:
+            return keys     # Includes deleted keys (until compacted), as always has
+        f, rows = self._tablequery(filename, "SELECT key FROM keys ORDER BY first;", verbose=verbose)
+        if f:
+            f.close()
+        return [ loads(key) for (key,) in rows ]    # Includes deleted keys (until compacted), as always has
 
     def getall(self, url=None, database=None, table=None, verbose=False):
         # Add keyvalues to a table, note it doesnt delete existing keys and values, just writes to end
         filename = self._tablefilename(database, table, createdatabase=True)
-        #logging.debug("XXX@getal {}".format(filename))
-        resarr = self._rawlistreverse(filename=filename, verbose=False) # [ {key:k1, value:v1} {key:k2, value:v2}, {key:k1, value:v3}]
         #TODO-KEYVALUE check sig which has to be on each keyvalue, not on entire set
-        resdict = { kv["key"]: kv.get("value") for kv in resarr }               # {k1:v3, k2:v2} - replaces earlier with later values for same key
+        resdict = self._tablecached(filename, dict, verbose=verbose)
+        if resdict is not None:
+            return resdict
+        resdict = { key: record.get("value") for key, record in self._tablerecords(filename, verbose=verbose) }  # {k1:v3, k2:v2} - latest value for each key
         return resdict
 
+    def getpage(self, url=None, database=None, table=None, after=0, limit=None, verbose=False):
+        """
+        Page through the records of a table in the order they were written, the latest record for a key wins and a
+        deleted key's record has no "value". Keep the returned nextoffset to fetch only changes next time.
+
+        :param after:   Cursor to start at, 0 or the nextoffset from the previous page
+        :param limit:   Maximum number of records
+        :return:        (iterator of {key, value}, nextoffset)
+        """
+        filename = self._tablefilename(database, table, createdatabase=True)
+        return self._recordspage(filename, after=after, limit=limit)
 
+    @classmethod
+    def indextables(cls, directory, verbose=False):
+        """
+        Build or bring up to date the index of every table under directory e.g. config["domains"]["directory"]
+        (which is .cache/table of the server), e.g. to convert existing tables rather than waiting for first use.
+
+        :param directory:   Containing <database>/<table>
+        :return:            number of tables indexed
+        """
+        count = 0
+        for filename in cls._tablefiles(directory):
+            f, _ = cls._tablequery(filename, "SELECT 1;", verbose=verbose)
+            if f:
+                f.close()
+            count += 1
+            if verbose: logging.debug("TransportLocal.indextables indexed {}".format(filename))
+        logging.info("TransportLocal.indextables indexed {} tables in {}".format(count, directory))
+        return count
@@ -18,6 +18,8 @@ config = {
         # "url_add_url": "http://localhost:5001/api/v0/add",  #TODO-IPFS move uses of url_add_data to urladd when its working
         "url_urlstore": "http://localhost:5001/api/v0/urlstore/add",    # Should have "ipfs daemon" running locally
         "url_dht_provide": "http://localhost:5001/api/v0/dht/provide",
+        "ingest_concurrency": 8,    # Files pushed to IPFS in parallel by ArchiveItem.cache_ipfs
+        "stream_chunksize": 1048576,    # Bytes per chunk when streaming from archive.org into IPFS add
     },
     "gateway": {
         "url_metadata": "https://https://dweb.me/arc/archive.org/metadata/",
@@ -28,12 +30,49 @@ config = {
     "httpserver": {  # Configuration used by generic HTTP server
         "favicon_url": "https://dweb.me/favicon.ico",
         "root_path": "info",
+        "max_upload": 2**30,        # Bytes, larger POSTs get a 413
+        "upload_memory": 1048576,   # Octet-stream POSTs bigger than this are passed to the handler as a file, not read into memory
     },
     "domains": {
         # This is also name of directory in /usr/local/dweb-gateway/.cache/table, if change this then can safely rename that directory to new name to retain metadata saved
         "metadataverifykey": 'NACL VERIFY:h9MB6YOnYEgby-ZRkFKzY3rPDGzzGZ8piGNwi9ltBf0=',
         "metadatapassphrase": "Replace this with something secret/arc/archive.org/metadata",                       # TODO - change for something secret!
         "directory": '/usr/local/dweb-gateway/.cache/table/',                             # Used by maintenance note overridden below for mitraglass (mitra's laptop)
+        "leaf_concurrency": 10,     # Number of items whose metadata is fetched in parallel for a batch of leafs (/arc/archive.org/leaf?key=a&key=b)
+        "compact_min_size": 1048576,    # Tables smaller than this are never compacted automatically
+        "compact_garbage_ratio": 0.5,   # Compact a table in the background once this fraction is superseded or deleted records
+        "tablecache_table_bytes": 16777216,     # Tables bigger than this are read via their index rather than kept in memory
+        "tablecache_bytes": 268435456,          # Total size of tables kept in memory, least recently used dropped beyond this
+    },
+    "local": {  # Files stored by TransportLocal (.cache)
+        "dir": ".cache",        # Directory for blocks, lists and tables, relative to the working directory
+        "group_commit": True,   # Concurrent appends to the same list or table file are written together
+        "fsync": True,          # Appends are synced to disk before returning
+        "block_filter": True,               # Keep a Bloom filter of blocks stored, so misses dont touch the disk
+        "block_filter_capacity": 10000000,  # Blocks the filter is sized for, grown if more are found when it is built
+        "block_filter_error": 0.01,         # Fraction of misses that still look on disk
+        "block_filter_refresh": 1,          # Seconds between checking for blocks stored by other processes
+        "block_filter_journal_bytes": 4 * 2**20,    # Size at which block/.journal is folded into block/.filter and emptied
+        "block_cache_bytes": 50 * 2**30,    # Budget for .cache/block, least recently used blocks that arent pinned are evicted beyond it, None to keep everything
+        "block_cache_lowwater": 0.9,        # Evict down to this fraction of the budget
+        "block_cache_interval": 60,         # Seconds between recording block use and checking the budget
+        "upload_chunksize": 1048576,        # Bytes read at a time when storing a block from an upload
+        "sqlite_pool_size": 8,      # Connections kept open to each table index and to the block cache index, shared by request threads
+        "record_format": "json",    # Format of new list and table files, "json" lines or "msgpack" (needs msgpack installed), see maintenance convertrecords
+    },
+    "doi": {
+        "sqlite_mmap_size": 268435456,      # Bytes of DOI sqlite database memory mapped by each connection
+        "sqlite_cache_kb": 65536,           # Page cache per connection
+        "sqlite_cached_statements": 256,    # Prepared statements kept per connection
+        "sqlite_pool_size": 16,             # Connections kept open to each DOI sqlite database, shared by request threads
+        "preload_batch": 5000,              # Files per pipelined Redis write in DOI.preload
+        "ipfs_concurrency": 4,              # DOI files pushed to IPFS in the background at once
+        "url_metadata": "http://dx.doi.org/",   # CSL-JSON metadata for a DOI
+        "metadata_ttl": 30*24*3600,         # Seconds to cache metadata from doi.org
+        "metadata_negative_ttl": 3600,      # Seconds to remember that doi.org failed for a DOI
+        "metadata_timeout": 10,             # Seconds to wait for doi.org
+        "metadata_concurrency": 8,          # Requests outstanding to doi.org at once
+        "batch_query_size": 500,            # DOIs per sqlite query when resolving a POSTed list
     },
     "directories": {
         "bootloader": "/usr/local/dweb-archive/dist/bootloader.html",               # Location of bootloader file, note overridden below for mitraglass (mitra's laptop)
@@ -1,10 +1,17 @@
 import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
 # This is run every 10 minutes by Cron (10 * 58 = 580 ~ 10 hours)
 from python.config import config
 import redis
 import base58
 from .HashStore import StateService
 from .TransportIPFS import TransportIPFS
+from .TransportLocal import TransportLocal
+from .DOI import DOI, DOIsearch
 
 logging.basicConfig(**config["logging"])    # For server
 
@@ -73,6 +80,156 @@ def resetipfs(removeipfs=False, reseedipfs=False, removemagnet=False, announcedh
                         announceddht = announceddht + 1
     logging.debug("Scanned {}, withipfs {}, deleted {}, reseeded {}, announced {}, magremoved {}".format(total, withipfs, removed, reseeded, announceddht, magremoved))
 
+def doiindexes(sqlitefile=None, verbose=False):
+    """
+    Add the covering indexes that let DOI.SQLJOINED resolve a DOI or sha1 from indexes alone, safe to rerun.
+    Needs write access to the database, which the server itself only opens read-only.
+
+    :param sqlitefile:  Path to database, default DOI.SQLITE
+    """
+    db = sqlite3.connect(sqlitefile or DOI.SQLITE)
+    for sql in [
+        'CREATE INDEX IF NOT EXISTS files_id_doi_doi_sha1 on files_id_doi (doi, sha1);',
+        'CREATE INDEX IF NOT EXISTS files_metadata_covering on files_metadata (sha1, mimetype, size_bytes, md5);',
+        'CREATE INDEX IF NOT EXISTS urls_covering on urls (sha1, url, datetime);',
+        'ANALYZE;',
+    ]:
+        if verbose: logging.debug("doiindexes: {}".format(sql))
+        db.execute(sql)
+    db.commit()
+    db.close()
+    logging.debug("doiindexes complete on {}".format(sqlitefile or DOI.SQLITE))
+
+def doipreload(restart=False, verbose=False):
+    """
+    Bulk load LocationService and MimetypeService from the DOI sqlite, resumes from the last batch unless restart
+
+    :param restart:     "restart" on the command line to start again from the first sha1
+    """
+    DOI.preload(resume=not restart, verbose=verbose)
+
+def doisearchindex(source="-", indexfile=None, verbose=False):
+    """
+    Build the DOIsearch full text index from an NDJSON file of works (or - for stdin)
+    """
+    if source == "-":
+        DOIsearch.build(sys.stdin, indexfile=indexfile, verbose=verbose)
+    else:
+        with open(source, encoding="utf-8") as f:
+            DOIsearch.build(f, indexfile=indexfile, verbose=verbose)
+
+def doinormalize(sqlitefile=None, batchsize=100000, verbose=False):
+    """
+    Add and fill files_id_doi.doi_norm = DOI.normalize(doi), and index it, so DOI lookups are insensitive to case, encoding and
+    insignificant punctuation. Resumable, only fills rows still NULL. Needs write access to the database.
+
+    :param sqlitefile:  Path to database, default DOI.SQLITE
+    """
+    db = sqlite3.connect(sqlitefile or DOI.SQLITE)
+    db.create_function("doinormalize", 1, DOI.normalize, deterministic=True)
+    if "doi_norm" not in [ row[1] for row in db.execute("PRAGMA table_info(files_id_doi);") ]:
+        db.execute("ALTER TABLE files_id_doi ADD COLUMN doi_norm text;")
+    done = 0
+    while True:
+        cur = db.execute("UPDATE files_id_doi SET doi_norm = doinormalize(doi) WHERE rowid IN "
+                         "(SELECT rowid FROM files_id_doi WHERE doi_norm IS NULL LIMIT ?);", [int(batchsize)])
+        db.commit()
+        if not cur.rowcount:
+            break
+        done += cur.rowcount
+        logging.debug("doinormalize {} rows".format(done))
+    db.execute("CREATE INDEX IF NOT EXISTS files_id_doi_norm_sha1 on files_id_doi (doi_norm, sha1, doi);")
+    db.execute("ANALYZE;")
+    db.commit()
+    db.close()
+    logging.debug("doinormalize complete, {} rows normalized in {}".format(done, sqlitefile or DOI.SQLITE))
+
+def migrateblocks(dir=".cache", verbose=False):
+    """
+    Move the local block store (default .cache as used by LocalResolver) from flat to sharded directories
+    """
+    TransportLocal(options={"local": {"dir": dir}}, verbose=verbose).migrateblocks(verbose=verbose)
+
+def indextables(directory=None, verbose=False):
+    """
+    Build the key index beside each KeyValueTable (default under config["domains"]["directory"]), converting existing tables
+    """
+    TransportLocal.indextables(directory or config["domains"]["directory"], verbose=verbose)
+
+def compacttables(directory=None, verbose=False):
+    """
+    Compact each KeyValueTable (default under config["domains"]["directory"]), dropping superseded and deleted records
+    """
+    TransportLocal.compacttables(directory or config["domains"]["directory"], verbose=verbose)
+
+def evictblocks(budget=None, dir=".cache", verbose=False):
+    """
+    Bring the block store (default .cache as used by LocalResolver) under budget bytes, default config["local"]["block_cache_bytes"],
+    first adding any blocks stored before it was managed
+    """
+    transport = TransportLocal(options={"local": {"dir": dir}}, verbose=verbose)
+    transport.indexblocks(verbose=verbose)
+    transport.evictblocks(budget=int(budget) if budget else None, verbose=verbose)
+
+def pinblock(multihash58, dir=".cache", verbose=False):
+    """
+    Stop a block being evicted from the block store
+    """
+    TransportLocal(options={"local": {"dir": dir}}, verbose=verbose).pin(multihash58, verbose=verbose)
+
+def unpinblock(multihash58, dir=".cache", verbose=False):
+    TransportLocal(options={"local": {"dir": dir}}, verbose=verbose).pin(multihash58, pinned=False, verbose=verbose)
+
+def convertrecords(format="msgpack", dir=".cache", tabledirectory=None, verbose=False):
+    """
+    Convert the lists (under dir, default .cache as used by LocalResolver) and KeyValueTables (default under
+    config["domains"]["directory"]) to format "msgpack" or "json", see config["local"]["record_format"] for new files
+    """
+    filenames = [ os.path.join(dir, subdir, name) for subdir in ("list", "reverse") if os.path.isdir(os.path.join(dir, subdir))
+                  for name in sorted(os.listdir(os.path.join(dir, subdir))) if not name.startswith(".tmp") ]
+    filenames += list(TransportLocal._tablefiles(tabledirectory or config["domains"]["directory"]))
+    count = sum(1 for filename in filenames if TransportLocal.convertrecords(filename, format, verbose=verbose))
+    logging.info("convertrecords converted {} of {} files to {}".format(count, len(filenames), format))
+
+def benchrecords(count=100000, verbose=False):
+    """
+    Compare size and read speed of a list of count records in each format, e.g. before changing config["local"]["record_format"]
+    """
+    records = [ {"key": "item{}".format(i), "value": {"identifier": "item{}".format(i), "title": "Title of item {}".format(i),
+                 "urls": ["ipfs:/ipfs/Qm{:044d}".format(i), "contenthash:/contenthash/5dq{:027d}".format(i)], "size": i * 1000}}
+                for i in range(int(count)) ]
+    with tempfile.TemporaryDirectory() as dirname:
+        for format in ("json", "msgpack"):
+            filename = os.path.join(dirname, format)
+            with open(filename, 'wb') as f:
+                f.write((TransportLocal.RECORDMAGIC if format == "msgpack" else b"") + TransportLocal._encoderecords(records, format))
+            start = time.time()
+            read = sum(1 for _, _, record in TransportLocal._records(filename) if record is not None)
+            elapsed = time.time() - start
+            print("{}: {} bytes, {} records read in {:.3f}s, {:.0f} records/s".format(format, os.path.getsize(filename), read, elapsed, read / elapsed))
+
+# Run from the top directory e.g. python3 -m python.maintenance doiindexes [data/idents_files_urls.sqlite]
+commands = {
+    "resetipfs": resetipfs,
+    "doiindexes": doiindexes,
+    "doinormalize": doinormalize,
+    "doipreload": doipreload,
+    "doisearchindex": doisearchindex,
+    "migrateblocks": migrateblocks,
+    "indextables": indextables,
+    "compacttables": compacttables,
+    "evictblocks": evictblocks,
+    "pinblock": pinblock,
+    "unpinblock": unpinblock,
+    "convertrecords": convertrecords,
+    "benchrecords": benchrecords,
+}
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print("Usage: python3 -m python.maintenance <{}> [args]".format("|".join(commands)))
+        sys.exit(1)
+    commands[sys.argv[1]](*sys.argv[2:])
+
 # To announce DHT under cron
 #logging.basicConfig(**config["logging"])    # For server
 #resetipfs(announcedht=True)
@@ -9,6 +9,9 @@ from magneturi import bencode
 import base64
 import hashlib
 import urllib.parse
+import queue
+import threading
+from contextlib import contextmanager
 from .Errors import TransportURLNotFound, ForbiddenException
 from .config import config
 
@@ -108,3 +111,67 @@ def httpget(url, wantmime=False, range=None):
             logging.error("HTTP request failed", exc_info=True)
             raise e  # For now just raise it
 
+
+def httpstream(url, range=None, chunksize=None):
+    """
+    Open a streamed GET on url, so that large content can be passed on without being held in memory
+
+    :param url:
+    :param range:       Optional range header
+    :param chunksize:   Size of chunks yielded by the returned iterator (default 1MB)
+    :return:            (iterator over chunks of bytes, mimetype)
+    :raises:            TransportURLNotFound, ForbiddenException or requests exceptions as for httpget
+    """
+    r = None  # So that if exception in get, r is still defined and can be tested for None
+    try:
+        logging.debug("GET streamed {} {}".format(url, range if range else ""))
+        headers = { "Connection": "keep-alive"}
+        if range: headers["range"] = range
+        r = requests.get(url, headers=headers, stream=True)
+        r.raise_for_status()
+        return r.iter_content(chunk_size=chunksize or 1048576), r.headers.get('content-type')
+    except (requests.exceptions.RequestException, requests.exceptions.HTTPError, requests.exceptions.InvalidSchema) as e:
+        if r is not None and (r.status_code == 404):
+            raise TransportURLNotFound(url=url)
+        elif r is not None and (r.status_code == 403):
+            raise ForbiddenException(what=e)
+        else:
+            logging.error("HTTP request failed err={}".format(e))
+            raise e
+
+
+class SqlitePool(object):
+    """
+    A bounded pool of connections to one sqlite database.
+    The server starts a thread per request, so a connection per thread would be opened (schema parsed, PRAGMAs run) on
+    every request and never reused; instead connections are checked out for a call and returned after it.
+
+    Use like:   with pool.connection() as db: rows = db.execute(...).fetchall()
+    """
+
+    def __init__(self, connect, size):
+        """
+        :param connect: function() returning a new sqlite3.Connection, opened with check_same_thread=False as it will
+                        move between threads (though only one uses it at a time)
+        :param size:    most connections open at once, callers beyond that wait for one to be returned
+        """
+        self.connect = connect
+        self.idle = queue.LifoQueue()   # Most recently used first, its pages are most likely to still be cached
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        self.slots.acquire()
+        try:
+            try:
+                db = self.idle.get_nowait()
+            except queue.Empty:
+                db = self.connect()
+            try:
+                yield db
+            finally:
+                if db.in_transaction:   # Left part way through by an exception, dont pass that on to the next caller
+                    db.rollback()
+                self.idle.put(db)
+        finally:
+            self.slots.release()
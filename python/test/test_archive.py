@@ -45,6 +45,16 @@ def test_leaf():
     res = _processurl(leafurl, verbose=verbose, key=item) # Should get value cached above
     if verbose: logging.debug("{} returned {}".format(leafurl, res))
 
+def test_leaves():
+    verbose=False
+    items = ["commute", "prelinger", "nosuchitematall"]
+    res = _processurl("arc/archive.org/leaf", verbose=verbose, key=items)  # Batch of leafs in one request
+    if verbose: logging.debug("leaf batch returned {}".format(res))
+    assert "commute" in res["data"] and "prelinger" in res["data"]
+    assert "nosuchitematall" not in res["data"]
+    res = _processurl("get/table/{}/domain".format(config["domains"]["metadataverifykey"]), verbose=verbose, key=items[0:2])
+    assert res["data"]["commute"] and res["data"]["prelinger"]
+
 def test_archiveerrs():
     verbose=True
     if verbose: logging.debug("Starting test_archiveid")
@@ -1,5 +1,10 @@
 from python.Multihash import Multihash
+from python.miscutils import loads, dumps
+from python.DOI import DOI, DOIfile, DOIsearch
 import logging
+import os
+import sqlite3
+import tempfile
 from ._utils import _processurl
 
 DOIURL = "metadata/doi/10.1001/jama.2009.1064"
@@ -18,13 +23,88 @@ SHA1BASESTRING="5drjPwBymU5TC4YNFK5aXXpwpFFbww" # Sha1 of above
 
 logging.basicConfig(level=logging.DEBUG)    # Log to stderr
 
+def _doisqlite(files, urls):
+    """
+    Make a small database like DOI.SQLITE in a temp dir
+
+    :param files:   [ (doi, sha1hex) ]
+    :param urls:    [ (sha1hex, url, datetime) ]
+    :return:        path to the database
+    """
+    path = os.path.join(tempfile.mkdtemp(prefix="test_doi"), "idents_files_urls.sqlite")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE files_id_doi (doi text not null, sha1 char(40) not null, type text);")
+    db.execute("CREATE TABLE files_metadata (sha1 char(40) not null, mimetype text, size_bytes integer, md5 char(32));")
+    db.execute("CREATE TABLE urls (sha1 char(40) not null, url text not null, datetime integer);")
+    db.executemany("INSERT INTO files_id_doi (doi, sha1) VALUES (?, ?);", files)
+    db.executemany("INSERT INTO files_metadata VALUES (?, 'application/pdf', 1234, NULL);", set((sha1,) for _, sha1 in files))
+    db.executemany("INSERT INTO urls VALUES (?, ?, ?);", urls)
+    db.commit()
+    db.close()
+    return path
+
 def test_doi_resolve():
     verbose=False   # True to debug
     res = _processurl(DOIURL, verbose)
     assert res["Content-type"] == "application/json"
     #assert res["data"]["files"][0]["sha1hex"] == PDF_SHA1HEX, "Would check sha1hex, but not returning now do multihash58"
     assert res["data"]["files"][0]["multihash58"] == CONTENTMULTIHASH
+    assert res["data"]["files"][0]["ipfsstatus"] in ("cached", "pending"), "IPFS push should not block the response"
+
+def test_doi_batch():
+    verbose=False
+    res = _processurl("metadata/doi", verbose, data=["10.1001/jama.2009.1064", "https://doi.org/10.1001/JAMA.2009.1064", "notadoi"])    # As if POSTed a JSON array
+    assert res["Content-type"] == "application/x-ndjson"
+    results = { r["doi"]: r for r in [ loads(line) for line in res["data"] ] }
+    assert len(results) == 3, "One result for each string sent, even if the same DOI"
+    assert results["10.1001/jama.2009.1064"]["metadata"]["files"][0]["multihash58"] == CONTENTMULTIHASH
+    assert results["https://doi.org/10.1001/JAMA.2009.1064"]["metadata"]["files"][0]["multihash58"] == CONTENTMULTIHASH
+    assert results["notadoi"]["error"]
+
+def test_doi_normalize():
+    assert DOI.normalize("https://doi.org/10.1001/JAMA.2009.1064.") == "10.1001/jama.2009.1064"
+    assert DOI.normalize("doi:10.1001%2Fjama.2009.1064") == "10.1001/jama.2009.1064"
+    assert DOI.canonical("10.1001", "JAMA.2009.1064") == "10.1001/jama.2009.1064"
+    assert DOI.normalize("10.1002/(SICI)1097-4636(199601)") == "10.1002/(sici)1097-4636(199601)"   # Balanced brackets are kept
+
+def test_doifile_shared_sha1():
+    oldsqlite = DOI.SQLITE
+    DOI.SQLITE = _doisqlite([("10.1/a", PDF_SHA1HEX), ("10.1/b", PDF_SHA1HEX)],
+                            [(PDF_SHA1HEX, "http://example.com/a.pdf", None), (PDF_SHA1HEX, "http://example.com/a2.pdf", None)])
+    try:
+        doifile = DOIfile(multihash=Multihash(sha1hex=PDF_SHA1HEX))
+        assert doifile._metadata["files"] == ["http://example.com/a.pdf", "http://example.com/a2.pdf"]   # Once each, though both DOIs have the file
+    finally:
+        DOI.SQLITE = oldsqlite
+
+def test_doi_unmigrated():
+    oldsqlite = DOI.SQLITE
+    DOI.SQLITE = _doisqlite([("10.1/abc.", PDF_SHA1HEX)], [(PDF_SHA1HEX, "http://example.com/abc.pdf", None)])   # No doi_norm column
+    try:
+        doi = DOI(None, "10.1", "ABC.")     # normalize drops the ".", but it is in the stored DOI
+        assert doi.doi == "10.1/abc."
+        assert doi._list[0]._metadata["files"] == ["http://example.com/abc.pdf"]
+    finally:
+        DOI.SQLITE = oldsqlite
 
+def test_doi_search():
+    works = [
+        {"doi": "10.1/c", "title": "Something else entirely", "topic": "fluid"},
+        {"doi": "10.1/b", "title": "Bubbles", "journal": "Journal of Fluid Mechanics", "author": [{"given": "Ann", "family": "Smith"}]},
+        {"doi": "10.1/a", "title": "Fluid dynamics of bubbles", "journal": "Nature"},
+    ]
+    oldindex = DOIsearch.SEARCHINDEX
+    DOIsearch.SEARCHINDEX = os.path.join(tempfile.mkdtemp(prefix="test_doi"), "doi_search.sqlite")
+    try:
+        assert DOIsearch.build([ dumps(w) + "\n" for w in works ] + ["not json\n"], batchsize=2) == 3
+        res = DOIsearch.search("fluid", do_highlight=True)
+        assert [ hit["doi"] for hit in res["hits"]["hits"] ] == ["10.1/a", "10.1/b", "10.1/c"], "Title beats journal beats topic"
+        assert res["hits"]["total"] == 3
+        assert res["hits"]["hits"][0]["highlight"]["title"] == ["<mark>Fluid</mark> dynamics of bubbles"]
+        assert [ hit["doi"] for hit in DOIsearch.search("author:smith")["hits"]["hits"] ] == ["10.1/b"]
+        assert DOIsearch.search("bubbles", limit=1)["hits"]["total"] == 2
+    finally:
+        DOIsearch.SEARCHINDEX = oldindex
 
 def test_contenthash_resolve():
     verbose=False   # True to debug
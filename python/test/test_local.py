@@ -1,7 +1,21 @@
+import io
 import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
 from datetime import datetime
+import pytest
 from ._utils import _processurl
 from python.miscutils import dumps, loads
+from python.LocalResolver import LocalResolver
+from python.config import config
+from python.Multihash import Multihash
+from python.TransportLocal import TransportLocal
+from python.ServerBase import MultipartParser, UploadStream
+from python.Errors import TransportFileNotFound, TransportCursorException, MultihashError
 
 logging.basicConfig(level=logging.DEBUG)    # Log to stderr
 
@@ -9,6 +23,14 @@ CONTENTMULTIHASH = "5dqpnTaoMSJPpsHna58ZJHcrcJeAjW"
 BASESTRING="A quick brown fox"
 SHA1BASESTRING="5drjPwBymU5TC4YNFK5aXXpwpFFbww" # Sha1 of above
 
+def setup_module():
+    # Each run starts from an empty cache, rather than whatever the last run left in .cache
+    setup_module.olddir = config["local"]["dir"]
+    config["local"]["dir"] = tempfile.mkdtemp(prefix="test_local")
+
+def teardown_module():
+    shutil.rmtree(config["local"]["dir"], ignore_errors=True)
+    config["local"]["dir"] = setup_module.olddir
 
 def test_local():
     verbose=True
@@ -17,20 +39,305 @@ def test_local():
     contenthash = res["data"]
     res = _processurl("content/rawfetch/{0}".format(contenthash), verbose)  # Simulate what the server would do with the URL #TODO-ARC
     if verbose: logging.debug("test_local content/rawfetch/{0} returned {1}".format(contenthash, res))
-    assert res["data"].decode('utf-8') == BASESTRING
+    with res["data"] as f:    # rawfetch returns the open block file, for the server to sendfile
+        assert f.read().decode('utf-8') == BASESTRING
     #res = _processurl("content/contenthash/{0}".format(contenthash), verbose)  # OLD STYLE
     res = _processurl("contenthash/{0}".format(contenthash), verbose)
     if verbose: logging.debug("test_local content/contenthash/{0} returned {1}".format(contenthash, res))
 
+def test_rawstore_stream():
+    transport = LocalResolver.transport()
+    data = bytes(range(256)) * 1000
+    oldchunksize = config["local"]["upload_chunksize"]
+    config["local"]["upload_chunksize"] = 10000     # So the upload takes many reads
+    try:
+        url = transport.rawstore(data=io.BytesIO(data))
+    finally:
+        config["local"]["upload_chunksize"] = oldchunksize
+    assert url == transport.url(multihash=Multihash(data=data, code=Multihash.SHA2_256))
+    assert transport.rawfetch(url) == data
+    boundary = "b0und4ry"
+    body = ("preamble\r\n--{0}\r\nContent-Disposition: form-data; name=\"x\"\r\n\r\nfield\r\n--{0}\r\n"
+            "Content-Disposition: form-data; name=\"data\"; filename=\"f.bin\"\r\n\r\n").format(boundary).encode() \
+           + data + "\r\n--{0}--\r\n".format(boundary).encode()
+    parts = MultipartParser(UploadStream(io.BufferedReader(io.BytesIO(body), 100), len(body)), boundary).parts()
+    name, filename, part = next(parts)
+    assert (name, filename, part.read()) == ("x", None, b"field")
+    name, filename, part = next(parts)
+    assert (name, filename) == ("data", "f.bin")
+    assert transport.rawstore(data=part) == url, "Streamed straight from the part"
+    assert list(parts) == []
+
+def test_evictblocks():
+    transport = TransportLocal(options={"local": {"dir": os.path.join(config["local"]["dir"], "evict")}}, verbose=False)
+    urls = []
+    for c in "ABCD":
+        urls.append(transport.rawstore(data=c.encode('utf-8') * 1000))
+        time.sleep(0.01)    # Distinct times of last use
+    transport.rawfetch(urls[0])     # A is now the most recently used
+    transport.pin(urls[1].split('/')[-1])   # B is oldest, but pinned
+    assert transport.evictblocks(budget=10000) == (0, 0)    # Under budget
+    assert transport.evictblocks(budget=2500) == (2, 2000)  # Down to 90% of budget, oldest unpinned first
+    for url, kept in zip(urls, (True, True, False, False)):
+        try:
+            transport.rawfetch(url)
+            assert kept, "{} should have been evicted".format(url)
+        except TransportFileNotFound:
+            assert not kept, "{} should have been kept".format(url)
+    data = b"E" * 1000
+    url = transport.rawstore(data=data)
+    time.sleep(0.01)
+    transport.rawstore(data=b"F" * 1000)
+    transport._blockcacheflush()
+    time.sleep(0.01)
+    transport._blockcache()["used"].clear()     # Stored again, as if by another process that hasnt flushed its use yet
+    assert transport.rawstore(data=data) == url
+    transport._blockcache()["used"].clear()
+    assert transport.evictblocks(budget=2500) == (2, 2000)
+    assert transport.rawfetch(url) == data, "Before F by the index, but just stored again so A and F evicted instead"
+
+def test_migrateblocks():
+    transport = TransportLocal(options={"local": {"dir": os.path.join(config["local"]["dir"], "migrate")}}, verbose=False)
+    data = b"flat block"
+    multihash = Multihash(data=data, code=Multihash.SHA2_256)
+    with open(transport._flatfilename("block", multihash), 'wb') as f:
+        f.write(data)
+    with open(os.path.join(transport.dir, "block", "README"), 'wb') as f:     # Not a block, must not stop the migration
+        f.write(b"stray")
+    shard = os.path.dirname(transport._filename("block", Multihash(data=b"other", code=Multihash.SHA2_256)))
+    os.makedirs(shard)
+    for name, age in ((".tmpold", TransportLocal.INCOMINGMAXAGE + 60), (".tmpnew", 0)):
+        with open(os.path.join(shard, name), 'wb') as f:
+            f.write(b"partial")
+        os.utime(os.path.join(shard, name), (time.time() - age, time.time() - age))
+    assert transport.migrateblocks() == 1
+    assert transport.rawfetch(transport.url(multihash=multihash)) == data
+    assert os.path.exists(os.path.join(transport.dir, "block", "README"))
+    assert sorted(os.listdir(shard)) == [".tmpnew"], "Only writes long abandoned are removed"
+
+def test_indexblocks():
+    dir = os.path.join(config["local"]["dir"], "index")
+    transport = TransportLocal(options={"local": {"dir": dir}}, verbose=False)
+    oldbudget = config["local"]["block_cache_bytes"]
+    config["local"]["block_cache_bytes"] = None     # No background thread, it would index the block itself
+    try:
+        transport.rawstore(data=b"stored before the cache index")
+        TransportLocal._blockcaches.pop(dir)    # Forget the use, as if stored by an old version
+        assert transport.evictblocks(budget=1) == (0, 0)    # Not known to the index, so cant count it
+        assert transport.indexblocks() == 1
+        assert transport.evictblocks(budget=1) == (1, len(b"stored before the cache index"))
+    finally:
+        config["local"]["block_cache_bytes"] = oldbudget
+
+def _storeblock(dir, data, compact):
+    # Run in another process, which has its own block filter
+    transport = TransportLocal(options={"local": {"dir": dir}}, verbose=False)
+    transport.rawstore(data=data)
+    if compact:
+        transport._compactjournal(TransportLocal._blockfilters[dir])
+
+def test_blockfilter():
+    dir = os.path.join(config["local"]["dir"], "filter")
+    transport = TransportLocal(options={"local": {"dir": dir}}, verbose=False)
+    oldconfig = dict(config["local"])
+    config["local"].update(block_filter_refresh=0, block_filter_journal_bytes=100)  # Compacted every couple of blocks
+    try:
+        while transport._blockfilter() is None:     # Built in the background
+            time.sleep(0.01)
+        for i in range(6):
+            data = "stored by another process {}".format(i).encode('utf-8')
+            p = multiprocessing.get_context("fork").Process(target=_storeblock, args=(dir, data, i % 3 == 2))
+            p.start()
+            p.join()
+            assert transport.rawfetch(transport.url(data=data)) == data, "Not in the filter yet, but must still be found"
+        time.sleep(0.5)     # Let this process's compaction finish
+        assert os.path.exists(dir + "/block/.filter")
+        assert os.path.getsize(dir + "/block/.journal") <= 100
+        assert transport.rawfetch(transport.url(data=b"stored by another process 0")) == b"stored by another process 0"
+    finally:
+        config["local"].update(oldconfig)
+
+def _settable(dir, database, table, keyvalues):
+    # Run in another process, which has its own table cache
+    TransportLocal(options={"local": {"dir": dir}}, verbose=False).set(database=database, table=table, keyvaluelist=keyvalues)
+
+def test_tablecache():
+    transport = LocalResolver.transport()
+    database, table = "Qtablecache", "cached"
+    assert transport.keys(database=database, table=table) == []     # Creates the database
+    transport.set(database=database, table=table, keyvaluelist=[{"key": "a", "value": 1}])
+    assert transport.get(database=database, table=table, keys=["a"]) == {"a": 1}   # Now cached
+    p = multiprocessing.get_context("fork").Process(target=_settable, args=(transport.dir, database, table, [{"key": "a", "value": 2}, {"key": "b", "value": 3}]))
+    p.start()
+    p.join()
+    assert transport.get(database=database, table=table, keys=["a", "b"]) == {"a": 2, "b": 3}
+    assert transport.getall(database=database, table=table) == {"a": 2, "b": 3}
+
+def _appendtable(dir, database, table, count):
+    # Run in another process, appending one record at a time
+    transport = TransportLocal(options={"local": {"dir": dir}}, verbose=False)
+    for i in range(count):
+        transport.set(database=database, table=table, keyvaluelist=[{"key": "new{}".format(i), "value": i}])
+
+def test_compact():
+    transport = LocalResolver.transport()
+    database, table = "Qcompact", "compacted"
+    transport.keys(database=database, table=table)      # Creates the database
+    for r in range(3):
+        transport.set(database=database, table=table, keyvaluelist=[{"key": "old{}".format(i), "value": r} for i in range(100)])
+    transport.delete(database=database, table=table, keys=["old0"])
+    filename = transport._tablefilename(database, table)
+    p = multiprocessing.get_context("fork").Process(target=_appendtable, args=(transport.dir, database, table, 300))
+    p.start()
+    compactions = 0
+    while p.is_alive() or not compactions:  # Compact over and over while the other process appends
+        if TransportLocal.compact(filename):
+            compactions += 1
+    p.join()
+    values = transport.getall(database=database, table=table)
+    assert values.get("old0") is None
+    assert all(values["old{}".format(i)] == 2 for i in range(1, 100))
+    assert all(values.get("new{}".format(i)) == i for i in range(300)), "Appended during compaction but lost"
+    TransportLocal.compact(filename)
+    assert len(list(TransportLocal._records(filename))) == 99 + 300, "Only the latest record of each live key is kept"
+
+def test_cursor_compacted():
+    transport = LocalResolver.transport()
+    database, table = "Qcursor", "paged"
+    transport.set(database=database, table=table, keyvaluelist=[{"key": "n{}".format(i), "value": i} for i in range(10)])
+    transport.set(database=database, table=table, keyvaluelist=[{"key": "n{}".format(i), "value": i} for i in range(10)])
+    records, cursor = transport.getpage(database=database, table=table, limit=15)
+    assert len(list(records)) == 15
+    records, _ = transport.getpage(database=database, table=table, after=cursor)
+    assert [ record["key"] for record in records ] == ["n{}".format(i) for i in range(5, 10)]
+    TransportLocal.compact(transport._tablefilename(database, table))
+    transport.set(database=database, table=table, keyvaluelist=[{"key": "n{}".format(i), "value": i} for i in range(10, 50)])
+    with pytest.raises(TransportCursorException):   # Offset may be a boundary of the new file, but the inode isnt
+        transport.getpage(database=database, table=table, after=cursor)
+    with pytest.raises(TransportCursorException):
+        transport.getpage(database=database, table=table, after="notacursor")
+    records, _ = transport.getpage(database=database, table=table, after=0)
+    assert len(list(records)) == 50
+
+def test_msgpack_records():
+    pytest.importorskip("msgpack")
+    filename = os.path.join(tempfile.mkdtemp(dir=config["local"]["dir"]), "records")
+    records = [ {"key": "k{}".format(i), "value": {"n": i, "s": "\u00e9" * i}} for i in range(5) ]
+    with open(filename, 'wb') as f:
+        f.write(TransportLocal.RECORDMAGIC + TransportLocal._encoderecords(records, "msgpack"))
+    frames = list(TransportLocal._records(filename))
+    assert [ record for _, _, record in frames ] == records
+    with open(filename, 'r+b') as f:
+        f.seek(frames[1][1] - 1)    # Last byte of the second record, so its crc32 doesnt match
+        last = f.read(1)[0]
+        f.seek(frames[1][1] - 1)
+        f.write(bytes([last ^ 0xff]))
+        f.seek(0, os.SEEK_END)
+        f.write(TransportLocal._encoderecords([{"key": "torn"}], "msgpack")[:-3])    # An append cut short
+    assert [ record for _, _, record in TransportLocal._records(filename) ] == records[:1] + [None] + records[2:], \
+        "Corrupt record returned as None, torn one at the end not returned"
+
+def test_convertrecords():
+    pytest.importorskip("msgpack")
+    filename = os.path.join(tempfile.mkdtemp(dir=config["local"]["dir"]), "records")
+    records = [ {"key": "k{}".format(i), "value": [i, "v{}".format(i)]} for i in range(2500) ]    # More than one batch
+    with open(filename, 'wb') as f:
+        f.write(TransportLocal._encoderecords(records, "json"))
+    jsondata = open(filename, 'rb').read()
+    assert TransportLocal.convertrecords(filename, "msgpack")
+    assert open(filename, 'rb').read().startswith(TransportLocal.RECORDMAGIC)
+    assert [ record for _, _, record in TransportLocal._records(filename) ] == records
+    assert not TransportLocal.convertrecords(filename, "msgpack")   # Already is
+    assert TransportLocal.convertrecords(filename, "json")
+    assert open(filename, 'rb').read() == jsondata
+
+def test_tableindex():
+    transport = LocalResolver.transport()
+    database, table = "Qtableindex", "indexed"
+    transport.keys(database=database, table=table)      # Creates the database
+    filename = transport._tablefilename(database, table)
+    oldcachebytes = config["domains"]["tablecache_table_bytes"]
+    config["domains"]["tablecache_table_bytes"] = 0     # So reads go to the index rather than the in-memory cache
+    try:
+        transport.set(database=database, table=table, keyvaluelist=[{"key": "a", "value": 1}, {"key": "b", "value": 2}])
+        assert transport.get(database=database, table=table, keys=["a", "b"]) == {"a": 1, "b": 2}
+        assert os.path.exists(filename + ".idx")
+        with open(filename + ".new", 'wb') as f:    # Replaced (new inode) by something other than compaction
+            f.write(TransportLocal._encoderecords([{"key": "a", "value": 9}], "json"))
+        os.replace(filename + ".new", filename)
+        assert transport.get(database=database, table=table, keys=["a", "b"]) == {"a": 9}, "Index rebuilt for the new table"
+        transport.set(database=database, table=table, keyvaluelist=[{"key": "c", "value": 3}])
+        assert transport.get(database=database, table=table, keys=["a", "c"]) == {"a": 9, "c": 3}, "Index caught up with the append"
+        TransportLocal._indexpools.pop(filename + ".idx")     # As if a new process ...
+        for ext in (".idx", ".idx-wal", ".idx-shm"):            # ... finding the index gone
+            if os.path.exists(filename + ext):
+                os.remove(filename + ext)
+        assert transport.get(database=database, table=table, keys=["a", "b", "c"]) == {"a": 9, "c": 3}, "Index rebuilt from the table"
+        assert transport.keys(database=database, table=table) == ["a", "c"]
+    finally:
+        config["domains"]["tablecache_table_bytes"] = oldcachebytes
+
+def test_concurrent_appends():
+    transport = LocalResolver.transport()
+    database, table = "Qappend", "appended"
+    transport.keys(database=database, table=table)      # Creates the database
+    threads, each = 8, 50
+    start = threading.Barrier(threads)
+    def _append(n):
+        start.wait()
+        for i in range(each):
+            transport.set(database=database, table=table, keyvaluelist=[{"key": "{}-{}".format(n, i), "value": str(n) * 5000}])
+    workers = [ threading.Thread(target=_append, args=(n,)) for n in range(threads) ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    records = [ record for _, _, record in TransportLocal._records(transport._tablefilename(database, table)) ]
+    assert None not in records, "Records interleaved"
+    assert sorted(record["key"] for record in records) == sorted("{}-{}".format(n, i) for n in range(threads) for i in range(each))
+    assert all(record["value"] == record["key"].split("-")[0] * 5000 for record in records)
+    assert not TransportLocal._appendqueues, "Queues are dropped once no thread is appending"
+    with pytest.raises(TransportFileNotFound):
+        transport._rawadd(os.path.join(transport.dir, "nosuchdir", "file"), [{"key": "a"}])
+    with pytest.raises(IsADirectoryError):  # Not a 404, e.g. disk full should be reported as it is
+        transport._rawadd(transport.dir, [{"key": "a"}])
+
+def test_rawaddbatch():
+    transport = TransportLocal(options={"local": {"dir": os.path.join(config["local"]["dir"], "batch")}}, verbose=False)
+    list1, list2, url1, url2 = [ Multihash(data=name.encode("utf-8"), code=Multihash.SHA2_256).multihash58 for name in ("list1", "list2", "url1", "url2") ]
+    sigs = [ {"urls": [url1, url2], "signature": "s0"},
+             {"urls": [url1, "http://example.com/notamultihash"], "signature": "s1"},
+             {"urls": url2, "signature": "s2"} ]
+    appended = []
+    rawadd = transport._rawadd
+    transport._rawadd = lambda filename, records: (appended.append(filename), rawadd(filename, records))
+    transport.rawaddbatch([ (list1, sigs[0]), (list2, sigs[1]), (list1, sigs[2]) ])
+    assert len(appended) == len(set(appended)) == 4, "One append to each of the two lists and two reverse lists"
+    assert [ sig["signature"] for sig in transport.rawlist(list1) ] == ["s0", "s2"]
+    assert [ sig["signature"] for sig in transport.rawlist(list2) ] == ["s1"]
+    assert [ sig["signature"] for sig in transport.rawreverse(url1) ] == ["s0", "s1"]
+    assert [ sig["signature"] for sig in transport.rawreverse(url2) ] == ["s0", "s2"]
+    with pytest.raises(MultihashError):
+        transport.rawaddbatch([ (list1, {"urls": [], "signature": "s3"}), ("notamultihash", {"urls": [], "signature": "s4"}) ])
+    assert [ sig["signature"] for sig in transport.rawlist(list1) ] == ["s0", "s2"], "Nothing stored if a list url is bad"
+
 def test_list():
     verbose = True
     date =  datetime.utcnow().isoformat()
     adddict = { "urls": [ CONTENTMULTIHASH ], "date": date, "signature": "XXYYYZZZ", "signedby": [ SHA1BASESTRING ], "verbose": verbose }
+    res = _processurl("void/rawadd/"+SHA1BASESTRING, verbose, data=dumps(dict(adddict, date="2000-01-01T00:00:00"))) # So there is a second page
     res = _processurl("void/rawadd/"+SHA1BASESTRING, verbose, data=dumps(adddict)) #TODO-ARC
     if verbose: logging.debug("test_list {0}".format(res))
     res = _processurl("metadata/rawlist/{0}".format(SHA1BASESTRING), verbose, data=dumps(adddict)) #TODO-ARC
     if verbose: logging.debug("rawlist returned {0}".format(res))
     assert res["data"][-1]["date"] == date
+    res = _processurl("metadata/rawlist/{0}".format(SHA1BASESTRING), verbose, limit=1)
+    assert len(res["data"]) == 1
+    res = _processurl("metadata/rawlist/{0}".format(SHA1BASESTRING), verbose, after=res["headers"]["X-Next-Offset"], output="ndjson")
+    assert loads(list(res["data"])[-1])["date"] == date
+    assert LocalResolver.transport().rawreverse(CONTENTMULTIHASH)[-1]["date"] == date   # Also on the reverse list of each of its urls
+    res = _processurl("void/rawadd/"+SHA1BASESTRING, verbose, data=dumps([dict(adddict, signature="batch0"), dict(adddict, signature="batch1")]))
+    assert [ sig["signature"] for sig in LocalResolver.transport().rawlist(SHA1BASESTRING)[-2:] ] == ["batch0", "batch1"]
 
 def test_keyvaluetable():  #TODO-ARC
     verbose=True